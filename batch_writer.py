@@ -0,0 +1,347 @@
+import sqlite3
+import time
+from loader_metrics import metrics
+
+try:
+    from mysql.connector.errors import InterfaceError, OperationalError
+    connection_error_types = (InterfaceError, OperationalError)
+except ImportError:
+    # SQLite-only setups, there is no MySQL connection to lose
+    connection_error_types = ()
+
+
+# MySQL errors that undo the open transaction: lock wait timeout and deadlock. A lock wait timeout only rolls back
+# the statement unless innodb_rollback_on_timeout is set, the writer rolls back the rest before replaying
+rollback_errors = {1205, 1213}
+# Client errors of a broken connection: server has gone away, lost connection during the query or to the server
+connection_errors = {2006, 2013, 2055}
+
+
+def connection_lost(error):
+    return isinstance(error, connection_error_types) or getattr(error, "errno", None) in connection_errors
+
+
+def print_insert_error(table, data, error):
+    print(f"Error inserting data into {table}: {error}")
+
+
+class BatchWriter:
+    """
+    Buffers rows per (table, column tuple) and writes them with executemany.
+    The INSERT text is built once per column set and reused for every batch.
+    Works with sqlite3 ("?" placeholders) and mysql.connector ("%s" placeholders).
+    On MySQL the batches sent since the last commit are kept, so a transaction rolled back by a deadlock
+    or lock wait timeout is replayed up to `max_replays` times instead of silently losing its rows.
+    With the db_pool.ConnectionPool `conn` came from, a broken connection is returned to the pool as broken
+    and the transaction is replayed on a new one, the pool reconnects with backoff.
+    """
+    def __init__(self, conn, placeholder="?", quote='"', batch_size=1000, commit=False, on_error=print_insert_error,
+                 max_replays=3, pool=None):
+        self.conn = conn
+        self.pool = pool
+        self.cursor = conn.cursor()
+        self.placeholder = placeholder
+        self.quote = quote
+        self.batch_size = max(1, batch_size)
+        self.commit = commit
+        self.on_error = on_error
+        # sqlite3 leaves the rows before a failing one inserted, a savepoint lets us undo them
+        self.use_savepoint = isinstance(conn, sqlite3.Connection)
+        self.buffers = {}
+        self.queries = {}
+        self.pending = 0
+        self.rows_written = 0
+        # Rows sent but not committed yet, and the batches holding them (MySQL only)
+        self.uncommitted = 0
+        self.rows_committed = 0
+        self.transaction = []
+        self.max_replays = max_replays
+        self.replays = 0
+
+
+    def add(self, table, data):
+        """
+        Queue one row. All buffers are flushed once `batch_size` rows are pending.
+        """
+        key = (table, tuple(data))
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = self.buffers[key] = []
+        buffer.append(tuple(data.values()))
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+
+    def query_for(self, key):
+        query = self.queries.get(key)
+        if query is None:
+            table, columns = key
+            column_list = ", ".join(f"{self.quote}{c}{self.quote}" for c in columns)
+            insert_values = ", ".join([self.placeholder] * len(columns))
+            query = f"INSERT INTO {table} ({column_list}) VALUES ({insert_values})"
+            self.queries[key] = query
+        return query
+
+
+    def flush(self):
+        """
+        Write every buffered row. Buffers are flushed in the order their column sets were
+        first seen, so parent rows (e.g. detection_info) go in before the rows referencing them.
+        """
+        for key, rows in self.buffers.items():
+            if rows:
+                # A new list, the transaction log may still hold the written one
+                self.buffers[key] = []
+                self.write_batch(key, rows)
+        self.pending = 0
+        if self.commit:
+            self.commit_now()
+
+
+    def commit_now(self):
+        attempt = 0
+        while True:
+            try:
+                self.conn.commit()
+                break
+            except Exception as e:
+                # A commit the server applied before the connection broke makes the replay fail on duplicate keys
+                if attempt == self.max_replays or not self.transaction_lost(e):
+                    raise
+                attempt += 1
+                self.replay(e)
+        self.rows_committed += self.uncommitted
+        self.uncommitted = 0
+        self.transaction = []
+
+
+    def send(self, key, rows):
+        self.cursor.executemany(self.query_for(key), rows)
+
+
+    def transaction_lost(self, error):
+        """
+        True when `error` undid the whole open transaction, not just the failed statement.
+        A broken connection only counts when the pool can replace it.
+        """
+        if getattr(error, "errno", None) in rollback_errors:
+            return True
+        return self.pool is not None and connection_lost(error)
+
+
+    def reconnect(self):
+        # conn is None when the last attempt to get a new one failed
+        if self.conn is not None:
+            self.pool.release(self.conn, broken=True)
+            self.conn = None
+        self.conn = self.pool.acquire()
+        self.cursor = self.conn.cursor()
+
+
+    def replay(self, error):
+        """
+        Roll back what is left of the transaction `error` interrupted, or reconnect when it broke the connection,
+        and send every logged batch again.
+        """
+        for attempt in range(1, self.max_replays + 1):
+            self.replays += 1
+            print(f"Transaction rolled back ({error}), replaying {self.uncommitted} uncommitted rows (attempt {attempt})")
+            try:
+                if self.pool is not None and connection_lost(error):
+                    self.reconnect()
+                else:
+                    self.conn.rollback()
+                for key, rows in self.transaction:
+                    self.send(key, rows)
+                return
+            except Exception as e:
+                if not self.transaction_lost(e):
+                    raise
+                error = e
+        raise error
+
+
+    def execute(self, key, rows):
+        """
+        Send one batch inside the open transaction and log it for replay.
+        When MySQL rolled the transaction back the logged batches are replayed and the batch is sent again,
+        a transaction that cannot be replayed raises.
+        """
+        attempt = 0
+        while True:
+            try:
+                self.send(key, rows)
+                break
+            except Exception as e:
+                if attempt == self.max_replays or not self.transaction_lost(e):
+                    raise
+                attempt += 1
+                self.replay(e)
+        if not self.use_savepoint:
+            self.transaction.append((key, rows))
+        self.rows_written += len(rows)
+        self.uncommitted += len(rows)
+
+
+    def write_batch(self, key, rows):
+        start_time = time.perf_counter()
+        try:
+            if self.use_savepoint:
+                if not self.conn.in_transaction:
+                    self.cursor.execute("BEGIN")
+                self.cursor.execute("SAVEPOINT batch_writer")
+            self.execute(key, rows)
+            if self.use_savepoint:
+                self.cursor.execute("RELEASE batch_writer")
+            metrics.record_batch(key[0], rows, time.perf_counter() - start_time)
+        except Exception as e:
+            if self.transaction_lost(e):
+                raise
+            if self.use_savepoint:
+                self.cursor.execute("ROLLBACK TO batch_writer")
+                self.cursor.execute("RELEASE batch_writer")
+            # Retry row by row so only the offending rows are reported and skipped
+            self.write_rows(key, rows)
+
+
+    def write_rows(self, key, rows):
+        table, columns = key
+        for row in rows:
+            start_time = time.perf_counter()
+            try:
+                self.execute(key, [row])
+                metrics.record_batch(table, [row], time.perf_counter() - start_time)
+            except Exception as e:
+                if self.transaction_lost(e):
+                    raise
+                metrics.record_error(table, e)
+                self.on_error(table, dict(zip(columns, row)), e)
+
+
+    def close(self):
+        self.flush()
+        self.cursor.close()
+
+
+class MySQLBatchWriter(BatchWriter):
+    """
+    Group-commit writer for mysql.connector.
+    Sends multi-row INSERT ... VALUES (...),(...) statements kept under max_allowed_packet
+    and commits every `commit_rows` rows or `commit_interval_ms` milliseconds, whichever comes first.
+    """
+    def __init__(self, conn, batch_size=1000, commit_rows=10000, commit_interval_ms=1000,
+                 max_packet=None, on_error=print_insert_error, max_replays=3, pool=None):
+        super().__init__(conn, placeholder="%s", quote="`", batch_size=batch_size, commit=False, on_error=on_error,
+                         max_replays=max_replays, pool=pool)
+        self.commit_rows = commit_rows
+        self.commit_interval = commit_interval_ms / 1000
+        if max_packet is None:
+            self.cursor.execute("SELECT @@max_allowed_packet")
+            max_packet = int(self.cursor.fetchone()[0])
+        # Leave headroom for the statement text and protocol overhead
+        self.max_statement_bytes = int(max_packet * 0.9)
+        self.statements = {}
+        self.last_commit = time.monotonic()
+        self.commits = 0
+
+
+    def add(self, table, data):
+        super().add(table, data)
+        if self.pending and time.monotonic() - self.last_commit >= self.commit_interval:
+            self.flush()
+
+
+    def flush(self):
+        super().flush()
+        if self.uncommitted >= self.commit_rows or time.monotonic() - self.last_commit >= self.commit_interval:
+            self.commit_now()
+
+
+    def commit_now(self):
+        with metrics.timer("all", "commit"):
+            super().commit_now()
+        self.last_commit = time.monotonic()
+        self.commits += 1
+
+
+    def statement_parts(self, key):
+        parts = self.statements.get(key)
+        if parts is None:
+            table, columns = key
+            prefix = f"INSERT INTO {table} ({', '.join(f'`{c}`' for c in columns)}) VALUES "
+            row_values = "(" + ", ".join(["%s"] * len(columns)) + ")"
+            parts = self.statements[key] = (prefix, row_values)
+        return parts
+
+
+    def send(self, key, rows):
+        prefix, row_values = self.statement_parts(key)
+        query = prefix + ", ".join([row_values] * len(rows))
+        self.cursor.execute(query, [value for row in rows for value in row])
+
+
+    def write_batch(self, key, rows):
+        prefix, row_values = self.statement_parts(key)
+        row_text = len(row_values) + 2
+
+        chunk = []
+        chunk_bytes = len(prefix)
+        for row in rows:
+            row_bytes = row_text + estimate_row_bytes(row)
+            if chunk and chunk_bytes + row_bytes > self.max_statement_bytes:
+                self.write_statement(key, chunk)
+                chunk = []
+                chunk_bytes = len(prefix)
+            chunk.append(row)
+            chunk_bytes += row_bytes
+        if chunk:
+            self.write_statement(key, chunk)
+
+
+    def write_statement(self, key, rows):
+        start_time = time.perf_counter()
+        try:
+            self.execute(key, rows)
+            metrics.record_batch(key[0], rows, time.perf_counter() - start_time)
+        except Exception as e:
+            if self.transaction_lost(e):
+                raise
+            # A failed statement is rolled back on its own, retry row by row to report the bad rows
+            self.write_rows(key, rows)
+
+
+    def close(self):
+        super().flush()
+        self.commit_now()
+        self.cursor.close()
+
+
+# Bytes MySQL escapes with a backslash in a quoted literal
+_escaped_bytes = b"\\'\"\0\n\r\x1a"
+
+
+def escaped_size(data):
+    """
+    Size of bytes escaped inside a MySQL string literal (without the quotes), one extra byte per escaped byte.
+    """
+    return len(data) * 2 - len(data.translate(None, _escaped_bytes))
+
+
+def estimate_row_bytes(row):
+    """
+    Upper bound of the escaped size of a row's values in the statement text.
+    Strings are measured in UTF-8, so multi-byte characters and escapes are counted.
+    """
+    size = 0
+    for value in row:
+        if isinstance(value, str):
+            size += escaped_size(value.encode()) + 2
+        elif isinstance(value, (bytes, bytearray)):
+            # Sent as _binary'...'
+            size += escaped_size(value) + 9
+        elif value is None:
+            size += 4
+        else:
+            size += len(str(value)) + 2
+    return size
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import time
+
+
+def file_hash(filepath, chunk_size=1024 * 1024):
+    """
+    blake2b digest of a file's content, read in chunks.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(filepath, "rb") as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CheckpointManifest:
+    """
+    Per-target record of which export files were loaded and how far.
+    For every file it keeps size, mtime, content hash, the number of entries committed
+    and whether the file is done, in a JSON file written atomically on save().
+    A manifest without a path keeps nothing and loads every file from the start.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                self.files = json.load(file).get("files", {})
+
+
+    @staticmethod
+    def key(filepath):
+        return os.path.normpath(filepath)
+
+
+    def start_file(self, filepath):
+        """
+        Number of entries of `filepath` already committed, or None when the whole file is loaded.
+        A file whose size or mtime changed is re-hashed, if the content changed it loads from the start.
+        """
+        if not self.path:
+            return 0
+        stat = os.stat(filepath)
+        record = self.files.get(self.key(filepath))
+        if record and (record["size"], record["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns):
+            content_hash = file_hash(filepath)
+            if content_hash == record["hash"]:
+                record["size"], record["mtime_ns"] = stat.st_size, stat.st_mtime_ns
+            else:
+                print(f"{os.path.basename(filepath)}: changed since the last load, loading it again")
+                record = None
+        if record is None:
+            record = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "hash": file_hash(filepath),
+                "entries": 0,
+                "done": False,
+            }
+            self.files[self.key(filepath)] = record
+        return None if record["done"] else record["entries"]
+
+
+    def mark(self, filepath, entries, done=False):
+        """
+        Record progress in memory, call save() once the rows up to `entries` are committed.
+        """
+        record = self.files.get(self.key(filepath))
+        if record is None:
+            return
+        record["entries"] = entries
+        record["done"] = done
+        record["updated"] = time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+    def save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump({"files": self.files}, file, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+def manifest_for(checkpoint_directory, target):
+    """
+    Open the manifest of a target database, checkpoints are off when `checkpoint_directory` is empty.
+    """
+    if not checkpoint_directory:
+        return CheckpointManifest(None)
+    name = "".join(c if c.isalnum() or c in "-_." else "_" for c in target)
+    return CheckpointManifest(os.path.join(checkpoint_directory, f"{name}.json"))
@@ -0,0 +1,215 @@
+import os
+import queue
+import threading
+import time
+import mysql.connector
+from contextlib import contextmanager
+
+
+def mysql_configs(target):
+    """
+    Connection configs from the environment, one for "mysql", one per shard for "shards".
+    """
+    if target == "mysql":
+        ports = [("MYSQL_PORT", "MYSQL_DB")]
+    else:
+        ports = [(f"MYSQL_SHARD{i}_PORT", f"MYSQL_SHARD{i}_DB") for i in range(1, 5)]
+    return [
+        {
+            'host': os.getenv("MYSQL_HOST"),
+            'port': os.getenv(port),
+            'user': os.getenv("MYSQL_USER"),
+            'password': os.getenv("MYSQL_PASSWORD"),
+            'database': os.getenv(database)
+        }
+        for port, database in ports
+    ]
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of mysql.connector connections to one database.
+    Opens up to `size` connections on demand (`min_size` of them up front), validates a connection
+    that sat idle for more than `validate_after` seconds before handing it out, and reconnects
+    with exponential backoff when the server is not reachable.
+    Keeps checkout wait-time metrics, see stats().
+    """
+    def __init__(self, config, size=4, min_size=1, name="mysql", validate_after=1.0,
+                 max_retries=5, backoff=0.5, max_backoff=10.0):
+        self.config = config
+        self.size = max(1, size)
+        self.name = name
+        self.validate_after = validate_after
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # (connection, time it was returned), most recently used first
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.closed = False
+
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.reconnects = 0
+        self.connect_failures = 0
+
+        for _ in range(min(min_size, self.size)):
+            self.idle.put((self.connect(), time.monotonic()))
+            self.created += 1
+
+
+    def connect(self):
+        """
+        Open a new connection, retrying with exponential backoff.
+        """
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                return mysql.connector.connect(**self.config)
+            except mysql.connector.Error as e:
+                self.connect_failures += 1
+                if attempt == self.max_retries:
+                    raise
+                print(f"[{self.name}] connect failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+
+    def validate(self, conn):
+        """
+        Return a working connection: `conn` when it answers a ping, otherwise a new one.
+        """
+        try:
+            conn.ping(reconnect=False)
+            return conn
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            self.reconnects += 1
+            return self.connect()
+
+
+    def acquire(self, timeout=None):
+        """
+        Check out a connection, waiting up to `timeout` seconds (forever when None) when all are in use.
+        """
+        start_time = time.perf_counter()
+        waited = False
+        while True:
+            try:
+                conn, returned_at = self.idle.get_nowait()
+                break
+            except queue.Empty:
+                pass
+            with self.lock:
+                grow = self.created < self.size
+                if grow:
+                    self.created += 1
+            if grow:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+                returned_at = None
+                break
+
+            if not waited:
+                waited = True
+                with self.lock:
+                    self.waits += 1
+            # Wake up regularly, a dropped connection frees a slot without anything being returned
+            try:
+                conn, returned_at = self.idle.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if timeout is not None and time.perf_counter() - start_time >= timeout:
+                    raise PoolTimeout(f"[{self.name}] no connection available after {timeout}s")
+
+        if returned_at is not None and time.monotonic() - returned_at > self.validate_after:
+            conn = self.validate(conn)
+
+        elapsed = time.perf_counter() - start_time
+        with self.lock:
+            self.checkouts += 1
+            self.wait_time += elapsed
+            self.max_wait_time = max(self.max_wait_time, elapsed)
+        return conn
+
+
+    def release(self, conn, broken=False):
+        """
+        Return a connection to the pool, rolling back anything left uncommitted.
+        A `broken` connection is closed and the next checkout opens a new one.
+        """
+        if self.closed:
+            conn.close()
+            return
+        if not broken:
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except Exception:
+                broken = True
+        if not broken:
+            self.idle.put((conn, time.monotonic()))
+            return
+        # Broken connection, drop it so the next checkout opens a new one
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self.lock:
+            self.created -= 1
+
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "open": self.created,
+            "checkouts": self.checkouts,
+            "waits": self.waits,
+            "avg_wait_ms": self.wait_time / self.checkouts * 1000 if self.checkouts else 0.0,
+            "max_wait_ms": self.max_wait_time * 1000,
+            "reconnects": self.reconnects,
+            "connect_failures": self.connect_failures,
+        }
+
+
+    def report(self):
+        stats = self.stats()
+        print(f"[{self.name}] pool: {stats['open']}/{stats['size']} connections, {stats['checkouts']} checkouts, "
+              f"{stats['waits']} waited (avg {stats['avg_wait_ms']:.2f} ms, max {stats['max_wait_ms']:.2f} ms), "
+              f"{stats['reconnects']} reconnects")
+
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                conn, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.close()
+            except Exception:
+                pass
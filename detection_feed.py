@@ -0,0 +1,484 @@
+import heapq
+import os
+import sqlite3
+import sys
+import time
+from dotenv import load_dotenv
+from frame_dedup import frame_column, frame_join, has_frame_table
+from tsv_loader import TsvBulkLoader
+
+
+load_dotenv()
+
+feed_table = "credocommon_detection_feed"
+detection_table = "credocommon_detection"
+
+# Rows per feed page, and rows per fetchmany while a page streams in
+feed_page_size = int(os.getenv("FEED_PAGE_SIZE", "1000"))
+feed_fetch_size = int(os.getenv("FEED_FETCH_SIZE", "500"))
+# "feed" pages credocommon_detection_feed, "join" pages credocommon_detection joined to its users and teams
+feed_source = os.getenv("FEED_SOURCE", "feed")
+
+# Clustered on (timestamp, detection_id): the latest detections are one range scan, no join chain and no sort.
+# Frames stay in credocommon_detection and are fetched by primary key.
+sqlite_feed_ddl = f"""
+    CREATE TABLE IF NOT EXISTS {feed_table} (
+        timestamp BIGINT NOT NULL,
+        detection_id INTEGER NOT NULL,
+        device_id INTEGER NOT NULL,
+        username VARCHAR(150),
+        display_name VARCHAR(50),
+        team_name VARCHAR(255),
+        PRIMARY KEY (timestamp, detection_id)
+    ) WITHOUT ROWID
+"""
+
+mysql_feed_ddl = f"""
+    CREATE TABLE IF NOT EXISTS `{feed_table}` (
+        `timestamp` TIMESTAMP NOT NULL,
+        `detection_id` int NOT NULL,
+        `device_id` int NOT NULL,
+        `username` varchar(150) DEFAULT NULL,
+        `display_name` varchar(50) DEFAULT NULL,
+        `team_name` varchar(255) DEFAULT NULL,
+        PRIMARY KEY (`timestamp`, `detection_id`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci
+"""
+
+def feed_select(frame="det.frame_content", join=""):
+    """
+    What the feed page reads, the read-model version of performance_test's latest_detections.
+    """
+    return f"""
+    SELECT
+        {frame} AS detection_frame_content,
+        f.timestamp AS detection_timestamp,
+        f.username AS user_username,
+        f.display_name AS user_display_name,
+        f.team_name AS user_team_name
+    FROM
+        {feed_table} f
+    JOIN
+        {detection_table} det ON det.id = f.detection_id
+    {join}
+    ORDER BY
+        f.timestamp DESC, f.detection_id DESC
+    LIMIT 800000
+"""
+
+
+feed_query = feed_select()
+# SQLite also finds the frames deduplicated into credocommon_frame
+sqlite_feed_query = feed_select(frame_column, frame_join)
+
+owner_query = """
+    SELECT u.username, u.display_name, t.name
+    FROM credocommon_device d
+    JOIN credocommon_user u ON d.user_id = u.id
+    LEFT JOIN credocommon_team t ON u.team_id = t.id
+    WHERE d.id = {placeholder}
+"""
+
+rebuild_select = f"""
+    SELECT det.timestamp, det.id, det.device_id, u.username, u.display_name, t.name
+    FROM {detection_table} det
+    LEFT JOIN credocommon_device d ON det.device_id = d.id
+    LEFT JOIN credocommon_user u ON d.user_id = u.id
+    LEFT JOIN credocommon_team t ON u.team_id = t.id
+    WHERE det.id > {{placeholder}} AND det.id <= {{placeholder}}
+"""
+
+# Feed rows whose detection is gone or has another timestamp now
+orphans_condition = f"""
+    NOT EXISTS (
+        SELECT 1 FROM {detection_table} det WHERE det.id = {feed_table}.detection_id AND det.timestamp = {feed_table}.timestamp
+    )
+"""
+
+
+# Source, (timestamp, id) key columns and the columns of a page row: timestamp, detection id, username, display_name, team name
+page_sources = {
+    "feed": (
+        f"{feed_table} f",
+        ("f.timestamp", "f.detection_id"),
+        "f.timestamp, f.detection_id, f.username, f.display_name, f.team_name",
+    ),
+    "join": (
+        f"""{detection_table} det
+        LEFT JOIN credocommon_device d ON det.device_id = d.id
+        LEFT JOIN credocommon_user u ON d.user_id = u.id
+        LEFT JOIN credocommon_team t ON u.team_id = t.id""",
+        ("det.timestamp", "det.id"),
+        "det.timestamp, det.id, u.username, u.display_name, t.name",
+    ),
+}
+
+
+def page_query(placeholder="?", source="feed", after=False):
+    """
+    One feed page, newest first. With `after` the page continues below a (timestamp, id) key, the first
+    condition bounds the index range and the second one skips the rows of the key's own timestamp already read.
+    Parameters: (limit,) or (timestamp, timestamp, id, limit).
+    """
+    table, (timestamp, key), columns = page_sources[source]
+    where = f"WHERE {timestamp} <= {placeholder} AND ({timestamp} < {placeholder} OR {key} < {placeholder})" if after else ""
+    return f"""
+    SELECT {columns}
+    FROM {table}
+    {where}
+    ORDER BY {timestamp} DESC, {key} DESC
+    LIMIT {placeholder}
+    """
+
+
+def is_sqlite(conn):
+    return isinstance(conn, sqlite3.Connection)
+
+
+def ensure_feed_table(conn):
+    """
+    Create the feed table on an SQLite or MySQL connection when missing.
+    """
+    cursor = conn.cursor()
+    cursor.execute(sqlite_feed_ddl if is_sqlite(conn) else mysql_feed_ddl)
+    cursor.close()
+    conn.commit()
+
+
+class FeedDirectory:
+    """
+    Names the feed denormalizes, kept from the teams, users and devices the loader passes through.
+    Devices loaded by an earlier run are looked up with `lookup(device_id)` once and cached.
+    A device the lookup did not find is not looked up again until forget_missing(), called when the writer
+    flushes, since until then the database cannot have learned about it.
+    """
+    def __init__(self, lookup=None):
+        self.lookup = lookup
+        self.teams = {}
+        self.users = {}
+        self.devices = {}
+        self.owners = {}
+        self.missing = set()
+        self.lookups = 0
+        self.unresolved = 0
+
+
+    def observe(self, table, data):
+        if table == "credocommon_team":
+            self.teams[data["id"]] = data.get("name")
+            self.owners.clear()
+        elif table == "credocommon_user":
+            self.users[data["id"]] = (data.get("username"), data.get("display_name"), data.get("team_id"))
+            self.owners.clear()
+        elif table == "credocommon_device":
+            self.devices[data["id"]] = data.get("user_id")
+            self.owners.pop(data["id"], None)
+            self.missing.discard(data["id"])
+
+
+    def forget_missing(self):
+        self.missing.clear()
+
+
+    def owner(self, device_id, lookup=None):
+        """
+        (username, display_name, team name) of a device's user, None values when it cannot be resolved.
+        """
+        owner = self.owners.get(device_id)
+        if owner is not None:
+            return owner
+        user = self.users.get(self.devices.get(device_id))
+        if user is not None:
+            username, display_name, team_id = user
+            owner = (username, display_name, self.teams.get(team_id))
+        else:
+            lookup = lookup or self.lookup
+            row = None
+            if lookup and device_id not in self.missing:
+                row = lookup(device_id)
+                self.lookups += 1
+            if row is None:
+                self.unresolved += 1
+                # Not cached as an owner, the device may still arrive later in the load
+                self.missing.add(device_id)
+                return (None, None, None)
+            owner = tuple(row)
+        self.owners[device_id] = owner
+        return owner
+
+
+    def feed_row(self, detection, lookup=None):
+        username, display_name, team_name = self.owner(detection["device_id"], lookup)
+        return {
+            "timestamp": detection["timestamp"],
+            "detection_id": detection["id"],
+            "device_id": detection["device_id"],
+            "username": username,
+            "display_name": display_name,
+            "team_name": team_name,
+        }
+
+
+    def report(self, name="feed"):
+        print(f"[{name}] detection feed: {len(self.owners)} devices resolved, {self.lookups} database lookups, "
+              f"{self.unresolved} detections without a known owner (run the rebuild to fill them in)")
+
+
+def connection_lookup(conn):
+    """
+    Owner lookup on an open SQLite or MySQL connection, it sees the rows this connection wrote but did not commit.
+    """
+    query = owner_query.format(placeholder="?" if is_sqlite(conn) else "%s")
+
+    def lookup(device_id):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(query, (device_id,))
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        return rows[0] if rows else None
+    return lookup
+
+
+class FeedWriter:
+    """
+    Wraps a row writer (BatchWriter, TsvBulkLoader, FrameDedupWriter) so every detection also gets its feed row.
+    Everything else is passed to the wrapped writer unchanged.
+    """
+    def __init__(self, writer, directory=None):
+        self.writer = writer
+        # LOAD DATA only fills the database at the end, there is nothing to look up before that
+        self.directory = directory or FeedDirectory(None if isinstance(writer, TsvBulkLoader) else self.lookup)
+
+
+    def lookup(self, device_id):
+        # The writer's connection, which it may have replaced after losing the old one
+        return connection_lookup(self.writer.conn)(device_id)
+
+
+    def add(self, table, data):
+        self.directory.observe(table, data)
+        self.writer.add(table, data)
+        if table == detection_table:
+            self.writer.add(feed_table, self.directory.feed_row(data))
+
+
+    def flush(self):
+        self.writer.flush()
+        self.directory.forget_missing()
+
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+
+class DetectionFeed:
+    """
+    Keyset-paginated reader of the latest detections on one SQLite or MySQL connection.
+    A page continues after the (timestamp, id) of the previous page's last row, so every page is one index range
+    scan however deep the reader goes, where OFFSET reads and throws away every row before it.
+    Pages stream in with fetchmany from an unbuffered cursor and carry no frames, frames() fetches them on demand.
+    """
+    def __init__(self, conn, page_size=feed_page_size, fetch_size=feed_fetch_size, source=feed_source):
+        self.conn = conn
+        self.page_size = page_size
+        self.fetch_size = fetch_size
+        self.sqlite = is_sqlite(conn)
+        # Frames deduplicated into credocommon_frame are only there after a load with FRAME_DEDUP
+        self.frame_join = self.sqlite and has_frame_table(conn)
+        self.placeholder = "?" if self.sqlite else "%s"
+        self.first_query = page_query(self.placeholder, source)
+        self.next_query = page_query(self.placeholder, source, after=True)
+
+
+    def stream_page(self, after=None, limit=None):
+        """
+        Yield the rows of one page as they arrive from the server.
+        """
+        limit = limit or self.page_size
+        cursor = self.conn.cursor()
+        try:
+            if after is None:
+                cursor.execute(self.first_query, (limit,))
+            else:
+                timestamp, detection_id = after
+                cursor.execute(self.next_query, (timestamp, timestamp, detection_id, limit))
+            while True:
+                rows = cursor.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            # An unbuffered MySQL cursor has to be read to the end before the connection runs another query
+            if not self.sqlite:
+                while cursor.fetchmany(self.fetch_size):
+                    pass
+            cursor.close()
+
+
+    def pages(self, after=None, max_rows=None):
+        """
+        Pages from below `after` (None starts at the newest detection) until the end or `max_rows` rows.
+        """
+        read = 0
+        while max_rows is None or read < max_rows:
+            limit = self.page_size if max_rows is None else min(self.page_size, max_rows - read)
+            rows = list(self.stream_page(after, limit))
+            if not rows:
+                return
+            read += len(rows)
+            yield rows
+            if len(rows) < limit:
+                return
+            after = (rows[-1][0], rows[-1][1])
+
+
+    def page(self, after=None):
+        """
+        One page and the key to pass as `after` for the next one, None on the last page.
+        """
+        rows = list(self.stream_page(after))
+        return rows, ((rows[-1][0], rows[-1][1]) if len(rows) == self.page_size else None)
+
+
+    def frames(self, detection_ids, chunk_size=500):
+        """
+        {detection id: frame_content} for the given detections, one query per `chunk_size` ids.
+        """
+        detection_ids = list(detection_ids)
+        frames = {}
+        cursor = self.conn.cursor()
+        try:
+            for i in range(0, len(detection_ids), chunk_size):
+                chunk = detection_ids[i:i + chunk_size]
+                ids = ", ".join([self.placeholder] * len(chunk))
+                if self.frame_join:
+                    query = f"SELECT det.id, {frame_column} FROM {detection_table} det {frame_join} WHERE det.id IN ({ids})"
+                else:
+                    query = f"SELECT id, frame_content FROM {detection_table} WHERE id IN ({ids})"
+                cursor.execute(query, chunk)
+                frames.update(cursor.fetchall())
+        finally:
+            cursor.close()
+        return frames
+
+
+class ShardedDetectionFeed:
+    """
+    The feed over every shard: each shard is paged on its own connection and the streams are merged on
+    (timestamp, id), so at most one page per shard is held in memory whatever the depth.
+    Has the same pages/page/frames interface as DetectionFeed.
+    """
+    def __init__(self, shard_conns, page_size=feed_page_size, fetch_size=feed_fetch_size, source=feed_source):
+        self.page_size = page_size
+        self.feeds = {
+            shard_id: DetectionFeed(conn, page_size, fetch_size, source) for shard_id, conn in shard_conns.items()
+        }
+        # detection id -> shard of the rows of the last page handed out, for frames()
+        self.shard_of = {}
+
+
+    @staticmethod
+    def shard_rows(shard_id, feed, after):
+        for page in feed.pages(after):
+            for row in page:
+                yield (row[0], row[1]), shard_id, row
+
+
+    def pages(self, after=None, max_rows=None):
+        streams = [self.shard_rows(shard_id, feed, after) for shard_id, feed in self.feeds.items()]
+        merged = heapq.merge(*streams, key=lambda item: item[0], reverse=True)
+        read = 0
+        page = []
+        for _, shard_id, row in merged:
+            if len(page) == 0:
+                self.shard_of = {}
+            page.append(row)
+            self.shard_of[row[1]] = shard_id
+            read += 1
+            if len(page) == self.page_size or read == max_rows:
+                yield page
+                page = []
+                if read == max_rows:
+                    return
+        if page:
+            yield page
+
+
+    def page(self, after=None):
+        rows = next(self.pages(after, max_rows=self.page_size), [])
+        return rows, ((rows[-1][0], rows[-1][1]) if len(rows) == self.page_size else None)
+
+
+    def frames(self, detection_ids):
+        by_shard = {}
+        for detection_id in detection_ids:
+            by_shard.setdefault(self.shard_of.get(detection_id), []).append(detection_id)
+        frames = {}
+        for shard_id, ids in by_shard.items():
+            feeds = [self.feeds[shard_id]] if shard_id in self.feeds else self.feeds.values()
+            for feed in feeds:
+                frames.update(feed.frames(ids))
+        return frames
+
+
+def rebuild(conn, batch_size=10000):
+    """
+    Backfill the feed from the detection tables in id ranges, one transaction per range, then drop the feed rows
+    whose detection is gone. The feed stays readable while it runs. Returns the number of rows written.
+    """
+    ensure_feed_table(conn)
+    sqlite = is_sqlite(conn)
+    placeholder = "?" if sqlite else "%s"
+    upsert = f"INSERT OR REPLACE INTO {feed_table}" if sqlite else f"REPLACE INTO {feed_table}"
+    columns = "(timestamp, detection_id, device_id, username, display_name, team_name)"
+    statement = f"{upsert} {columns} {rebuild_select.format(placeholder=placeholder)}"
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT MIN(id), MAX(id) FROM {detection_table}")
+    min_id, max_id = cursor.fetchone()
+    written = 0
+    start_time = time.perf_counter()
+    if min_id is not None:
+        for low in range(min_id - 1, max_id, batch_size):
+            cursor.execute(statement, (low, low + batch_size))
+            written += cursor.rowcount
+            conn.commit()
+    cursor.execute(f"DELETE FROM {feed_table} WHERE {orphans_condition}")
+    removed = cursor.rowcount
+    conn.commit()
+    cursor.close()
+    print(f"{feed_table}: {written} rows written, {removed} stale rows removed in {time.perf_counter() - start_time:.2f}s")
+    return written
+
+
+def main():
+    """
+    python detection_feed.py rebuild sqlite <db_file> [batch_size]
+    python detection_feed.py rebuild mysql [batch_size]
+    python detection_feed.py rebuild shards [batch_size]
+    """
+    if (len(sys.argv) < 3 or sys.argv[1] != "rebuild" or sys.argv[2] not in ("sqlite", "mysql", "shards")
+            or (sys.argv[2] == "sqlite" and len(sys.argv) < 4)):
+        print(main.__doc__.strip())
+        return
+    target = sys.argv[2]
+    if target == "sqlite":
+        batch_size = int(sys.argv[4]) if len(sys.argv) > 4 else 10000
+        conn = sqlite3.connect(sys.argv[3])
+        rebuild(conn, batch_size)
+        conn.close()
+        return
+    # The SQLite loaders import this module and must not need mysql-connector
+    import mysql.connector
+    from db_pool import mysql_configs
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+    for db_config in mysql_configs(target):
+        conn = mysql.connector.connect(**db_config)
+        print(f"{db_config['database']}:")
+        rebuild(conn, batch_size)
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
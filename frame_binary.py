@@ -0,0 +1,134 @@
+import base64
+import binascii
+import os
+import sqlite3
+import sys
+import time
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# Tables whose frame_content may still hold base64 text, credocommon_frame only exists with FRAME_DEDUP
+frame_tables = ["credocommon_detection", "credocommon_frame"]
+
+
+def decode_frame(frame_content):
+    """
+    Raw bytes of a frame as it arrives in the export (base64 text), bytes are returned unchanged.
+    """
+    if frame_content is None or isinstance(frame_content, (bytes, bytearray)):
+        return frame_content
+    return base64.b64decode(frame_content)
+
+
+def database_size_mb(db_file):
+    return sum(
+        os.path.getsize(path) for path in (db_file, db_file + "-wal") if os.path.exists(path)
+    ) / (1024 * 1024)
+
+
+def migrate_sqlite_table(conn, table, batch_size=1000):
+    """
+    Decode the base64 text frames of one table in place, `batch_size` rows per transaction.
+    Walks the table on rowid, so an interrupted run simply continues with the rows still stored as text.
+    Returns (converted, failed).
+    """
+    converted = 0
+    failed = 0
+    last_rowid = 0
+    start_time = time.perf_counter()
+    while True:
+        rows = conn.execute(
+            f"SELECT rowid, frame_content FROM {table} "
+            "WHERE rowid > ? AND typeof(frame_content) = 'text' ORDER BY rowid LIMIT ?",
+            (last_rowid, batch_size),
+        ).fetchall()
+        if not rows:
+            break
+        updates = []
+        for rowid, frame_content in rows:
+            try:
+                updates.append((base64.b64decode(frame_content, validate=True), rowid))
+            except (binascii.Error, ValueError):
+                failed += 1
+        conn.executemany(f"UPDATE {table} SET frame_content = ? WHERE rowid = ?", updates)
+        conn.commit()
+        converted += len(updates)
+        last_rowid = rows[-1][0]
+    elapsed = time.perf_counter() - start_time
+    print(f"{table}: {converted} frames decoded in {elapsed:.2f}s, {failed} not valid base64 (left as text)")
+    return converted, failed
+
+
+def migrate_sqlite(db_file, batch_size=1000, vacuum=True):
+    """
+    Convert every base64 frame of an SQLite database to raw bytes, then VACUUM so the file shrinks.
+    """
+    size_before = database_size_mb(db_file)
+    conn = sqlite3.connect(db_file)
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    converted = 0
+    for table in frame_tables:
+        if table in existing:
+            converted += migrate_sqlite_table(conn, table, batch_size)[0]
+    if converted and vacuum:
+        start_time = time.perf_counter()
+        conn.execute("VACUUM")
+        print(f"VACUUM took {time.perf_counter() - start_time:.2f}s")
+    conn.close()
+    print(f"{db_file}: {size_before:.1f} MB -> {database_size_mb(db_file):.1f} MB")
+
+
+def migrate_mysql(db_config, table="credocommon_detection", batch_size=1000):
+    """
+    Convert the base64 frames of a MySQL table to raw bytes with FROM_BASE64, one id range per transaction.
+    Frames that are already binary are not valid base64, FROM_BASE64 returns NULL for them and they are kept,
+    so the migration can run again after an interruption.
+    """
+    # The SQLite loaders import decode_frame from here and must not need mysql-connector
+    import mysql.connector
+    conn = mysql.connector.connect(**db_config)
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT MIN(id), MAX(id) FROM {table}")
+    min_id, max_id = cursor.fetchone()
+    converted = 0
+    start_time = time.perf_counter()
+    if min_id is not None:
+        for low in range(min_id - 1, max_id, batch_size):
+            cursor.execute(
+                f"UPDATE {table} SET frame_content = FROM_BASE64(frame_content) "
+                "WHERE id > %s AND id <= %s AND frame_content IS NOT NULL AND FROM_BASE64(frame_content) IS NOT NULL",
+                (low, low + batch_size),
+            )
+            conn.commit()
+            converted += cursor.rowcount
+    elapsed = time.perf_counter() - start_time
+    print(f"{db_config.get('database')}.{table}: {converted} frames decoded in {elapsed:.2f}s")
+    cursor.close()
+    conn.close()
+    return converted
+
+
+def main():
+    """
+    python frame_binary.py sqlite <db_file> [batch_size]
+    python frame_binary.py mysql [batch_size]
+    python frame_binary.py shards [batch_size]
+    """
+    if len(sys.argv) < 2 or sys.argv[1] not in ("sqlite", "mysql", "shards") or (sys.argv[1] == "sqlite" and len(sys.argv) < 3):
+        print(main.__doc__.strip())
+        return
+    target = sys.argv[1]
+    if target == "sqlite":
+        batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+        migrate_sqlite(sys.argv[2], batch_size)
+        return
+    from db_pool import mysql_configs
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    for db_config in mysql_configs(target):
+        migrate_mysql(db_config, batch_size=batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import base64
+import hashlib
+
+
+frame_table = "credocommon_frame"
+
+# The frame of a detection "det" wherever it is stored: inline in frame_content, or in credocommon_frame once
+# deduplicated. SQLite only, and only where a load with FRAME_DEDUP created credocommon_frame, see has_frame_table.
+frame_join = f"LEFT JOIN {frame_table} fr ON fr.hash = det.frame_hash"
+frame_column = "COALESCE(det.frame_content, fr.frame_content)"
+
+
+def frame_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class FrameDeduplicator:
+    """
+    Remembers which frames were already stored, keyed by the sha256 of the decoded frame,
+    and counts how many frames and bytes the deduplication saved.
+    """
+    def __init__(self, known_hashes=()):
+        self.seen = set(known_hashes)
+        self.frames = 0
+        self.unique = 0
+        self.bytes_total = 0
+        self.bytes_unique = 0
+
+
+    def add(self, data, digest=None):
+        """
+        Returns (hash, True when this is the first time the frame is seen).
+        `digest` is the frame's hash when the caller already computed it.
+        """
+        digest = digest or frame_hash(data)
+        self.frames += 1
+        self.bytes_total += len(data)
+        if digest in self.seen:
+            return digest, False
+        self.seen.add(digest)
+        self.unique += 1
+        self.bytes_unique += len(data)
+        return digest, True
+
+
+    def forget(self, digest):
+        """
+        Treat a frame as not stored again, after its write failed or its last reference was deleted.
+        """
+        self.seen.discard(digest)
+
+
+    def report(self, name="frames"):
+        duplicates = self.frames - self.unique
+        saved_mb = (self.bytes_total - self.bytes_unique) / (1024 * 1024)
+        share = duplicates / self.frames * 100 if self.frames else 0.0
+        print(f"[{name}] dedup: {self.frames} frames, {self.unique} unique, {duplicates} duplicates ({share:.1f}%), "
+              f"{saved_mb:.1f} MB not written")
+
+
+def has_frame_table(conn):
+    """
+    True when an SQLite database has credocommon_frame, i.e. frame_join can be used on it.
+    """
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (frame_table,)).fetchone() is not None
+
+
+def ensure_frame_table(conn, detection_table="credocommon_detection"):
+    """
+    Create the SQLite frame table and the frame_hash column of the detection table when missing.
+    Returns the hashes already stored, so a resumed load does not insert them again.
+    """
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {frame_table} (hash TEXT NOT NULL PRIMARY KEY, frame_content BLOB)")
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({detection_table})")]
+    if "frame_hash" not in columns:
+        conn.execute(f"ALTER TABLE {detection_table} ADD COLUMN frame_hash TEXT")
+    conn.commit()
+    return [row[0] for row in conn.execute(f"SELECT hash FROM {frame_table}")]
+
+
+class FrameDedupWriter:
+    """
+    Wraps a row writer (BatchWriter) so detection frames are stored once in credocommon_frame.
+    Detection rows keep frame_content NULL and reference the frame through frame_hash, read them with frame_column.
+    A frame row that fails to insert is forgotten, so the next detection with that frame writes it again.
+    Everything else is passed to the wrapped writer unchanged.
+    """
+    def __init__(self, writer, dedup, detection_table="credocommon_detection"):
+        self.writer = writer
+        self.dedup = dedup
+        self.detection_table = detection_table
+        self.failed = set()
+        on_error = writer.on_error
+
+        def frame_error(table, data, error):
+            if table == frame_table:
+                self.dedup.forget(data["hash"])
+                self.failed.add(data["hash"])
+            on_error(table, data, error)
+        writer.on_error = frame_error
+
+
+    def add(self, table, data):
+        content = data.get("frame_content") if table == self.detection_table else None
+        if content is not None:
+            raw = content if isinstance(content, (bytes, bytearray)) else base64.b64decode(content)
+            digest, new = self.dedup.add(raw)
+            if new:
+                self.writer.add(frame_table, {"hash": digest, "frame_content": content})
+            data = dict(data, frame_content=None, frame_hash=digest)
+        self.writer.add(table, data)
+
+
+    def orphaned_hashes(self):
+        """
+        Hashes whose frame row failed and was never written later, detections referencing them have no frame.
+        """
+        if not self.failed:
+            return []
+        self.writer.flush()
+        cursor = self.writer.conn.cursor()
+        try:
+            failed = list(self.failed)
+            stored = set()
+            for i in range(0, len(failed), 500):
+                chunk = failed[i:i + 500]
+                cursor.execute(f"SELECT hash FROM {frame_table} WHERE hash IN ({', '.join('?' * len(chunk))})", chunk)
+                stored.update(row[0] for row in cursor.fetchall())
+        finally:
+            cursor.close()
+        return sorted(self.failed - stored)
+
+
+    def report(self, name="frames"):
+        self.dedup.report(name)
+        orphaned = self.orphaned_hashes()
+        if orphaned:
+            print(f"[{name}] ⚠️ {len(orphaned)} frames could not be stored, detections with these frame_hash values "
+                  f"have no frame: {', '.join(orphaned[:10])}{' ...' if len(orphaned) > 10 else ''}")
+
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
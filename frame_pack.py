@@ -0,0 +1,294 @@
+import base64
+import mmap
+import os
+import sqlite3
+import sys
+import time
+from dotenv import load_dotenv
+from frame_dedup import FrameDeduplicator
+
+
+load_dotenv()
+
+frame_pack_directory = os.getenv("FRAME_PACK_DIRECTORY", "frames")
+# Start a new segment file once the current one reaches this size
+segment_size = int(os.getenv("FRAME_PACK_SEGMENT_MB", "256")) * 1024 * 1024
+
+
+class FramePack:
+    """
+    Append-only store for decoded detection frames.
+    Frames are appended to large segment files (segment_00000.pack, ...) and an SQLite index maps
+    detection id -> (segment, offset, length). Rows reference a frame as "pack:<detection id>",
+    so compaction can move frames without touching the database. Reads are zero-copy memoryviews
+    over an mmap of the segment.
+    With `dedup` identical frames are stored once and rows reference them as "sha256:<hash>",
+    resolved through the frame_hashes table to the detection whose frame holds the content.
+    frame_refs records the hash of every detection, so a shared frame lives until its last reference is deleted.
+    Has the same submit/close interface as image_store.ImageWriter.
+    """
+    def __init__(self, directory=frame_pack_directory, segment_size=segment_size, fsync=True, index_batch=1000,
+                 dedup=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.index_batch = index_batch
+        self.index = sqlite3.connect(os.path.join(directory, "index.sqlite3"))
+        self.index.execute(
+            "CREATE TABLE IF NOT EXISTS frames ("
+            "detection_id INTEGER PRIMARY KEY, segment INTEGER NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL)"
+        )
+        self.index.execute("CREATE TABLE IF NOT EXISTS frame_hashes (hash TEXT PRIMARY KEY, detection_id INTEGER NOT NULL)")
+        self.index.execute("CREATE TABLE IF NOT EXISTS frame_refs (detection_id INTEGER PRIMARY KEY, hash TEXT NOT NULL)")
+        self.index.execute("CREATE INDEX IF NOT EXISTS idx_frame_refs_hash ON frame_refs (hash)")
+        # Packs written before frame_refs existed: the detection holding each frame references it
+        self.index.execute("INSERT OR IGNORE INTO frame_refs SELECT detection_id, hash FROM frame_hashes")
+        self.index.commit()
+        self.dedup = None
+        if dedup:
+            self.dedup = FrameDeduplicator(row[0] for row in self.index.execute("SELECT hash FROM frame_hashes"))
+        self.pending_hashes = []
+        self.pending_refs = []
+
+        segments = self.segments()
+        self.segment = segments[-1] if segments else 0
+        self.file = open(self.segment_path(self.segment), "ab")
+        self.offset = self.file.tell()
+        self.pending = []
+        self.maps = {}
+
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.start_time = time.perf_counter()
+
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"segment_{segment:05d}.pack")
+
+
+    def segments(self):
+        return sorted(
+            int(name[len("segment_"):-len(".pack")])
+            for name in os.listdir(self.directory)
+            if name.startswith("segment_") and name.endswith(".pack")
+        )
+
+
+    @staticmethod
+    def reference(detection_id):
+        return f"pack:{detection_id}"
+
+
+    def parse_reference(self, frame_path):
+        frame_path = str(frame_path)
+        if frame_path.startswith("pack:"):
+            return int(frame_path[len("pack:"):])
+        if frame_path.startswith("sha256:"):
+            if self.pending_hashes or self.pending_refs:
+                self.flush()
+            row = self.index.execute(
+                "SELECT detection_id FROM frame_hashes WHERE hash = ?", (frame_path[len("sha256:"):],)
+            ).fetchone()
+            return row[0] if row else None
+        raise ValueError(f"Not a frame pack reference: {frame_path}")
+
+
+    def append(self, detection_id, data):
+        """
+        Append one decoded frame and return the reference to store in frame_path.
+        A frame appended again for the same detection replaces the old one, which becomes dead space.
+        """
+        if self.offset and self.offset + len(data) > self.segment_size:
+            self.roll()
+        self.file.write(data)
+        self.pending.append((detection_id, self.segment, self.offset, len(data)))
+        self.offset += len(data)
+        self.frames_written += 1
+        self.bytes_written += len(data)
+        if len(self.pending) >= self.index_batch:
+            self.flush()
+        return self.reference(detection_id)
+
+
+    def submit(self, detection_id, frame_content):
+        data = base64.b64decode(frame_content)
+        if self.dedup is None:
+            return self.append(detection_id, data)
+        digest, new = self.dedup.add(data)
+        if new:
+            try:
+                self.append(detection_id, data)
+            except OSError:
+                self.dedup.forget(digest)
+                raise
+            self.pending_hashes.append((digest, detection_id))
+        self.pending_refs.append((detection_id, digest))
+        if len(self.pending_refs) >= self.index_batch:
+            self.flush()
+        return f"sha256:{digest}"
+
+
+    def roll(self):
+        self.flush()
+        self.file.close()
+        self.segment += 1
+        self.file = open(self.segment_path(self.segment), "ab")
+        self.offset = 0
+
+
+    def flush(self):
+        """
+        Make appended frames durable, then publish them in the index.
+        """
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        if self.pending or self.pending_hashes or self.pending_refs:
+            self.index.executemany("INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?)", self.pending)
+            self.index.executemany("INSERT OR REPLACE INTO frame_hashes VALUES (?, ?)", self.pending_hashes)
+            self.index.executemany("INSERT OR REPLACE INTO frame_refs VALUES (?, ?)", self.pending_refs)
+            self.index.commit()
+            self.pending = []
+            self.pending_hashes = []
+            self.pending_refs = []
+
+
+    def locate(self, detection_id):
+        return self.index.execute(
+            "SELECT segment, offset, length FROM frames WHERE detection_id = ?", (detection_id,)
+        ).fetchone()
+
+
+    def segment_map(self, segment, needed):
+        segment_map = self.maps.get(segment)
+        # The active segment grows, map it again when the frame lies past the old mapping
+        if segment_map is None or len(segment_map) < needed:
+            if segment == self.segment:
+                self.file.flush()
+            with open(self.segment_path(segment), "rb") as file:
+                segment_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = segment_map
+        return segment_map
+
+
+    def read(self, frame):
+        """
+        Frame bytes for a detection id or "pack:<id>" reference as a memoryview into the mmap, None if unknown.
+        """
+        detection_id = frame if isinstance(frame, int) else self.parse_reference(frame)
+        if self.pending:
+            self.flush()
+        if detection_id is None:
+            return None
+        location = self.locate(detection_id)
+        if location is None:
+            return None
+        segment, offset, length = location
+        return memoryview(self.segment_map(segment, offset + length))[offset:offset + length]
+
+
+    def delete(self, detection_id):
+        """
+        Drop a detection's frame, its bytes become dead space until compaction.
+        A deduplicated frame still referenced by other detections is handed over to one of them and kept,
+        it is only dropped with its last reference.
+        """
+        self.flush()
+        row = self.index.execute("SELECT hash FROM frame_refs WHERE detection_id = ?", (detection_id,)).fetchone()
+        self.index.execute("DELETE FROM frame_refs WHERE detection_id = ?", (detection_id,))
+        owner = None
+        if row is not None:
+            owner = self.index.execute("SELECT detection_id FROM frame_hashes WHERE hash = ?", (row[0],)).fetchone()
+        if owner is None or owner[0] == detection_id:
+            heir = None
+            if owner is not None:
+                heir = self.index.execute("SELECT detection_id FROM frame_refs WHERE hash = ? LIMIT 1", (row[0],)).fetchone()
+            if heir is None:
+                self.index.execute("DELETE FROM frames WHERE detection_id = ?", (detection_id,))
+                if owner is not None:
+                    self.index.execute("DELETE FROM frame_hashes WHERE hash = ?", (row[0],))
+                    if self.dedup is not None:
+                        self.dedup.forget(row[0])
+            else:
+                self.index.execute("UPDATE OR REPLACE frames SET detection_id = ? WHERE detection_id = ?", (heir[0], detection_id))
+                self.index.execute("UPDATE frame_hashes SET detection_id = ? WHERE hash = ?", (heir[0], row[0]))
+        self.index.commit()
+
+
+    def drop_segment(self, segment):
+        segment_map = self.maps.pop(segment, None)
+        if segment_map is not None:
+            try:
+                segment_map.close()
+            except BufferError:
+                # A reader still holds a view, the map goes away with it
+                pass
+        os.remove(self.segment_path(segment))
+
+
+    def compact(self, min_live_ratio=0.5):
+        """
+        Rewrite closed segments where less than `min_live_ratio` of the bytes are still referenced,
+        moving their live frames to the end of the pack. Returns the number of bytes reclaimed.
+        """
+        self.flush()
+        reclaimed = 0
+        for segment in self.segments():
+            if segment == self.segment:
+                continue
+            size = os.path.getsize(self.segment_path(segment))
+            live = self.index.execute("SELECT COALESCE(SUM(length), 0) FROM frames WHERE segment = ?", (segment,)).fetchone()[0]
+            if size and live / size >= min_live_ratio:
+                continue
+
+            start_time = time.perf_counter()
+            frames = self.index.execute(
+                "SELECT detection_id, offset, length FROM frames WHERE segment = ? ORDER BY offset", (segment,)
+            ).fetchall()
+            with open(self.segment_path(segment), "rb") as file:
+                for detection_id, offset, length in frames:
+                    file.seek(offset)
+                    self.append(detection_id, file.read(length))
+            self.flush()
+            self.drop_segment(segment)
+            reclaimed += size - live
+            print(f"compacted segment {segment}: {len(frames)} live frames moved, {(size - live) / (1024 * 1024):.1f} MB "
+                  f"reclaimed in {time.perf_counter() - start_time:.2f}s")
+        return reclaimed
+
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        self.index.close()
+        for segment_map in self.maps.values():
+            try:
+                segment_map.close()
+            except BufferError:
+                pass
+        elapsed = time.perf_counter() - self.start_time
+        rate = self.frames_written / elapsed if elapsed > 0 else 0.0
+        mb = self.bytes_written / (1024 * 1024)
+        print(f"frame pack: {self.frames_written} frames appended ({mb:.1f} MB) in {elapsed:.2f}s ({rate:.0f} frames/s)")
+        if self.dedup is not None:
+            self.dedup.report("frame pack")
+
+
+def main():
+    """
+    python frame_pack.py compact [directory] [min_live_ratio]
+    """
+    if len(sys.argv) < 2 or sys.argv[1] != "compact":
+        print(main.__doc__.strip())
+        return
+    directory = sys.argv[2] if len(sys.argv) > 2 else frame_pack_directory
+    min_live_ratio = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+    pack = FramePack(directory)
+    reclaimed = pack.compact(min_live_ratio)
+    pack.close()
+    print(f"{directory}: {reclaimed / (1024 * 1024):.1f} MB reclaimed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+import base64
+import hashlib
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from frame_dedup import FrameDeduplicator, frame_hash
+
+
+# Detections whose frames live in an image store, frame_path holds the file path or the frame pack reference
+detection_v2_table = "credocommon_detection_v2"
+mysql_detection_v2_ddl = f"""
+    CREATE TABLE IF NOT EXISTS `{detection_v2_table}` (
+        `id` int NOT NULL AUTO_INCREMENT,
+        `frame_path` varchar(255) DEFAULT NULL,
+        `timestamp` TIMESTAMP NOT NULL,
+        `time_received` TIMESTAMP NOT NULL,
+        `visible` tinyint(1) NOT NULL,
+        `device_id` int NOT NULL,
+        `detection_info_id` int NOT NULL,
+        PRIMARY KEY (`id`),
+        UNIQUE KEY `detection_v2_info_id_UNIQUE` (`detection_info_id`),
+        KEY `device_id` (`device_id`),
+        KEY `idx_detection_v2_timestamp` (`timestamp`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci
+"""
+
+
+def ensure_detection_v2_table(conn):
+    """
+    Create credocommon_detection_v2 on a MySQL connection when missing.
+    """
+    cursor = conn.cursor()
+    cursor.execute(mysql_detection_v2_ddl)
+    cursor.close()
+    conn.commit()
+
+
+def image_path_for(output_dir, detection_id):
+    """
+    Two-level hashed fan-out, e.g. images/3f/a2/detection_123.jpg, so no directory holds more
+    than a few thousand files even for millions of detections.
+    """
+    digest = hashlib.md5(str(detection_id).encode()).hexdigest()
+    return os.path.join(output_dir, digest[:2], digest[2:4], f"detection_{detection_id}.jpg")
+
+
+def image_path_for_hash(output_dir, frame_hash):
+    """
+    Content-addressed path of a deduplicated frame, e.g. images/3f/a2/3fa2...e1.jpg.
+    """
+    return os.path.join(output_dir, frame_hash[:2], frame_hash[2:4], f"{frame_hash}.jpg")
+
+
+class ImageWriter:
+    """
+    Decodes and writes detection frames on a pool of threads.
+    submit() returns the file path at once, so the row referencing the image can be inserted
+    without waiting for the write. At most `queue_size` frames wait to be written.
+    Every worker fsyncs its files (and their directories) in batches of `fsync_batch`, 0 never fsyncs.
+    With `dedup` frames are named by their sha256 and identical frames are written once. The name depends
+    on the decoded content, so submit() returns a Future of the path and the workers decode and hash the frame,
+    PendingRows holds the rows until it resolves. A hash counts as stored only once its file is written.
+    """
+    def __init__(self, output_dir="images", workers=4, queue_size=256, fsync_batch=64, dedup=False):
+        self.output_dir = output_dir
+        self.dedup = FrameDeduplicator() if dedup else None
+        self.fsync_batch = fsync_batch
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.created_dirs = set()
+        # Hashes a worker is writing right now, duplicates wait for the write to finish
+        self.writing = {}
+        self.images_written = 0
+        self.bytes_written = 0
+        self.failed = []
+        self.sync_error = None
+        self.start_time = time.perf_counter()
+        self.threads = [
+            threading.Thread(target=self.run, name=f"image-writer-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for thread in self.threads:
+            thread.start()
+
+
+    def submit(self, detection_id, frame_content):
+        if self.dedup is None:
+            path = image_path_for(self.output_dir, detection_id)
+            self.queue.put((detection_id, path, frame_content, None))
+            return path
+        future = Future()
+        self.queue.put((detection_id, None, frame_content, future))
+        return future
+
+
+    def ensure_dir(self, directory):
+        if directory in self.created_dirs:
+            return
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            self.created_dirs.add(directory)
+
+
+    def sync(self, files):
+        directories = set()
+        for file in files:
+            file.flush()
+            os.fsync(file.fileno())
+            file.close()
+            directories.add(os.path.dirname(file.name))
+        # Directory entries of new files need their own fsync, not possible on Windows
+        if os.name != "nt":
+            for directory in directories:
+                fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        files.clear()
+
+
+    def write(self, path, data, unsynced):
+        self.ensure_dir(os.path.dirname(path))
+        file = open(path, "wb")
+        file.write(data)
+        if self.fsync_batch:
+            unsynced.append(file)
+            if len(unsynced) >= self.fsync_batch:
+                self.sync(unsynced)
+        else:
+            file.close()
+        with self.lock:
+            self.images_written += 1
+            self.bytes_written += len(data)
+
+
+    def write_unique(self, data, unsynced):
+        """
+        Write a deduplicated frame unless it is stored already and return its path.
+        When another worker is writing the same frame this waits for it, and writes the frame itself if that failed.
+        """
+        digest = frame_hash(data)
+        path = image_path_for_hash(self.output_dir, digest)
+        while True:
+            with self.lock:
+                if digest in self.dedup.seen:
+                    self.dedup.add(data, digest)
+                    return path
+                writing = self.writing.get(digest)
+                if writing is None:
+                    writing = self.writing[digest] = threading.Event()
+                    break
+            writing.wait()
+        try:
+            self.write(path, data, unsynced)
+            with self.lock:
+                self.dedup.add(data, digest)
+        finally:
+            with self.lock:
+                del self.writing[digest]
+            writing.set()
+        return path
+
+
+    def run(self):
+        unsynced = []
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if isinstance(item, threading.Barrier):
+                try:
+                    self.sync(unsynced)
+                except OSError as e:
+                    self.sync_error = e
+                item.wait()
+                continue
+            detection_id, path, frame_content, future = item
+            try:
+                data = frame_content if isinstance(frame_content, bytes) else base64.b64decode(frame_content)
+                if future is None:
+                    self.write(path, data, unsynced)
+                else:
+                    future.set_result(self.write_unique(data, unsynced))
+            except Exception as e:
+                with self.lock:
+                    self.failed.append(detection_id)
+                print(f"Error writing image for detection {detection_id}: {e}")
+                if future is not None:
+                    future.set_exception(e)
+        try:
+            self.sync(unsynced)
+        except OSError as e:
+            print(f"Error syncing images: {e}")
+
+
+    def flush(self):
+        """
+        Wait until every frame queued so far is written and synced, e.g. before a checkpoint.
+        Every worker syncs its files and waits at the barrier, so each takes exactly one of them.
+        """
+        barrier = threading.Barrier(len(self.threads) + 1)
+        for _ in self.threads:
+            self.queue.put(barrier)
+        barrier.wait()
+        if self.sync_error is not None:
+            raise self.sync_error
+
+
+    def close(self):
+        """
+        Wait for every queued frame to be written and synced, then report images/sec.
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        elapsed = time.perf_counter() - self.start_time
+        rate = self.images_written / elapsed if elapsed > 0 else 0.0
+        mb = self.bytes_written / (1024 * 1024)
+        print(f"images: {self.images_written} written ({mb:.1f} MB) in {elapsed:.2f}s ({rate:.0f} images/s), "
+              f"{len(self.failed)} failed")
+        if self.dedup is not None:
+            self.dedup.report("images")
+
+
+class PendingRows:
+    """
+    Rows waiting for the path of their frame, passed to `insert(path)` in submit order once it is known.
+    Plain paths go through at once, Futures from a deduplicating ImageWriter when they resolve.
+    At most `limit` rows wait, beyond that the oldest one is waited for. Rows whose frame failed are dropped.
+    """
+    def __init__(self, limit=256):
+        self.limit = limit
+        self.rows = deque()
+        self.dropped = 0
+
+
+    def add(self, path, insert):
+        self.rows.append((path, insert))
+        self.drain(wait=len(self.rows) > self.limit)
+
+
+    def drain(self, wait=False):
+        while self.rows:
+            path, insert = self.rows[0]
+            if isinstance(path, Future):
+                if not (wait or path.done()):
+                    return
+                try:
+                    path = path.result()
+                except Exception:
+                    # The image writer reported the error
+                    self.rows.popleft()
+                    self.dropped += 1
+                    wait = False
+                    continue
+            self.rows.popleft()
+            insert(path)
+            wait = False
+
+
+    def flush(self):
+        """
+        Insert every waiting row, e.g. before a checkpoint.
+        """
+        while self.rows:
+            self.drain(wait=True)
@@ -0,0 +1,434 @@
+import csv
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from dotenv import load_dotenv
+from performance_test import benchmarks, executed, timed_fetch, summarize
+from query_plans import summarize_sqlite_plan
+
+
+load_dotenv()
+
+# Timed runs per query and candidate, after one warm-up run (caches stay warm so only the plan changes)
+advisor_iterations = int(os.getenv("ADVISOR_ITERATIONS", "5"))
+# A candidate pays for itself when a query gets at least this much faster and none gets this much slower
+advisor_min_gain = float(os.getenv("ADVISOR_MIN_GAIN", "0.1"))
+# Rows re-inserted (and rolled back) to measure what an index adds to every insert
+advisor_ingest_rows = int(os.getenv("ADVISOR_INGEST_ROWS", "5000"))
+# Covering indexes never copy these, frames would double the table
+max_covering_columns = 5
+
+_keywords = {"ON", "WHERE", "LEFT", "RIGHT", "INNER", "OUTER", "CROSS", "JOIN", "GROUP", "ORDER", "LIMIT", "AS", "USING"}
+_table_ref = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", re.I)
+_join = re.compile(r"\b(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)")
+_filter = re.compile(r"(?:\b(\w+)\.)?\b(\w+)\s*(=|<>|!=|<=|>=|<|>|\bIN\b|\bLIKE\b|\bBETWEEN\b)", re.I)
+_column = re.compile(r"(?:\b(\w+)\.)?\b([A-Za-z_]\w*)\b")
+
+
+def clause(query, start, ends):
+    match = re.search(rf"\b{start}\b(.*?)(?:\b(?:{'|'.join(ends)})\b|;|$)", query, re.I | re.S)
+    return match.group(1) if match else ""
+
+
+class Schema:
+    """
+    Columns, rowid primary keys and indexes of the tables of an SQLite database.
+    """
+    def __init__(self, conn):
+        self.columns = {}
+        self.primary_keys = {}
+        self.blobs = {}
+        for (table,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"):
+            info = conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+            self.columns[table] = [row[1] for row in info]
+            self.blobs[table] = {row[1] for row in info if "BLOB" in (row[2] or "").upper()}
+            primary = [row for row in info if row[5]]
+            if len(primary) == 1 and (primary[0][2] or "").upper() == "INTEGER":
+                self.primary_keys[table] = primary[0][1]
+        self.indexes = existing_indexes(conn)
+
+
+    def resolve(self, aliases, default_tables, alias, column):
+        """
+        Table of a column reference, None when it is not a column (output aliases, functions, keywords).
+        """
+        if alias:
+            table = aliases.get(alias)
+            return table if table and column in self.columns.get(table, ()) else None
+        for table in default_tables:
+            if column in self.columns.get(table, ()):
+                return table
+        return None
+
+
+def existing_indexes(conn):
+    """
+    {index name: (table, columns, unique, origin)} where origin is "c" (CREATE INDEX), "u" (UNIQUE) or "pk".
+    """
+    indexes = {}
+    for (table,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"):
+        for _, name, unique, origin, _ in conn.execute(f'PRAGMA index_list("{table}")'):
+            columns = tuple(row[2] for row in conn.execute(f'PRAGMA index_info("{name}")'))
+            indexes[name] = (table, columns, bool(unique), origin)
+    return indexes
+
+
+def analyze_query(query, schema):
+    """
+    Columns a query uses per table: equality and range filters, join keys, ORDER BY / GROUP BY and every referenced column.
+    """
+    aliases = {}
+    tables = []
+    for table, alias in _table_ref.findall(query):
+        if table not in schema.columns:
+            continue
+        tables.append(table)
+        aliases[table] = table
+        if alias and alias.upper() not in _keywords:
+            aliases[alias] = table
+    usage = {table: {"equality": [], "range": [], "join": [], "order": [], "group": [], "needed": []} for table in tables}
+
+    def add(kind, alias, column):
+        table = schema.resolve(aliases, tables, alias, column)
+        if table and column not in usage[table][kind]:
+            usage[table][kind].append(column)
+        return table
+
+    for left_alias, left, right_alias, right in _join.findall(query):
+        add("join", left_alias, left)
+        add("join", right_alias, right)
+    where = _join.sub("", clause(query, "WHERE", ["GROUP", "ORDER", "LIMIT"]))
+    for alias, column, operator in _filter.findall(where):
+        add("equality" if operator == "=" else "range", alias, column)
+    for kind, text in (("order", clause(query, r"ORDER\s+BY", ["LIMIT"])),
+                       ("group", clause(query, r"GROUP\s+BY", ["HAVING", "ORDER", "LIMIT"]))):
+        for term in text.split(","):
+            match = _column.search(term)
+            if match:
+                add(kind, *match.groups())
+    for alias, column in _column.findall(query):
+        add("needed", alias, column)
+    return usage
+
+
+def index_name(table, columns, covering=False):
+    short = table[len("credocommon_"):] if table.startswith("credocommon_") else table
+    return f"idx_{short}_{'_'.join(columns)}{'_cover' if covering else ''}"
+
+
+def propose_candidates(usage, schema):
+    """
+    Single-column, composite (filter or join key + sort columns) and covering candidates for one query,
+    minus the ones an existing index already starts with.
+    """
+    candidates = []
+    for table, used in usage.items():
+        primary_key = schema.primary_keys.get(table)
+        sort = used["order"] or used["group"]
+        keys = [c for c in used["equality"] + used["join"] if c != primary_key]
+        shapes = [(c,) for c in keys + used["range"] + sort if c != primary_key]
+        shapes += [(key, *[c for c in sort if c != key]) for key in keys if sort and sort != [key]]
+        if len(used["equality"]) > 1:
+            shapes.append(tuple(used["equality"]))
+        if used["equality"] and used["range"]:
+            shapes.append((*used["equality"], used["range"][0]))
+        shapes = [(columns, False) for columns in shapes]
+        for columns, _ in list(shapes):
+            extra = tuple(c for c in used["needed"]
+                          if c not in columns and c != primary_key and c not in schema.blobs.get(table, ()))
+            if extra and len(columns) + len(extra) <= max_covering_columns:
+                shapes.append((columns + extra, True))
+        for columns, covering in shapes:
+            # Every SQLite index already ends with the rowid
+            columns = tuple(c for c in columns if c != primary_key)
+            if not columns or any(index_table == table and index_columns[:len(columns)] == columns
+                   for index_table, index_columns, _, _ in schema.indexes.values()):
+                continue
+            if (table, columns) not in [c[:2] for c in candidates]:
+                candidates.append((table, columns, index_name(table, columns, covering)))
+    return candidates
+
+
+def redundant_indexes(schema):
+    """
+    Created indexes that another index already provides: on the rowid primary key, a duplicate of another index,
+    or a non-unique prefix of a longer one. {index name: reason}
+    """
+    redundant = {}
+    for name, (table, columns, unique, origin) in schema.indexes.items():
+        if origin != "c":
+            continue
+        if columns == (schema.primary_keys.get(table),):
+            redundant[name] = "indexes the rowid primary key"
+            continue
+        for other, (other_table, other_columns, other_unique, other_origin) in schema.indexes.items():
+            if other == name or other_table != table or other in redundant:
+                continue
+            if other_columns == columns and (other_unique or not unique):
+                redundant[name] = f"duplicates {other}"
+                break
+            if not unique and other_columns[:len(columns)] == columns and len(other_columns) > len(columns):
+                redundant[name] = f"prefix of {other}"
+                break
+    return redundant
+
+
+def used_pages(conn):
+    return conn.execute("PRAGMA page_count").fetchone()[0] - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def time_workload(conn, workload, iterations=None):
+    """
+    p50 seconds and plan summary of every query of the workload on an open connection.
+    A query that fails is reported and left out of the results, the rest of the workload still runs.
+    """
+    iterations = iterations or advisor_iterations
+    results = {}
+    for benchmark in workload:
+        cursor = conn.cursor()
+        try:
+            timed_fetch(lambda: executed(cursor, benchmark.query_for("sqlite"), benchmark.params), "fetchall")
+            samples = [timed_fetch(lambda: executed(cursor, benchmark.query_for("sqlite"), benchmark.params), "fetchall")
+                       for _ in range(iterations)]
+            plan = summarize_sqlite_plan(plan_of(conn, benchmark))
+        except sqlite3.Error as e:
+            print(f"❌ {benchmark.name} failed: {e}")
+            continue
+        finally:
+            cursor.close()
+        results[benchmark.name] = {"p50": summarize(samples)["p50"], "plan": plan}
+    return results
+
+
+def plan_of(conn, benchmark):
+    query = benchmark.query_for("sqlite")
+    return [(row[0], row[1], row[3]) for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", benchmark.params)]
+
+
+def insert_cost(conn, table, schema, rows=None):
+    """
+    Seconds per row to insert `rows` copies of existing rows into `table`, rolled back afterwards.
+    None when no row could be inserted (every copy hits a unique constraint).
+    """
+    rows = rows or advisor_ingest_rows
+    columns = ", ".join(f'"{c}"' for c in schema.columns[table] if c != schema.primary_keys.get(table))
+    best = None
+    for _ in range(3):
+        conn.execute("BEGIN")
+        start_time = time.perf_counter()
+        cursor = conn.execute(
+            f'INSERT OR IGNORE INTO "{table}" ({columns}) SELECT {columns} FROM "{table}" ORDER BY rowid LIMIT ?', (rows,)
+        )
+        elapsed = time.perf_counter() - start_time
+        inserted = cursor.rowcount
+        conn.execute("ROLLBACK")
+        if inserted <= 0:
+            return None
+        per_row = elapsed / inserted
+        best = per_row if best is None else min(best, per_row)
+    return best
+
+
+def compare(before, after, min_gain=None):
+    """
+    Per-query change of an index: seconds saved per workload run, best relative gain and worst regression.
+    Only queries whose plan changed count, the others differ by timing noise alone.
+    """
+    min_gain = advisor_min_gain if min_gain is None else min_gain
+    changes = {}
+    for name, result in after.items():
+        if name not in before:
+            continue
+        old = before[name]["p50"]
+        changes[name] = {
+            "before": old,
+            "after": result["p50"],
+            "gain": (old - result["p50"]) / old if old else 0.0,
+            "plan_changed": result["plan"]["signature"] != before[name]["plan"]["signature"],
+        }
+    changed = [change for change in changes.values() if change["plan_changed"]]
+    gains = [change["gain"] for change in changed]
+    return {
+        "queries": changes,
+        "saved": sum(change["before"] - change["after"] for change in changed),
+        "best_gain": max(gains, default=0.0),
+        "worst_gain": min(gains, default=0.0),
+        "improves": max(gains, default=0.0) >= min_gain,
+        "regresses": min(gains, default=0.0) <= -min_gain,
+    }
+
+
+def scratch_copy(db_file, directory):
+    """
+    Copy the database with the backup API, so a database in WAL mode is copied consistently.
+    """
+    path = os.path.join(directory, "advisor.sqlite3")
+    source = sqlite3.connect(db_file)
+    target = sqlite3.connect(path)
+    source.backup(target)
+    source.close()
+    target.close()
+    return path
+
+
+def advise(db_file, names=None, output_dir="performance_tests"):
+    """
+    Time the registered benchmarks on a scratch copy of `db_file`, then build every candidate index on its own,
+    time the workload again and measure its size and insert cost, and do the same for dropping each redundant index.
+    Benchmarks with their own runner and benchmarks whose required tables the database lacks are left out.
+    """
+    workload = [benchmark for name, benchmark in benchmarks.items()
+                if (not names or name in names) and benchmark.runner is None
+                and ("sqlite_opt" in benchmark.backends or "sqlite" in benchmark.backends)]
+    directory = tempfile.mkdtemp(prefix="index_advisor_")
+    try:
+        scratch = scratch_copy(db_file, directory)
+        for benchmark in list(workload):
+            missing = benchmark.missing_table(scratch)
+            if missing:
+                print(f"⏭️ {benchmark.name} skipped: no {missing} table")
+                workload.remove(benchmark)
+        conn = sqlite3.connect(scratch, isolation_level=None)
+        conn.execute("ANALYZE")
+        schema = Schema(conn)
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+
+        candidates = []
+        for benchmark in workload:
+            for table, columns, name in propose_candidates(analyze_query(benchmark.query_for("sqlite"), schema), schema):
+                if (table, columns) not in [c[:2] for c in candidates]:
+                    candidates.append((table, columns, name, benchmark.name))
+        redundant = redundant_indexes(schema)
+        tables = {c[0] for c in candidates} | {schema.indexes[name][0] for name in redundant}
+
+        print(f"Workload: {', '.join(b.name for b in workload)}")
+        print(f"{len(candidates)} candidate indexes, {len(redundant)} redundant indexes")
+        baseline = time_workload(conn, workload)
+        # Queries that fail on the unchanged database are not timed again for every candidate
+        workload = [benchmark for benchmark in workload if benchmark.name in baseline]
+        baseline_insert = {table: insert_cost(conn, table, schema) for table in tables}
+        for name, result in baseline.items():
+            print(f"   {name:<26} p50 {result['p50']:.6f}s")
+
+        results = []
+        for table, columns, name, source in candidates:
+            pages = used_pages(conn)
+            start_time = time.perf_counter()
+            conn.execute(f'CREATE INDEX "{name}" ON "{table}" ({", ".join(columns)})')
+            conn.execute(f'ANALYZE "{name}"')
+            build = time.perf_counter() - start_time
+            size = (used_pages(conn) - pages) * page_size
+            result = compare(baseline, time_workload(conn, workload))
+            insert = insert_cost(conn, table, schema)
+            conn.execute(f'DROP INDEX "{name}"')
+            makes_redundant = [other for other, (other_table, other_columns, unique, origin) in schema.indexes.items()
+                               if other_table == table and origin == "c" and not unique
+                               and columns[:len(other_columns)] == other_columns]
+            results.append(report_row("add", name, table, columns, result, size, build,
+                                      insert, baseline_insert.get(table), source=source,
+                                      note=f"makes redundant: {', '.join(makes_redundant)}" if makes_redundant else ""))
+
+        for name, reason in redundant.items():
+            table, columns, unique, _ = schema.indexes[name]
+            sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)).fetchone()[0]
+            pages = used_pages(conn)
+            conn.execute(f'DROP INDEX "{name}"')
+            size = (pages - used_pages(conn)) * page_size
+            result = compare(baseline, time_workload(conn, workload))
+            insert = insert_cost(conn, table, schema)
+            conn.execute(sql)
+            results.append(report_row("drop", name, table, columns, result, size, 0.0,
+                                      insert, baseline_insert.get(table), note=reason))
+        conn.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    write_report(results, baseline, output_dir)
+    print_report(results)
+    return results
+
+
+def report_row(action, name, table, columns, result, size, build, insert, baseline_insert, source="", note=""):
+    insert_delta = None if insert is None or baseline_insert is None else insert - baseline_insert
+    if action == "add":
+        pays = result["improves"] and not result["regresses"]
+        verdict = "recommend" if pays else ("regresses" if result["regresses"] else "no gain")
+        # Inserted rows per workload run after which the slower inserts eat up the faster reads
+        break_even = result["saved"] / insert_delta if pays and insert_delta and insert_delta > 0 else None
+    else:
+        verdict = "keep" if result["regresses"] else "drop"
+        break_even = None
+    return {
+        "action": action,
+        "index": name,
+        "table": table,
+        "columns": ", ".join(columns),
+        "verdict": verdict,
+        "source": source,
+        "saved": result["saved"],
+        "best_gain": result["best_gain"],
+        "worst_gain": result["worst_gain"],
+        "size_mb": size / (1024 * 1024),
+        "build": build,
+        "insert_us": None if insert_delta is None else insert_delta * 1e6,
+        "break_even_inserts": break_even,
+        "note": note,
+        "queries": result["queries"],
+    }
+
+
+def ddl(row):
+    if row["action"] == "add":
+        return f"CREATE INDEX {row['index']} ON {row['table']} ({row['columns']});"
+    return f"DROP INDEX {row['index']};  -- MySQL: DROP INDEX {row['index']} ON {row['table']};"
+
+
+def write_report(results, baseline, output_dir="performance_tests"):
+    os.makedirs(output_dir, exist_ok=True)
+    columns = ["action", "index", "table", "columns", "verdict", "source", "saved", "best_gain", "worst_gain",
+               "size_mb", "build", "insert_us", "break_even_inserts", "note"]
+    with open(os.path.join(output_dir, "index_advisor.csv"), "w", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(results)
+    with open(os.path.join(output_dir, "index_advisor.json"), "w", encoding="utf-8") as file:
+        json.dump({"baseline": baseline, "results": results}, file, indent=1)
+    print(f"✅ Report saved to {os.path.join(output_dir, 'index_advisor.csv')} and index_advisor.json")
+
+
+def print_report(results):
+    for row in sorted(results, key=lambda r: (r["action"], r["verdict"] != "recommend", -r["saved"])):
+        insert = "n/a" if row["insert_us"] is None else f"{row['insert_us']:+.2f} µs/row"
+        print(f"{row['verdict']:<10} {row['index']:<48} saved {row['saved'] * 1000:+8.2f} ms/run  "
+              f"best {row['best_gain'] * 100:+6.1f}%  worst {row['worst_gain'] * 100:+6.1f}%  "
+              f"{row['size_mb']:.2f} MB  insert {insert}")
+        if row["break_even_inserts"]:
+            print(f"{'':<11}pays for itself while fewer than {row['break_even_inserts']:.0f} rows are inserted per workload run")
+        if row["note"]:
+            print(f"{'':<11}{row['note']}")
+    statements = [ddl(row) for row in results if row["verdict"] in ("recommend", "drop")]
+    if statements:
+        print("Suggested changes:")
+        for statement in statements:
+            print(f"   {statement}")
+
+
+def main():
+    """
+    python index_advisor.py [db_file] [benchmark,benchmark...]
+    """
+    if len(sys.argv) > 1 and sys.argv[1] in ("-h", "--help"):
+        print(main.__doc__.strip())
+        return
+    db_file = sys.argv[1] if len(sys.argv) > 1 else os.getenv("DB_FILE_OPT")
+    names = [name for name in sys.argv[2].split(",") if name] if len(sys.argv) > 2 else None
+    advise(db_file, names, os.getenv("BENCHMARK_DIRECTORY", "performance_tests"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,426 @@
+import base64
+import csv
+import functools
+import importlib
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# Export the loaders are benchmarked on, generated with INGEST_DETECTIONS detections when missing
+ingest_export_directory = os.getenv("INGEST_EXPORT_DIRECTORY", "benchmark_export")
+ingest_detections = int(os.getenv("INGEST_DETECTIONS", "100000"))
+benchmark_directory = os.getenv("BENCHMARK_DIRECTORY", "performance_tests")
+# A loader run whose tables report more failed rows than this is aborted and left out of the results
+ingest_max_errors = int(os.getenv("INGEST_MAX_ERRORS", "0"))
+
+# Loader module, the variable naming its SQLite database and the empty database it starts from.
+# json_to_sqlite inserts the export's fields as they are and needs the original CREDO schema, which is not in dbs/
+loaders = {
+    "sqlite": ("json_to_sqlite", "DB_FILE_OG", os.getenv("INGEST_SQLITE_TEMPLATE", "")),
+    "sqlite_opt": ("json_to_sqlite_opt", "DB_FILE_OPT", "dbs/db_new.sqlite3"),
+    "mysql": ("json_to_mysql", None, None),
+    "shards": ("json_to_shards", None, None),
+}
+
+stages = ["read", "decode", "parse_wait", "transform", "execute", "commit", "images", "index"]
+
+
+class IngestAborted(BaseException):
+    """
+    Stops a loader run, a BaseException so the loaders' per-entry `except Exception` does not swallow it.
+    """
+
+
+def generate_export(directory, detections=100000, files=4, teams=20, users=2000, devices=4000, frame_bytes=2048, seed=42):
+    """
+    Write a synthetic export with the layout and fields of the real one.
+    The same arguments always give the same files, a third of the frames are repeats of a few blank frames.
+    """
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(directory, "detections"), exist_ok=True)
+    os.makedirs(os.path.join(directory, "pings"), exist_ok=True)
+
+    team_rows = [{"id": i, "name": f"team{i}"} for i in range(1, teams + 1)]
+    user_rows = [
+        {"id": i, "username": f"user{i}", "display_name": f"User {i}", "team_id": rng.randint(1, teams)}
+        for i in range(1, users + 1)
+    ]
+    device_rows = [
+        {"id": i, "device_type": rng.choice(["phone", "tablet"]), "device_model": f"model{rng.randint(1, 50)}",
+         "system_version": f"{rng.randint(8, 14)}.0", "user_id": rng.randint(1, users)}
+        for i in range(1, devices + 1)
+    ]
+    with open(os.path.join(directory, "team_mapping.json"), "w", encoding="utf-8") as file:
+        json.dump({"teams": team_rows}, file)
+    with open(os.path.join(directory, "user_mapping.json"), "w", encoding="utf-8") as file:
+        json.dump({"users": user_rows}, file)
+    with open(os.path.join(directory, "export.json"), "w", encoding="utf-8") as file:
+        json.dump({"devices": device_rows}, file)
+
+    blanks = [base64.b64encode(b"\xff\xd8" + bytes([i]) * frame_bytes).decode() for i in range(4)]
+    per_file = -(-detections // files)
+    timestamp = 1600000000000
+    for f in range(files):
+        ids = range(f * per_file + 1, min((f + 1) * per_file, detections) + 1)
+        detection_rows = []
+        ping_rows = []
+        for i in ids:
+            device = device_rows[rng.randrange(devices)]
+            timestamp += rng.randint(1, 2000)
+            frame = blanks[i % 4] if i % 3 == 0 else base64.b64encode(b"\xff\xd8" + rng.randbytes(frame_bytes)).decode()
+            detection_rows.append({
+                "id": i, "accuracy": rng.uniform(1, 50), "altitude": rng.uniform(0, 500),
+                "height": 480, "width": 640, "latitude": rng.uniform(-90, 90), "longitude": rng.uniform(-180, 180),
+                "provider": "gps", "source": "android", "x": rng.randint(0, 639), "y": rng.randint(0, 479),
+                "metadata": json.dumps({"max": rng.randint(0, 255)}), "frame_content": frame,
+                "timestamp": timestamp, "time_received": timestamp + rng.randint(10, 5000), "visible": rng.random() < 0.9,
+                "device_id": device["id"], "user_id": device["user_id"], "team_id": user_rows[device["user_id"] - 1]["team_id"],
+            })
+            ping_rows.append({
+                "id": i, "timestamp": timestamp, "delta_time": rng.randint(0, 60000), "device_id": device["id"],
+                "user_id": device["user_id"], "on_time": rng.randint(0, 60000), "time_received": timestamp + 50,
+                "metadata": "",
+            })
+        with open(os.path.join(directory, "detections", f"detections_{f:03d}.json"), "w", encoding="utf-8") as file:
+            json.dump({"detections": detection_rows}, file)
+        with open(os.path.join(directory, "pings", f"pings_{f:03d}.json"), "w", encoding="utf-8") as file:
+            json.dump({"pings": ping_rows}, file)
+    print(f"{directory}: synthetic export with {detections} detections and pings in {files} files")
+
+
+class StageTimer:
+    """
+    Wall time per ingestion stage, recorded by wrapping the functions that do each stage.
+    Stages nest and a stage only counts its own time, without the stages called inside it,
+    so the stages of the main thread add up to at most the wall time. Time spent on other
+    threads (shard writers) is kept apart as background time.
+    Rows and errors per table come from loader_metrics, so only rows the database accepted are counted.
+    """
+    def __init__(self, max_errors=ingest_max_errors):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.main_thread = threading.current_thread()
+        self.main_ns = defaultdict(int)
+        self.background_ns = defaultdict(int)
+        self.table_execute_ns = defaultdict(int)
+        self.max_errors = max_errors
+        self.errors = 0
+
+
+    @contextmanager
+    def stage(self, name, table=None):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(0)
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter_ns() - start_ns
+            own = elapsed - stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self.lock:
+                if threading.current_thread() is self.main_thread:
+                    self.main_ns[name] += own
+                else:
+                    self.background_ns[name] += own
+                if table is not None:
+                    self.table_execute_ns[table] += own
+
+
+    def timed(self, owner, attr, name, table_arg=None):
+        """
+        Replace owner.attr (a module function or a method) with a version timed as stage `name`.
+        `table_arg` is the position of the table name (or the (table, columns) key) in the call.
+        """
+        original = getattr(owner, attr)
+
+        @functools.wraps(original)
+        def wrapper(*args, **kwargs):
+            table = None
+            if table_arg is not None:
+                table = args[table_arg]
+                table = table[0] if isinstance(table, tuple) else table
+            with self.stage(name, table):
+                return original(*args, **kwargs)
+
+        setattr(owner, attr, wrapper)
+
+
+    def timed_iterator(self, owner, attr, name):
+        original = getattr(owner, attr)
+
+        @functools.wraps(original)
+        def wrapper(*args, **kwargs):
+            iterator = original(*args, **kwargs)
+            while True:
+                with self.stage(name):
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                yield item
+
+        setattr(owner, attr, wrapper)
+
+
+    def install(self, loader):
+        """
+        Wrap the stage functions used by a loader module. Must run before the loader's main().
+        """
+        import json_stream
+        from batch_writer import BatchWriter, MySQLBatchWriter
+        from tsv_loader import TsvBulkLoader
+        from image_store import ImageWriter
+        from frame_pack import FramePack
+        from sqlite_bulk import SQLiteBulkLoad
+
+        self.timed(json_stream._StreamReader, "fill", "read")
+        self.timed_iterator(loader, "iter_json_entries", "decode")
+        for name in ("entry_to_rows", "handle_missing_fields"):
+            if hasattr(loader, name):
+                self.timed(loader, name, "transform")
+        if hasattr(loader, "parallel_insert"):
+            # Waiting for the parse workers, which read, decode and transform in their own processes
+            self.timed(loader, "parallel_insert", "parse_wait")
+
+        self.timed(BatchWriter, "write_batch", "execute", table_arg=1)
+        self.timed(MySQLBatchWriter, "write_batch", "execute", table_arg=1)
+        self.timed(TsvBulkLoader, "load", "execute")
+        self.timed(MySQLBatchWriter, "commit_now", "commit")
+        if hasattr(loader, "report_insert_error"):
+            original = loader.report_insert_error
+
+            def report_insert_error(table, *args):
+                result = original(table, *args)
+                with self.lock:
+                    self.errors += 1
+                    errors = self.errors
+                # Stop a run against the wrong schema early, errors on writer threads are caught after the run
+                if errors > self.max_errors and threading.current_thread() is self.main_thread:
+                    raise IngestAborted(f"{errors} rows failed, the last one in {table}")
+                return result
+
+            loader.report_insert_error = report_insert_error
+
+        for cls in (ImageWriter, FramePack):
+            self.timed(cls, "submit", "images")
+            self.timed(cls, "close", "images")
+        self.timed(SQLiteBulkLoad, "begin", "index")
+        self.timed(SQLiteBulkLoad, "finish", "index")
+
+        timer = self
+
+        class TimedConnection(sqlite3.Connection):
+            def commit(self):
+                with timer.stage("commit"):
+                    return super().commit()
+
+        sqlite_connect = sqlite3.connect
+
+        def connect_sqlite(*args, **kwargs):
+            kwargs.setdefault("factory", TimedConnection)
+            return sqlite_connect(*args, **kwargs)
+
+        sqlite3.connect = connect_sqlite
+
+        # The MySQL loaders connect through db_pool.ConnectionPool
+        if hasattr(loader, "ConnectionPool"):
+            import mysql.connector
+            mysql_connect = mysql.connector.connect
+
+            def connect_mysql(*args, **kwargs):
+                conn = mysql_connect(*args, **kwargs)
+                commit = conn.commit
+
+                def timed_commit():
+                    with timer.stage("commit"):
+                        return commit()
+
+                conn.commit = timed_commit
+                return conn
+
+            mysql.connector.connect = connect_mysql
+
+
+    def result(self, wall_ns, snapshot):
+        """
+        Stage times and per-table throughput, `snapshot` is the loader_metrics snapshot at the end of the run.
+        """
+        main = {name: self.main_ns.get(name, 0) / 1e9 for name in stages}
+        main["other"] = max(0.0, wall_ns / 1e9 - sum(main.values()))
+        wall = wall_ns / 1e9
+        tables = {table: counters for table, counters in snapshot.items() if "inserts" in counters or "errors" in counters}
+        total_rows = sum(counters.get("inserts", 0) for counters in tables.values())
+        return {
+            "wall_seconds": wall,
+            "rows": total_rows,
+            "rows_per_second": total_rows / wall if wall > 0 else 0.0,
+            "stages": main,
+            "background_stages": {name: ns / 1e9 for name, ns in self.background_ns.items()},
+            "errors": sum(table_errors(counters) for counters in tables.values()),
+            "tables": {
+                table: {
+                    "rows": counters.get("inserts", 0),
+                    "rows_per_second": counters.get("inserts", 0) / wall if wall > 0 else 0.0,
+                    "execute_seconds": self.table_execute_ns.get(table, 0) / 1e9,
+                    "errors": table_errors(counters),
+                }
+                for table, counters in sorted(tables.items())
+            },
+        }
+
+
+def table_errors(counters):
+    # Rows LOAD DATA skipped failed as much as the ones an INSERT rejected
+    return counters.get("errors", 0) + counters.get("skipped", 0)
+
+
+def run_loader(name, export_directory, result_file):
+    """
+    Run one loader in this process with its stages timed and write the result as JSON.
+    Called in a fresh interpreter per loader, the loaders read their settings at import time.
+    """
+    module_name, db_variable, template = loaders[name]
+    os.environ["JSON_DIRECTORY"] = export_directory
+    # Every run loads the whole export, a manifest from an earlier run would skip files
+    os.environ["CHECKPOINT_DIRECTORY"] = ""
+    # Rows are counted by loader_metrics
+    os.environ["LOADER_METRICS"] = "1"
+    if db_variable:
+        db_file = os.path.join(os.path.dirname(result_file), f"ingest_{name}.sqlite3")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_file + suffix):
+                os.remove(db_file + suffix)
+        shutil.copyfile(os.path.join(os.path.dirname(os.path.abspath(__file__)), template), db_file)
+        os.environ[db_variable] = db_file
+
+    loader = importlib.import_module(module_name)
+    from loader_metrics import metrics
+    timer = StageTimer()
+    timer.install(loader)
+    start_ns = time.perf_counter_ns()
+    try:
+        loader.main()
+    except IngestAborted as e:
+        print(f"❌ {name} aborted: {e}")
+        sys.exit(1)
+    result = timer.result(time.perf_counter_ns() - start_ns, metrics.snapshot())
+    result["loader"] = name
+    result["settings"] = {
+        setting: os.getenv(setting, "")
+        for setting in ("INGEST_SQLITE_TEMPLATE", "BATCH_SIZE", "PARSE_WORKERS", "SQLITE_BULK_LOAD", "MYSQL_LOAD_MODE", "GROUP_COMMIT_ROWS",
+                        "FRAME_BINARY", "FRAME_DEDUP", "FRAME_STORE")
+    }
+    with open(result_file, "w", encoding="utf-8") as file:
+        json.dump(result, file, indent=1)
+
+
+def report(result):
+    wall = result["wall_seconds"]
+    print(f"\n📊 {result['loader']}: {result['rows']} rows in {wall:.2f}s ({result['rows_per_second']:.0f} rows/s)")
+    for stage, seconds in result["stages"].items():
+        if seconds:
+            share = seconds / wall * 100 if wall > 0 else 0.0
+            print(f"   {stage:<11} {seconds:8.3f}s  {share:5.1f}%")
+    for stage, seconds in result["background_stages"].items():
+        print(f"   {stage:<11} {seconds:8.3f}s  (background threads)")
+    for table, stats in result["tables"].items():
+        errors = f", {stats['errors']} errors" if stats["errors"] else ""
+        print(f"   {table:<28} {stats['rows']:>9} rows  {stats['rows_per_second']:>9.0f} rows/s  "
+              f"execute {stats['execute_seconds']:.3f}s{errors}")
+
+
+def write_summary(results, output_dir):
+    """
+    ingest_summary.csv has one line per loader with the stage times, ingest_tables.csv one line per loader and table.
+    """
+    with open(os.path.join(output_dir, "ingest_summary.csv"), "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["loader", "wall_seconds", "rows", "rows_per_second", *stages, "other"])
+        for result in results:
+            writer.writerow([result["loader"], f"{result['wall_seconds']:.3f}", result["rows"], f"{result['rows_per_second']:.0f}",
+                             *(f"{result['stages'][stage]:.3f}" for stage in [*stages, "other"])])
+    with open(os.path.join(output_dir, "ingest_tables.csv"), "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["loader", "table", "rows", "rows_per_second", "execute_seconds", "errors"])
+        for result in results:
+            for table, stats in result["tables"].items():
+                writer.writerow([result["loader"], table, stats["rows"], f"{stats['rows_per_second']:.0f}",
+                                 f"{stats['execute_seconds']:.3f}", stats["errors"]])
+    with open(os.path.join(output_dir, "ingest_summary.json"), "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=1)
+
+
+def main():
+    """
+    python ingest_benchmark.py generate [directory] [detections]
+    python ingest_benchmark.py run [loader,loader,...] [export_directory]
+    Loaders: sqlite, sqlite_opt, mysql, shards. The MySQL databases must be empty before a run,
+    sqlite needs INGEST_SQLITE_TEMPLATE, an empty database with the original CREDO schema.
+    """
+    if len(sys.argv) >= 5 and sys.argv[1] == "loader":
+        run_loader(sys.argv[2], sys.argv[3], sys.argv[4])
+        return
+    if len(sys.argv) < 2 or sys.argv[1] not in ("generate", "run"):
+        print(main.__doc__.strip())
+        return
+
+    if sys.argv[1] == "generate":
+        directory = sys.argv[2] if len(sys.argv) > 2 else ingest_export_directory
+        detections = int(sys.argv[3]) if len(sys.argv) > 3 else ingest_detections
+        generate_export(directory, detections)
+        return
+
+    names = sys.argv[2].split(",") if len(sys.argv) > 2 else [name for name in ("sqlite", "sqlite_opt") if loaders[name][2]]
+    export_directory = sys.argv[3] if len(sys.argv) > 3 else ingest_export_directory
+    if not os.path.isdir(export_directory):
+        generate_export(export_directory, ingest_detections)
+    os.makedirs(benchmark_directory, exist_ok=True)
+
+    results = []
+    for name in names:
+        if name not in loaders:
+            print(f"❌ Unknown loader: {name}")
+            continue
+        if loaders[name][1] and not loaders[name][2]:
+            print(f"❌ {name} needs INGEST_SQLITE_TEMPLATE, an empty database with the schema its loader writes")
+            continue
+        result_file = os.path.join(benchmark_directory, f"ingest_{name}.json")
+        if os.path.exists(result_file):
+            os.remove(result_file)
+        print(f"\n⏱️ Loading {export_directory} with {loaders[name][0]}...")
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), "loader", name, export_directory, result_file])
+        if completed.returncode != 0 or not os.path.exists(result_file):
+            print(f"❌ {name} failed with exit code {completed.returncode}")
+            continue
+        with open(result_file, "r", encoding="utf-8") as file:
+            result = json.load(file)
+        if result["errors"] > ingest_max_errors:
+            failed = ", ".join(f"{table} {stats['errors']}" for table, stats in result["tables"].items() if stats["errors"])
+            print(f"❌ {name} is left out of the results, rows failed: {failed}")
+            continue
+        results.append(result)
+
+    for result in results:
+        report(result)
+    write_summary(results, benchmark_directory)
+    print(f"\n✅ Results saved to: {benchmark_directory}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import json
+import os
+import sys
+from dotenv import load_dotenv
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is reported as n/a there
+    resource = None
+
+
+load_dotenv()
+
+# Largest unread JSON value the reader buffers before it gives up on the file as malformed
+json_max_buffer_mb = float(os.getenv("JSON_MAX_BUFFER_MB", "256"))
+
+_decoder = json.JSONDecoder()
+_whitespace = " \t\n\r"
+_number_chars = set("0123456789+-.eE")
+
+
+class _StreamReader:
+    """
+    Buffered scanner over a JSON text file.
+    Keeps only the unread tail of the file plus one chunk in memory.
+    """
+    def __init__(self, file, chunk_size, max_buffer=None):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.max_buffer = int((json_max_buffer_mb if max_buffer is None else max_buffer) * 1024 * 1024)
+        self.buf = ""
+        self.pos = 0
+        # Characters dropped from the front of the buffer, for offsets in errors
+        self.consumed = 0
+        self.eof = False
+
+
+    def fill(self):
+        """
+        Read the next chunk, dropping the part of the buffer that was already consumed.
+        The chunk grows with the pending data so a large value is decoded in few retries.
+        """
+        pending = len(self.buf) - self.pos
+        chunk = self.file.read(max(self.chunk_size, pending))
+        if not chunk:
+            self.eof = True
+        self.consumed += self.pos
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character ("" at the end of the file).
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _whitespace:
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                break
+            self.fill()
+        return self.buf[self.pos] if self.pos < len(self.buf) else ""
+
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected '{char}' at offset {self.consumed + self.pos}, found '{found}'")
+        self.pos += 1
+
+
+    def decode(self):
+        """
+        Decode one complete JSON value starting at the current position.
+        Raises ValueError when no value completes within `max_buffer` characters.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError as error:
+                if self.eof:
+                    raise
+                if len(self.buf) - self.pos > self.max_buffer:
+                    raise ValueError(f"No complete JSON value within {self.max_buffer} characters at offset "
+                                     f"{self.consumed + self.pos}: {error.msg}") from error
+                self.fill()
+                continue
+            # A value at the very end of the buffer, or a number followed only by number characters
+            # ("-2." or "5e" before a chunk boundary), may continue in the next chunk
+            if not self.eof and (end >= len(self.buf) or self.number_continues(value, end)):
+                self.fill()
+                continue
+            self.pos = end
+            return value
+
+
+    def number_continues(self, value, end):
+        return (isinstance(value, (int, float)) and not isinstance(value, bool)
+                and all(char in _number_chars for char in self.buf[end:]))
+
+
+    def iter_array(self):
+        """
+        Yield elements of the array starting at the current position one at a time.
+        """
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.decode()
+            char = self.peek()
+            self.pos += 1
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError(f"Expected ',' or ']' in array, found '{char}'")
+
+
+def iter_json_entries(filepath, keys=None, chunk_size=1024 * 1024):
+    """
+    Yield (key, entry) pairs from the top-level arrays of an export file, in file order.
+    Only one entry is held in memory at a time, so memory use does not depend on file size.
+    Arrays under keys not in `keys` are skipped element by element.
+    """
+    with open(filepath, "r", encoding="utf-8") as file:
+        reader = _StreamReader(file, chunk_size)
+        reader.expect("{")
+        if reader.peek() == "}":
+            return
+
+        while True:
+            key = reader.decode()
+            reader.expect(":")
+            wanted = keys is None or key in keys
+            if reader.peek() == "[":
+                for entry in reader.iter_array():
+                    if wanted:
+                        yield key, entry
+            else:
+                reader.decode()
+
+            char = reader.peek()
+            reader.pos += 1
+            if char == "}":
+                return
+            if char != ",":
+                raise ValueError(f"Expected ',' or '}}' in {filepath}, found '{char}'")
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MB, or None when it cannot be read.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def report_file(filename, rows, elapsed, peak=None):
+    """
+    Print rows/sec and peak memory after a file has been processed.
+    `peak` defaults to the peak RSS of the calling process.
+    """
+    rate = rows / elapsed if elapsed > 0 else 0.0
+    if peak is None:
+        peak = peak_rss_mb()
+    peak_str = f"{peak:.1f} MB" if peak is not None else "n/a"
+    print(f"{filename}: {rows} rows in {elapsed:.2f}s ({rate:.0f} rows/s), peak RSS {peak_str}")
@@ -1,15 +1,56 @@
 import os
-import json
-import mysql.connector
+import sys
 import random
-import base64
+import time
 from dotenv import load_dotenv
 from datetime import datetime
+from functools import partial
+from json_stream import iter_json_entries, report_file
+from batch_writer import BatchWriter, MySQLBatchWriter
+from tsv_loader import TsvBulkLoader
+from parallel_ingest import parallel_insert
+from db_pool import ConnectionPool
+from checkpoint import manifest_for
+from image_store import ImageWriter, PendingRows, detection_v2_table, ensure_detection_v2_table
+from frame_pack import FramePack
+from loader_metrics import start_instrumentation
+from frame_binary import decode_frame
+from detection_feed import FeedWriter, ensure_feed_table
 
 
 load_dotenv()
 
 json_directory = os.getenv("JSON_DIRECTORY")
+batch_size = int(os.getenv("BATCH_SIZE", "1000"))
+# Parse files on this many worker processes, 0 parses in the main process
+parse_workers = int(os.getenv("PARSE_WORKERS", "0"))
+parse_queue_size = int(os.getenv("PARSE_QUEUE_SIZE", "16"))
+# Group commit: commit every N rows or T milliseconds, 0 rows commits after every batch
+group_commit_rows = int(os.getenv("GROUP_COMMIT_ROWS", "0"))
+group_commit_ms = int(os.getenv("GROUP_COMMIT_MS", "1000"))
+# "insert" or "load_data" (stage TSV files and bulk load them with LOAD DATA LOCAL INFILE)
+load_mode = os.getenv("MYSQL_LOAD_MODE", "insert")
+bulk_load_directory = os.getenv("BULK_LOAD_DIRECTORY") or None
+# Manifests of loaded files are kept here so a re-run resumes, empty loads everything again
+checkpoint_directory = os.getenv("CHECKPOINT_DIRECTORY", "")
+# Commit and checkpoint every N entries inside a file
+checkpoint_every = int(os.getenv("CHECKPOINT_EVERY", "50000"))
+# Detection frames written as files (credocommon_detection_v2): target directory, writer threads,
+# frames waiting to be written and files per fsync batch (0 never fsyncs)
+image_directory = os.getenv("IMAGE_DIRECTORY", "images")
+image_workers = int(os.getenv("IMAGE_WORKERS", "4"))
+image_queue_size = int(os.getenv("IMAGE_QUEUE_SIZE", "256"))
+image_fsync_batch = int(os.getenv("IMAGE_FSYNC_BATCH", "64"))
+# Where detection frames go: "inline" (frame_content of credocommon_detection), "files" (one JPEG per detection)
+# or "pack" (frame pack segments in FRAME_PACK_DIRECTORY). files and pack load detections into credocommon_detection_v2
+# with the frame's path
+frame_store = os.getenv("FRAME_STORE", "inline")
+# Store identical frames once, named by their sha256. Files and pack only, inline frame dedup is SQLite only
+frame_dedup = os.getenv("FRAME_DEDUP", "0") == "1"
+# Decode base64 frames and store raw bytes in the frame_content blob
+frame_binary = os.getenv("FRAME_BINARY", "0") == "1"
+# Maintain credocommon_detection_feed (detections with their user and team names, keyed by timestamp) while loading
+detection_feed = os.getenv("DETECTION_FEED", "0") == "1"
 
 # Mapping JSON keys to table names
 table_mapping = {
@@ -86,156 +127,202 @@ def handle_missing_fields(table, data):
     return data
 
 
-def json_to_insert(table, data, cursor, conn):
+def report_insert_error(table, data, e):
+    print(f"MySQL insert error on table {table}: {e}")
+
+
+def json_to_insert(table, data, writer):
     """
-        Insert data into table
+        Queue data for insertion into table
     """
     data = handle_missing_fields(table, data)
-    
-    keys = data.keys()
-    columns = ", ".join(f"`{k}`" for k in keys)
-    insert_values = ", ".join(["%s" for _ in keys])
-    query = f"INSERT INTO {table} ({columns}) VALUES ({insert_values})"
-    try:
-        cursor.execute(query, list(data.values()))
-        conn.commit()
-    except mysql.connector.Error as e:
-        print(f"MySQL insert error on table {table}: {e}")
-
-
-def insert_data_teams(directory, cursor, conn):
+    writer.add(table, data)
+
+
+def insert_data_teams(directory, writer, manifest):
     filepath = os.path.join(directory, "team_mapping.json")
     if not os.path.exists(filepath):
         return
+    start = manifest.start_file(filepath)
+    if start is None:
+        return
 
-    with open(filepath, "r", encoding="utf-8") as f:
-        data = json.load(f)
-        for entry in data.get("teams", []):
-            try:
-                json_to_insert("credocommon_team" , entry, cursor, conn)
-            except Exception as e:
-                print(f"Error inserting team: {e}")
+    index = 0
+    for index, (_, entry) in enumerate(iter_json_entries(filepath, {"teams"}), 1):
+        if index <= start:
+            continue
+        try:
+            json_to_insert("credocommon_team" , entry, writer)
+        except Exception as e:
+            print(f"Error inserting team: {e}")
+    manifest.mark(filepath, max(index, start), done=True)
 
 
-def insert_data_users(directory, cursor, conn):
+def insert_data_users(directory, writer, manifest):
     filepath = os.path.join(directory, "user_mapping.json")
     if not os.path.exists(filepath):
         return
+    start = manifest.start_file(filepath)
+    if start is None:
+        return
     
-    with open(filepath, "r", encoding="utf-8") as f:
-        data = json.load(f)
-        for entry in data.get("users", []):
-            try:
-                user_info = {
-                    "id": entry["id"],
-                }
-                json_to_insert("credocommon_user_info" , user_info, cursor, conn)
-                json_to_insert("credocommon_user" , entry, cursor, conn)
-            except Exception as e:
-                print(f"Error inserting user: {e}")
+    index = 0
+    for index, (_, entry) in enumerate(iter_json_entries(filepath, {"users"}), 1):
+        if index <= start:
+            continue
+        try:
+            user_info = {
+                "id": entry["id"],
+            }
+            json_to_insert("credocommon_user_info" , user_info, writer)
+            json_to_insert("credocommon_user" , entry, writer)
+        except Exception as e:
+            print(f"Error inserting user: {e}")
+    manifest.mark(filepath, max(index, start), done=True)
+
+
+def detection_info_for(entry):
+    return {
+        "id": entry["id"],
+        "accuracy": entry["accuracy"],
+        "altitude": entry["altitude"],
+        "height": entry["height"],
+        "width": entry["width"],
+        "latitude": entry["latitude"],
+        "longitude": entry["longitude"],
+        "provider": entry["provider"],
+        "source": entry["source"],
+        "x": entry["x"],
+        "y": entry["y"],
+        "metadata": entry["metadata"]
+    }
 
 
-def insert_data(directory, cursor, conn):
+def entry_to_rows(table_name, entry):
+    """
+        Build the rows for one json entry as (table, data) pairs
+    """
+    rows = []
+    if table_name == "credocommon_user":
+        user_info = {
+            "id": entry["id"],
+        }
+        rows.append((f"{table_name}_info", user_info))
+        rows.append((table_name, entry))
+    elif table_name == "credocommon_device":
+        device_info = {
+            "id": entry["id"],
+            "device_identifier": entry["id"],
+            "device_type": entry["device_type"],
+            "device_model": entry["device_model"],
+            "user_id":  entry["user_id"]
+        }
+        device_version = {
+            "id": entry["id"],
+            "device_id": entry["id"],
+            "system_version": entry["system_version"],
+            "recorded_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        rows.append((table_name, device_info))
+        rows.append((f"{table_name}_version", device_version))
+    elif table_name == "credocommon_detection":
+        detection_info = detection_info_for(entry)
+        detection_main = {
+            "id": entry["id"],
+            "frame_content": decode_frame(entry["frame_content"]) if frame_binary else entry["frame_content"],
+            "timestamp": datetime.fromtimestamp(entry["timestamp"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
+            "time_received": datetime.fromtimestamp(entry["time_received"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
+            "visible": entry["visible"],
+            "device_id": entry["device_id"],
+        }
+        rows.append((f"{table_name}_info", detection_info))
+        rows.append((table_name, detection_main))
+    elif table_name == "credocommon_ping":
+        ping_info = {
+            "id": entry["id"],
+            "timestamp": datetime.fromtimestamp(entry["timestamp"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
+            "delta_time": entry["delta_time"],
+            "device_id": entry["device_id"],
+            "on_time": entry["on_time"],
+            "time_received": datetime.fromtimestamp(entry["time_received"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
+            "metadata": entry["metadata"],
+        }
+        rows.append((table_name, ping_info))
+    return rows
+
+
+def save_checkpoint(writer, manifest, images=None):
+    """
+    Commit everything written so far and wait for the image store to write and sync the frames of those rows,
+    then save the progress recorded in the manifest.
+    LOAD DATA only commits once the staged files are loaded, main saves the manifest after that.
+    """
+    writer.flush()
+    if isinstance(writer, FeedWriter):
+        writer = writer.writer
+    if isinstance(writer, TsvBulkLoader):
+        return
+    writer.commit_now()
+    if images is not None:
+        images.flush()
+    manifest.save()
+
+
+def insert_data(directory, writer, manifest):
     """
         Insert data from json files in given directory
         change the line in insert for the sqlite - mysql
+        Files the manifest marks as loaded are skipped, partly loaded ones resume after the last checkpoint
     """
-    for filename in os.listdir(directory):
+    for filename in sorted(os.listdir(directory)):
         if not filename.endswith(".json") or filename == "user_mapping.json" or filename == "team_mapping.json":
             continue
         filepath = os.path.join(directory, filename)
-        with open(filepath, "r", encoding="utf-8") as file:
-            json_data = json.load(file)
-
-            for key, table_name in table_mapping.items():
-                if key not in json_data:
-                    continue
-                for entry in json_data[key]:
-                    try:
-                        if table_name == "credocommon_user":
-                            user_info = {
-                                "id": entry["id"],
-                            }
-                            json_to_insert(f"{table_name}_info" , user_info, cursor, conn)
-                            json_to_insert(table_name, entry, cursor, conn)
-                        elif table_name == "credocommon_device":
-                            device_info = {
-                                "id": entry["id"],
-                                "device_identifier": entry["id"],
-                                "device_type": entry["device_type"],
-                                "device_model": entry["device_model"],
-                                "user_id":  entry["user_id"]
-                            }
-                            device_version = {
-                                "id": entry["id"],
-                                "device_id": entry["id"],
-                                "system_version": entry["system_version"],
-                                "recorded_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                            }
-                            json_to_insert(table_name, device_info, cursor, conn)
-                            json_to_insert(f"{table_name}_version", device_version, cursor, conn)
-                        elif table_name == "credocommon_detection":
-                            detection_info = {
-                                "id": entry["id"],
-                                "accuracy": entry["accuracy"],
-                                "altitude": entry["altitude"],
-                                "height": entry["height"],
-                                "width": entry["width"],
-                                "latitude": entry["latitude"],
-                                "longitude": entry["longitude"],
-                                "provider": entry["provider"],
-                                "source": entry["source"],
-                                "x": entry["x"],
-                                "y": entry["y"],
-                                "metadata": entry["metadata"]
-                            }
-                            detection_main = {
-                                "id": entry["id"],
-                                "frame_content": entry["frame_content"],
-                                "timestamp": datetime.fromtimestamp(entry["timestamp"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
-                                "time_received": datetime.fromtimestamp(entry["time_received"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
-                                "visible": entry["visible"],
-                                "device_id": entry["device_id"],
-                            }
-                            json_to_insert(f"{table_name}_info", detection_info, cursor, conn)
-                            json_to_insert(table_name, detection_main, cursor, conn)
-                        elif table_name == "credocommon_ping":
-                            ping_info = {
-                                "id": entry["id"],
-                                "timestamp": datetime.fromtimestamp(entry["timestamp"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
-                                "delta_time": entry["delta_time"],
-                                "device_id": entry["device_id"],
-                                "on_time": entry["on_time"],
-                                "time_received": datetime.fromtimestamp(entry["time_received"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
-                                "metadata": entry["metadata"],
-                            }
-                            json_to_insert(table_name, ping_info, cursor, conn)
-                    except Exception as e:
-                        print(f"Error inserting data into {table_name}: {e}")
-
-
-def save_image_from_blob(blob_data, detection_id, output_dir="images"):
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    image_path = os.path.join(output_dir, f"detection_{detection_id}.jpg")
-    with open(image_path, "wb") as f:
-        f.write(base64.b64decode(blob_data))
-    return image_path
-
-
-def process_detection_entry(entry, cursor, conn, output_dir="images"):
+        start = manifest.start_file(filepath)
+        if start is None:
+            print(f"{filename}: already loaded, skipped")
+            continue
+        rows = 0
+        index = 0
+        start_time = time.perf_counter()
+        for index, (key, entry) in enumerate(iter_json_entries(filepath, table_mapping), 1):
+            if index <= start:
+                continue
+            table_name = table_mapping[key]
+            rows += 1
+            try:
+                for table, data in entry_to_rows(table_name, entry):
+                    json_to_insert(table, data, writer)
+            except Exception as e:
+                print(f"Error inserting data into {table_name}: {e}")
+            if index % checkpoint_every == 0:
+                manifest.mark(filepath, index)
+                save_checkpoint(writer, manifest)
+        manifest.mark(filepath, max(index, start), done=True)
+        save_checkpoint(writer, manifest)
+        report_file(filename, rows, time.perf_counter() - start_time)
+
+
+def create_image_store(output_dir=None):
+    """
+        Pick where detection frames go for the configured FRAME_STORE
+    """
+    if frame_store == "pack":
+        return FramePack(output_dir, dedup=frame_dedup) if output_dir else FramePack(dedup=frame_dedup)
+    return ImageWriter(output_dir or image_directory, workers=image_workers, queue_size=image_queue_size,
+                       fsync_batch=image_fsync_batch, dedup=frame_dedup)
+
+
+def process_detection_entry(entry, writer, images, pending):
     """
     Process a single detection entry:
     - Extracts detection_info
-    - Converts BLOB to image file and saves it
+    - Queues the BLOB to be written as an image file
     - Inserts detection_info and detection_main (without BLOB) into respective tables
     """
-    # Save image and get the relative file path
-    image_path = save_image_from_blob(entry["frame_content"], entry["id"], output_dir)
-
     detection_main = {
         "id": entry["id"],
-        "frame_path": image_path,
+        "frame_path": None,
         "timestamp": datetime.fromtimestamp(entry["timestamp"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
         "time_received": datetime.fromtimestamp(entry["time_received"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
         "visible": entry["visible"],
@@ -243,34 +330,88 @@ def process_detection_entry(entry, cursor, conn, output_dir="images"):
         "detection_info_id": entry["id"]
     }
 
-    # Insert into database
-    json_to_insert("credocommon_detection_v2", detection_main, cursor, conn)
+    # The path is known before the image is written, the insert does not wait for the file.
+    # A deduplicated frame is named by its hash, the row goes in once an image worker computed it
+    json_to_insert("credocommon_detection_info", detection_info_for(entry), writer)
+    pending.add(images.submit(entry["id"], entry["frame_content"]),
+                lambda image_path: json_to_insert(detection_v2_table, dict(detection_main, frame_path=image_path), writer))
 
 
-def insert_detections_with_image_paths(directory, cursor, conn, output_dir="images"):
+def insert_detections_with_image_paths(directory, writer, manifest, output_dir=None):
     """
     Reads all JSON files and processes detection entries.
-    Converts BLOBs to images and saves them locally.
+    Converts BLOBs to images and saves them locally, as files or into a frame pack.
+    Files the manifest marks as loaded are skipped, partly loaded ones resume after the last checkpoint
     """
-    for filename in os.listdir(directory):
+    images = create_image_store(output_dir)
+    pending = PendingRows(image_queue_size)
+    for filename in sorted(os.listdir(directory)):
         if not filename.endswith(".json"):
             continue
 
         filepath = os.path.join(directory, filename)
-        with open(filepath, "r", encoding="utf-8") as file:
-            json_data = json.load(file)
-
-        if "detections" not in json_data:
+        start = manifest.start_file(filepath)
+        if start is None:
+            print(f"{filename}: already loaded, skipped")
             continue
-
-        for entry in json_data["detections"]:
+        rows = 0
+        index = 0
+        start_time = time.perf_counter()
+        for index, (_, entry) in enumerate(iter_json_entries(filepath, {"detections"}), 1):
+            if index <= start:
+                continue
+            rows += 1
             try:
-                process_detection_entry(entry, cursor, conn, output_dir)
+                process_detection_entry(entry, writer, images, pending)
             except Exception as e:
                 print(f"Error processing detection {entry.get('id')}: {e}")
+            if index % checkpoint_every == 0:
+                pending.flush()
+                manifest.mark(filepath, index)
+                save_checkpoint(writer, manifest, images)
+        pending.flush()
+        manifest.mark(filepath, max(index, start), done=True)
+        save_checkpoint(writer, manifest, images)
+        report_file(filename, rows, time.perf_counter() - start_time)
+    images.close()
+
+
+def create_writer(conn, pool=None):
+    """
+        Pick the row writer for the configured load mode
+        With `pool` the writer replaces a connection it lost and sends the uncommitted rows again
+    """
+    if load_mode == "load_data":
+        return TsvBulkLoader(conn, name=os.getenv("MYSQL_DB"), directory=bulk_load_directory, pool=pool)
+    if group_commit_rows > 0:
+        return MySQLBatchWriter(conn, batch_size=batch_size, commit_rows=group_commit_rows,
+                                commit_interval_ms=group_commit_ms, on_error=report_insert_error, pool=pool)
+    return BatchWriter(conn, placeholder="%s", quote="`", batch_size=batch_size, commit=True,
+                       on_error=report_insert_error, pool=pool)
+
+
+def load_directory(directory, writer, manifest):
+    """
+        Insert a directory, parsing files on PARSE_WORKERS processes when it is set
+        With parse workers files are checkpointed once complete, the commit happens at the end of the directory
+    """
+    if parse_workers > 0:
+        parallel_insert(directory, table_mapping, entry_to_rows, partial(json_to_insert, writer=writer),
+                        workers=parse_workers, queue_size=parse_queue_size, batch_rows=batch_size,
+                        skip_files=("user_mapping.json", "team_mapping.json"),
+                        resume=manifest.start_file, on_file=manifest.mark)
+        save_checkpoint(writer, manifest)
+    else:
+        insert_data(directory, writer, manifest)
 
 
 def main():
+    if detection_feed and frame_store != "inline":
+        # The feed pages credocommon_detection, files and pack load detections into credocommon_detection_v2 instead
+        sys.exit(f"❌ DETECTION_FEED=1 needs FRAME_STORE=inline, with FRAME_STORE={frame_store} the feed would stay empty")
+    if frame_dedup and frame_store == "inline":
+        # credocommon_frame and the frame_hash column only exist on SQLite, every detection would keep its own blob
+        sys.exit("❌ FRAME_DEDUP=1 needs FRAME_STORE=files or pack here, inline frames are only deduplicated on SQLite")
     config = {
         'host': os.getenv("MYSQL_HOST"),
         'port': os.getenv("MYSQL_PORT"),
@@ -278,22 +419,55 @@ def main():
         'password': os.getenv("MYSQL_PASSWORD"),
         'database': os.getenv("MYSQL_DB")
     }
-    conn = mysql.connector.connect(**config)
-    cursor = conn.cursor()
-
-    insert_data_teams(json_directory, cursor, conn)
+    if load_mode == "load_data":
+        config['allow_local_infile'] = True
+    # Single writer connection, the pool retries the connect with backoff and validates it.
+    # The writer hands a connection it lost back to the pool and continues on a new one
+    instrumentation = start_instrumentation("mysql")
+    pool = ConnectionPool(config, size=1, name="mysql")
+    conn = pool.acquire()
+    writer = create_writer(conn, pool)
+    feed = None
+    if detection_feed:
+        ensure_feed_table(conn)
+        writer = feed = FeedWriter(writer)
+    if frame_store != "inline":
+        ensure_detection_v2_table(conn)
+    manifest = manifest_for(checkpoint_directory, f"mysql_{config['host']}_{config['port']}_{config['database']}")
+    start_time = time.perf_counter()
+
+    insert_data_teams(json_directory, writer, manifest)
+    save_checkpoint(writer, manifest)
     print("finished teams")
-    insert_data_users(json_directory, cursor, conn)
+    insert_data_users(json_directory, writer, manifest)
+    save_checkpoint(writer, manifest)
     print("finished users")
-    insert_data(json_directory, cursor, conn)
+    load_directory(json_directory, writer, manifest)
     print("finished rest")
-    insert_data(detections_directory, cursor, conn)
+    if frame_store == "inline":
+        load_directory(detections_directory, writer, manifest)
+    else:
+        # Frames go to the image store from this process, PARSE_WORKERS does not apply here
+        insert_detections_with_image_paths(detections_directory, writer, manifest)
     print("finished detections")
-    insert_data(pings_directory, cursor, conn)
+    load_directory(pings_directory, writer, manifest)
     print("finished pings")
 
-    conn.commit()
-    conn.close()
+    writer.close()
+    writer.conn.commit()
+    # A table that failed to LOAD DATA leaves the manifest as it was, so the next run loads its files again
+    if load_mode != "load_data" or not writer.failed_tables:
+        manifest.save()
+    if feed:
+        feed.directory.report("mysql")
+    pool.release(writer.conn)
+    pool.report()
+    pool.close()
+
+    elapsed = time.perf_counter() - start_time
+    rate = writer.rows_written / elapsed if elapsed > 0 else 0.0
+    print(f"{load_mode}: {writer.rows_written} rows in {elapsed:.2f}s ({rate:.0f} rows/s)")
+    instrumentation.stop()
 
 
 if __name__ == "__main__":
@@ -1,15 +1,77 @@
 import os
-import json
+import sys
 import mysql.connector
 import random
-import base64
+import time
+import bisect
+import hashlib
+import heapq
+import itertools
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from datetime import datetime
+from functools import partial
+from json_stream import iter_json_entries, report_file
+from batch_writer import MySQLBatchWriter
+from tsv_loader import TsvBulkLoader
+from parallel_ingest import parallel_insert
+from db_pool import ConnectionPool
+from checkpoint import manifest_for
+from image_store import ImageWriter, PendingRows, detection_v2_table, ensure_detection_v2_table
+from frame_pack import FramePack
+from loader_metrics import metrics, start_instrumentation
+from frame_binary import decode_frame
+from detection_feed import FeedDirectory, connection_lookup, detection_table, ensure_feed_table, feed_table
 
 
 load_dotenv()
 
 json_directory = os.getenv("JSON_DIRECTORY")
+# "insert" or "load_data" (stage TSV files per shard and bulk load them with LOAD DATA LOCAL INFILE)
+load_mode = os.getenv("MYSQL_LOAD_MODE", "insert")
+bulk_load_directory = os.getenv("BULK_LOAD_DIRECTORY") or None
+batch_size = int(os.getenv("BATCH_SIZE", "1000"))
+# Group commit per shard: commit every N rows or T milliseconds, 0 inserts and commits row by row
+group_commit_rows = int(os.getenv("GROUP_COMMIT_ROWS", "0"))
+group_commit_ms = int(os.getenv("GROUP_COMMIT_MS", "1000"))
+# Parse files on this many worker processes, 0 parses in the main process
+parse_workers = int(os.getenv("PARSE_WORKERS", "0"))
+parse_queue_size = int(os.getenv("PARSE_QUEUE_SIZE", "16"))
+# Max user->shard routes kept in memory (LRU), 0 keeps all of them
+route_cache_size = int(os.getenv("SHARD_ROUTE_CACHE_SIZE", "0"))
+# Connections per shard and for the lookup DB
+pool_size = int(os.getenv("DB_POOL_SIZE", "4"))
+# Manifests of loaded files are kept here so a re-run resumes, empty loads everything again
+checkpoint_directory = os.getenv("CHECKPOINT_DIRECTORY", "")
+# Commit and checkpoint every N entries inside a file
+checkpoint_every = int(os.getenv("CHECKPOINT_EVERY", "50000"))
+# Detection frames written as files (credocommon_detection_v2): target directory, writer threads,
+# frames waiting to be written and files per fsync batch (0 never fsyncs)
+image_directory = os.getenv("IMAGE_DIRECTORY", "images")
+image_workers = int(os.getenv("IMAGE_WORKERS", "4"))
+image_queue_size = int(os.getenv("IMAGE_QUEUE_SIZE", "256"))
+image_fsync_batch = int(os.getenv("IMAGE_FSYNC_BATCH", "64"))
+# Where detection frames go: "inline" (frame_content of credocommon_detection), "files" (one JPEG per detection)
+# or "pack" (frame pack segments in FRAME_PACK_DIRECTORY). files and pack load detections into credocommon_detection_v2
+# with the frame's path
+frame_store = os.getenv("FRAME_STORE", "inline")
+# Store identical frames once, named by their sha256. Files and pack only, inline frame dedup is SQLite only
+frame_dedup = os.getenv("FRAME_DEDUP", "0") == "1"
+# Decode base64 frames and store raw bytes in the frame_content blob
+frame_binary = os.getenv("FRAME_BINARY", "0") == "1"
+# Maintain credocommon_detection_feed on every shard (its detections with user and team names) while loading
+detection_feed = os.getenv("DETECTION_FEED", "0") == "1"
+# "round_robin" (file order) or "hash" (consistent-hash ring, computable without the lookup DB)
+shard_placement = os.getenv("SHARD_PLACEMENT", "round_robin")
+shard_virtual_nodes = int(os.getenv("SHARD_VIRTUAL_NODES", "160"))
+# Optional per-shard ring weights, e.g. "1=1,2=1,3=2,4=1"
+shard_weights = {
+    int(shard_id): float(weight)
+    for shard_id, weight in (item.split("=") for item in os.getenv("SHARD_WEIGHTS", "").split(",") if item)
+}
 
 # Mapping JSON keys to table names
 table_mapping = {
@@ -83,222 +145,862 @@ def handle_missing_fields(table, data):
     return data
 
 
+def report_insert_error(table, data, e):
+    print(f"MySQL insert error on table {table}: {e} with data: {data}")
+
+
+class ShardWriter:
+    """
+    Buffers rows for one shard and writes them on a dedicated thread with its own pooled connection,
+    through a MySQLBatchWriter (multi-row INSERTs and group commits).
+    Rows are handed to the thread in batches of `batch_size` and at most `queue_size` batches
+    wait per shard, so a slow shard applies backpressure instead of growing memory.
+    rows_written counts committed rows. Once the connection is lost every row handed to the thread
+    and not committed counts as failed.
+    """
+    def __init__(self, shard_id, pool, batch_size=1000, commit_rows=10000, commit_interval_ms=1000, queue_size=8):
+        self.shard_id = shard_id
+        self.pool = pool
+        self.batch_size = max(1, batch_size)
+        self.commit_rows = commit_rows
+        self.commit_interval_ms = commit_interval_ms
+        self.buffer = []
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.rows_written = 0
+        # Rows taken from the queue by the writer thread
+        self.rows_sent = 0
+        self.failed_rows = 0
+        self.last_failure = None
+        # Set when the shard connection breaks, rows sent after that are counted as failed
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name=f"shard{shard_id}-writer", daemon=True)
+        self.thread.start()
+
+
+    def add(self, table, data):
+        self.buffer.append((table, data))
+        if len(self.buffer) >= self.batch_size:
+            self.queue.put(self.buffer)
+            self.buffer = []
+
+
+    def flush_async(self):
+        """
+        Hand the buffered rows to the writer thread and ask it to write and commit everything.
+        Returns an Event that is set once the shard has caught up.
+        """
+        if self.buffer:
+            self.queue.put(self.buffer)
+            self.buffer = []
+        done = threading.Event()
+        self.queue.put(done)
+        return done
+
+
+    def flush(self):
+        self.flush_async().wait()
+
+
+    def close(self):
+        if self.buffer:
+            self.queue.put(self.buffer)
+            self.buffer = []
+        self.queue.put(None)
+        self.thread.join()
+
+
+    def record_failure(self, table, data, e):
+        self.failed_rows += 1
+        self.last_failure = f"{table}: {e}"
+        report_insert_error(table, data, e)
+
+
+    def fail(self, error, writer):
+        # Rejected, uncommitted, still buffered or not reached yet, no row after the last commit made it
+        self.error = error
+        self.failed_rows = self.rows_sent - writer.rows_committed
+
+
+    def run(self):
+        conn = None
+        writer = None
+        try:
+            conn = self.pool.acquire()
+            writer = MySQLBatchWriter(conn, batch_size=self.batch_size, commit_rows=self.commit_rows,
+                                      commit_interval_ms=self.commit_interval_ms, on_error=self.record_failure,
+                                      pool=self.pool)
+        except Exception as e:
+            self.error = e
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if isinstance(item, threading.Event):
+                if self.error is None:
+                    try:
+                        writer.flush()
+                        writer.commit_now()
+                    except Exception as e:
+                        self.fail(e, writer)
+                item.set()
+            elif self.error is not None:
+                self.rows_sent += len(item)
+                self.failed_rows += len(item)
+            else:
+                self.rows_sent += len(item)
+                try:
+                    for table, data in item:
+                        writer.add(table, data)
+                except Exception as e:
+                    self.fail(e, writer)
+            if writer is not None:
+                self.rows_written = writer.rows_committed
+
+        if writer is not None and self.error is None:
+            try:
+                writer.close()
+            except Exception as e:
+                self.fail(e, writer)
+            self.rows_written = writer.rows_committed
+        if writer is not None:
+            # The writer's connection is None when it could not replace a lost one
+            conn = writer.conn
+        if conn is not None:
+            self.pool.release(conn)
+
+
+class RoundRobinPlacement:
+    """
+    Places users on shards in turn, so placement depends on the order users are loaded in
+    and can only be looked up later through the lookup DB.
+    """
+    deterministic = False
+
+    def __init__(self, shard_ids):
+        self.shard_ids = list(shard_ids)
+        self.next_index = 0
+
+
+    def shard_for(self, user_id):
+        shard_id = self.shard_ids[self.next_index % len(self.shard_ids)]
+        self.next_index += 1
+        return shard_id
+
+
+    def resume(self, placed):
+        """
+        Continue after `placed` users, so a resumed load spreads users like a straight-through one.
+        """
+        self.next_index = placed
+
+
+class ConsistentHashRing:
+    """
+    Places users on a hash ring with `virtual_nodes` points per shard (scaled by its weight).
+    The shard of a user is a pure function of the user id and the ring, so it is computed
+    locally, and adding or removing a shard only moves the users of the affected ring arcs.
+    """
+    deterministic = True
+
+    def __init__(self, shard_ids, virtual_nodes=160, weights=None):
+        self.virtual_nodes = virtual_nodes
+        self.weights = {}
+        self.points = []
+        self.owners = []
+        for shard_id in shard_ids:
+            self.add_shard(shard_id, (weights or {}).get(shard_id, 1))
+
+
+    @staticmethod
+    def hash(key):
+        # md5 is stable across processes and Python versions, unlike hash()
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], "big")
+
+
+    def rebuild(self):
+        ring = sorted(
+            (self.hash(f"shard-{shard_id}#{vnode}"), shard_id)
+            for shard_id, weight in self.weights.items()
+            for vnode in range(max(1, round(self.virtual_nodes * weight)))
+        )
+        self.points = [point for point, _ in ring]
+        self.owners = [shard_id for _, shard_id in ring]
+
+
+    def add_shard(self, shard_id, weight=1):
+        self.weights[shard_id] = weight
+        self.rebuild()
+
+
+    def remove_shard(self, shard_id):
+        del self.weights[shard_id]
+        self.rebuild()
+
+
+    def shard_for(self, user_id):
+        index = bisect.bisect(self.points, self.hash(user_id))
+        return self.owners[index % len(self.owners)]
+
+
+def create_placement(shard_ids):
+    if shard_placement == "hash":
+        return ConsistentHashRing(shard_ids, shard_virtual_nodes, shard_weights)
+    return RoundRobinPlacement(shard_ids)
+
+
+def report_shard_moves(ring: ConsistentHashRing, user_ids, added=(), removed=()):
+    """
+    Count how many of `user_ids` would change shard if `added` shards (ids or (id, weight) pairs)
+    joined the ring and `removed` shards left it. Nothing is written.
+    """
+    changed = ConsistentHashRing([], ring.virtual_nodes)
+    changed.weights = dict(ring.weights)
+    for shard in added:
+        shard_id, weight = shard if isinstance(shard, tuple) else (shard, 1)
+        changed.weights[shard_id] = weight
+    for shard_id in removed:
+        changed.weights.pop(shard_id, None)
+    changed.rebuild()
+
+    total = 0
+    moved = 0
+    for user_id in user_ids:
+        total += 1
+        if ring.shard_for(user_id) != changed.shard_for(user_id):
+            moved += 1
+    share = moved / total * 100 if total else 0.0
+    print(f"shard placement: adding {list(added)} / removing {list(removed)} moves {moved} of {total} users ({share:.1f}%)")
+    return moved
+
+
 class ShardManager:
-    def __init__(self, lookup_config, shard_configs):
-        # Connect to lookup DB
-        self.lookup_conn = mysql.connector.connect(**lookup_config)
-        self.lookup_cursor = self.lookup_conn.cursor(dictionary=True)
+    def __init__(self, lookup_config, shard_configs, preload_routes=True, route_cache_size=None, placement=None,
+                 pool_size=4):
+        # Connection pool for the lookup DB
+        self.lookup_pool = ConnectionPool(lookup_config, size=pool_size, name="lookup")
+
+        # user_id -> shard_id, None keeps every route, otherwise least recently used routes are evicted
+        self.route_cache = OrderedDict()
+        self.route_cache_size = route_cache_size or None
+        self.route_hits = 0
+        self.route_misses = 0
+        # Placement strategy for new users, a deterministic one also answers route lookups locally,
+        # but only once every route already in user_shard is known to agree with it
+        self.placement = placement or RoundRobinPlacement(shard_configs)
+        self.placement_verified = False
+        self.routes_preloaded = preload_routes and not self.route_cache_size
+        self.stored_routes = self.load_shard_routes() if preload_routes else self.count_stored_routes()
+        if not preload_routes and self.placement.deterministic:
+            self.placement_verified = self.stored_routes == 0
+        if not self.placement.deterministic:
+            self.placement.resume(self.stored_routes)
         
-        # Connect to shards
-        self.shards = {}
-        for shard_id, config in shard_configs.items():
-            conn = mysql.connector.connect(**config)
-            self.shards[shard_id] = conn
+        # Connection pool per shard, each opens one connection up front and grows to pool_size
+        self.shards = {
+            shard_id: ConnectionPool(config, size=pool_size, name=f"shard{shard_id}")
+            for shard_id, config in shard_configs.items()
+        }
+
+        # One row writer per shard, only set while a batched or bulk load is running
+        self.writers = {}
+        # shard_id -> tables that failed to LOAD DATA in the last finish_writes
+        self.failed_loads = {}
+        self.rows_written = 0
+        # Names for the detection feed rows, only set while start_feed is active
+        self.feed = None
+
+
+    def load_shard_routes(self):
+        """
+        Bulk-load the user->shard map from the lookup DB in one query.
+        In bounded mode only the first `route_cache_size` routes are kept.
+        With a deterministic placement every stored route is checked against it. Users placed by an earlier
+        round-robin load or another ring would be routed to the wrong shard once evicted from the cache,
+        so when any route differs cache misses read user_shard first.
+        """
+        stored = 0
+        mismatched = 0
+        with self.lookup_pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT user_id, shard_id FROM user_shard")
+                while True:
+                    rows = cursor.fetchmany(10000)
+                    if not rows:
+                        break
+                    for user_id, shard_id in rows:
+                        stored += 1
+                        if self.placement.deterministic and self.placement.shard_for(user_id) != shard_id:
+                            mismatched += 1
+                        if self.route_cache_size and len(self.route_cache) >= self.route_cache_size:
+                            continue
+                        self.route_cache[user_id] = shard_id
+            finally:
+                cursor.close()
+        if self.placement.deterministic:
+            self.placement_verified = mismatched == 0
+            if mismatched:
+                print(f"⚠️ {mismatched} of {stored} users in user_shard are not where the configured placement puts them, "
+                      f"cache misses are looked up in user_shard")
+        return stored
+
+
+    def stored_shard(self, user_id):
+        """
+        Shard user_shard already holds for a user, None when no load placed the user yet.
+        """
+        shard_id = self.route_cache.get(user_id)
+        # An unbounded preload already cached every stored route
+        if shard_id is not None or not self.stored_routes or self.routes_preloaded:
+            return shard_id
+        with self.lookup_pool.connection() as conn:
+            cursor = conn.cursor(dictionary=True)
+            try:
+                cursor.execute("SELECT shard_id FROM user_shard WHERE user_id = %s", (user_id,))
+                result = cursor.fetchone()
+            finally:
+                cursor.close()
+        if result:
+            self.cache_route(user_id, result['shard_id'])
+            return result['shard_id']
+        return None
+
+
+    def count_stored_routes(self):
+        with self.lookup_pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT COUNT(*) FROM user_shard")
+                return cursor.fetchone()[0]
+            finally:
+                cursor.close()
+
+
+    def cache_route(self, user_id, shard_id):
+        self.route_cache[user_id] = shard_id
+        if self.route_cache_size:
+            self.route_cache.move_to_end(user_id)
+            while len(self.route_cache) > self.route_cache_size:
+                self.route_cache.popitem(last=False)
 
 
     def get_shard_for_user(self, user_id):
+        shard_id = self.route_cache.get(user_id)
+        if shard_id is not None:
+            self.route_hits += 1
+            metrics.count("shard_lookup", "cache_hits")
+            if self.route_cache_size:
+                self.route_cache.move_to_end(user_id)
+            return shard_id
+
+        self.route_misses += 1
+        metrics.count("shard_lookup", "cache_misses")
+        if self.placement.deterministic and self.placement_verified:
+            shard_id = self.placement.shard_for(user_id)
+            self.cache_route(user_id, shard_id)
+            return shard_id
+
         query = "SELECT shard_id FROM user_shard WHERE user_id = %s"
-        self.lookup_cursor.execute(query, (user_id,))
-        result = self.lookup_cursor.fetchone()
+        with self.lookup_pool.connection() as conn, metrics.timer("shard_lookup", "lookup"):
+            cursor = conn.cursor(dictionary=True)
+            try:
+                cursor.execute(query, (user_id,))
+                result = cursor.fetchone()
+            finally:
+                cursor.close()
         if result:
+            self.cache_route(user_id, result['shard_id'])
             return result['shard_id']
+        elif self.placement.deterministic:
+            # Not placed by an earlier load, the placement decides
+            shard_id = self.placement.shard_for(user_id)
+            self.cache_route(user_id, shard_id)
+            return shard_id
         else:
             raise Exception(f"No shard mapping found for user_id={user_id}")
 
 
-    def insert_user_shard_mapping(self, user_id, shard_id):
-        cursor = self.lookup_conn.cursor()
+    def scatter_gather(self, query, params=None, order_by=None, descending=False, limit=None,
+                       fetch_size=1000, queue_size=4):
+        """
+        Run `query` on every shard at once and yield the rows as one globally ordered stream.
+        Each shard is read on its own thread with fetchmany into a bounded queue and the
+        streams are combined with a k-way heap merge on `order_by` (a column index or a key function),
+        stopping after `limit` rows. The query must already be ordered the same way and should carry
+        its own LIMIT, so each shard only returns its top K rows.
+        Per-shard times of the last call are kept in `self.shard_query_times` (until the shard's rows are all read)
+        and `self.shard_execute_times` (until execute() returned).
+        """
+        stop = threading.Event()
+        queues = {shard_id: queue.Queue(maxsize=queue_size) for shard_id in self.shards}
+        self.shard_query_times = {}
+        self.shard_execute_times = {}
+
+        def put(rows_queue, item):
+            while not stop.is_set():
+                try:
+                    rows_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read_shard(shard_id, pool, rows_queue):
+            start_time = time.perf_counter()
+            try:
+                with pool.connection() as conn:
+                    cursor = conn.cursor()
+                    try:
+                        cursor.execute(query, params)
+                        self.shard_execute_times[shard_id] = time.perf_counter() - start_time
+                        while True:
+                            rows = cursor.fetchmany(fetch_size)
+                            if not rows:
+                                break
+                            if not stop.is_set():
+                                put(rows_queue, rows)
+                            # After an early stop the rest is still read, so the connection stays usable
+                    finally:
+                        cursor.close()
+                put(rows_queue, None)
+            except Exception as e:
+                put(rows_queue, e)
+            finally:
+                self.shard_query_times[shard_id] = time.perf_counter() - start_time
+
+        def shard_rows(shard_id, rows_queue):
+            while True:
+                item = rows_queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise RuntimeError(f"Query failed on shard {shard_id}: {item}") from item
+                yield from item
+
+        if order_by is None:
+            key = None
+        elif callable(order_by):
+            key = order_by
+        else:
+            key = lambda row: row[order_by]
+
+        threads = [
+            threading.Thread(target=read_shard, args=(shard_id, pool, queues[shard_id]), daemon=True)
+            for shard_id, pool in self.shards.items()
+        ]
+        for thread in threads:
+            thread.start()
         try:
-            sql = "INSERT INTO user_shard (user_id, shard_id) VALUES (%s, %s)"
-            cursor.execute(sql, (user_id, shard_id))
-            self.lookup_conn.commit()
-        except mysql.connector.Error as e:
-            print(f"Error inserting shard mapping for user {user_id}: {e}")
-            raise
+            streams = [shard_rows(shard_id, rows_queue) for shard_id, rows_queue in queues.items()]
+            if key is None:
+                merged = itertools.chain.from_iterable(streams)
+            else:
+                merged = heapq.merge(*streams, key=key, reverse=descending)
+            yield from itertools.islice(merged, limit)
         finally:
-            cursor.close()
+            stop.set()
+            for thread in threads:
+                thread.join()
+
 
+    def route_cache_stats(self):
+        lookups = self.route_hits + self.route_misses
+        return {
+            "hits": self.route_hits,
+            "misses": self.route_misses,
+            "hit_rate": self.route_hits / lookups if lookups else 0.0,
+            "size": len(self.route_cache),
+            "max_size": self.route_cache_size,
+        }
 
-    def insert_generic(self, table, data, user_id=None):
+
+    def insert_user_shard_mapping(self, user_id, shard_id):
+        with self.lookup_pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                sql = "INSERT INTO user_shard (user_id, shard_id) VALUES (%s, %s)"
+                cursor.execute(sql, (user_id, shard_id))
+                conn.commit()
+                self.cache_route(user_id, shard_id)
+            except mysql.connector.Error as e:
+                print(f"Error inserting shard mapping for user {user_id}: {e}")
+                raise
+            finally:
+                cursor.close()
+
+
+    def insert_generic(self, table, data, user_id=None, shard_id=None):
         data = handle_missing_fields(table, data)
+        if shard_id is None:
+            shard_id = self.get_shard_for_user(user_id)
+        if self.feed is not None:
+            self.feed.observe(table, data)
+        self.write_row(shard_id, table, data)
+        # A user's devices and detections live on the user's shard, so its feed rows go there too
+        if self.feed is not None and table == detection_table:
+            self.write_row(shard_id, feed_table, self.feed.feed_row(data, self.feed_lookup(shard_id)))
+
+
+    def write_row(self, shard_id, table, data):
+        if self.writers:
+            self.writers[shard_id].add(table, data)
+            return
+
         keys = data.keys()
         columns = ", ".join(f"`{k}`" for k in keys)
         insert_values = ", ".join(["%s" for _ in keys])
         query = f"INSERT INTO {table} ({columns}) VALUES ({insert_values})"
+        with self.shards[shard_id].connection() as conn:
+            cursor = conn.cursor()
+            start_time = time.perf_counter()
+            try:
+                cursor.execute(query, list(data.values()))
+                conn.commit()
+                self.rows_written += 1
+                metrics.record_batch(table, [tuple(data.values())], time.perf_counter() - start_time)
+            except mysql.connector.Error as e:
+                metrics.record_error(table, e)
+                report_insert_error(table, data, e)
+            finally:
+                cursor.close()
 
-        if user_id:
-            shard_id = self.get_shard_for_user(user_id)
-            conn = self.shards[shard_id]
 
-        cursor = conn.cursor()
-        try:
-            cursor.execute(query, list(data.values()))
-            conn.commit()
-        except mysql.connector.Error as e:
-            print(f"MySQL insert error on table {table}: {e} with data: {data}")
-        finally:
-            cursor.close()
+    def start_feed(self):
+        """
+        Create the feed table on every shard and add a feed row for every detection from now on.
+        """
+        for pool in self.shards.values():
+            with pool.connection() as conn:
+                ensure_feed_table(conn)
+        self.feed = FeedDirectory()
+
+
+    def feed_lookup(self, shard_id):
+        # Rows staged for LOAD DATA are only in the shard after finish_writes, nothing to look up before that
+        if isinstance(self.writers.get(shard_id), TsvBulkLoader):
+            return None
+        return partial(self.shard_owner, shard_id)
+
+
+    def shard_owner(self, shard_id, device_id):
+        with self.shards[shard_id].connection() as conn:
+            return connection_lookup(conn)(device_id)
+
+
+    def start_batched_writes(self, batch_size=1000, commit_rows=10000, commit_interval_ms=1000):
+        """
+        Route insert_generic rows into a ShardWriter per shard instead of row-by-row INSERTs,
+        so all shards are written concurrently, each on its own thread and pooled connection.
+        """
+        self.writers = {
+            shard_id: ShardWriter(shard_id, pool, batch_size=batch_size, commit_rows=commit_rows,
+                                  commit_interval_ms=commit_interval_ms)
+            for shard_id, pool in self.shards.items()
+        }
+
+
+    def start_bulk_load(self, directory=None):
+        """
+        Route insert_generic rows into one set of TSV files per shard instead of INSERTs.
+        Shard connections must be opened with allow_local_infile=True.
+        """
+        # Each loader holds a connection until finish_writes, checked again before LOAD DATA
+        self.writers = {
+            shard_id: TsvBulkLoader(pool.acquire(), name=f"shard{shard_id}", directory=directory, pool=pool)
+            for shard_id, pool in self.shards.items()
+        }
+
+
+    def flush(self):
+        """
+        Drain the buffers of every shard writer, all shards at once, and report failures per shard.
+        Returns {shard_id: number of rows that failed}.
+        """
+        pending = []
+        for writer in self.writers.values():
+            if isinstance(writer, ShardWriter):
+                pending.append(writer.flush_async())
+            else:
+                writer.flush()
+        for done in pending:
+            done.wait()
+        if self.feed is not None:
+            self.feed.forget_missing()
+        return self.report_shard_failures()
+
+
+    def report_shard_failures(self):
+        failures = {}
+        for shard_id, writer in self.writers.items():
+            if not isinstance(writer, ShardWriter):
+                continue
+            failures[shard_id] = writer.failed_rows
+            if writer.error is not None:
+                print(f"Shard {shard_id} writer failed: {writer.error} ({writer.failed_rows} rows not written)")
+            elif writer.failed_rows:
+                print(f"Shard {shard_id}: {writer.failed_rows} rows failed, last error: {writer.last_failure}")
+        return failures
+
+
+    def writer_errors(self):
+        """
+        Shards whose writer lost its connection, {shard_id: error}.
+        """
+        return {
+            shard_id: writer.error
+            for shard_id, writer in self.writers.items()
+            if isinstance(writer, ShardWriter) and writer.error is not None
+        }
+
+
+    def finish_writes(self):
+        """
+        Flush or load everything the shard writers hold, all shards at once,
+        report per-shard failures and return the number of rows written.
+        """
+        if not self.writers:
+            return 0
+        with ThreadPoolExecutor(max_workers=len(self.writers)) as pool:
+            list(pool.map(lambda writer: writer.close(), self.writers.values()))
+        self.report_shard_failures()
+        rows = sum(writer.rows_written for writer in self.writers.values())
+        self.failed_loads = {
+            shard_id: writer.failed_tables
+            for shard_id, writer in self.writers.items()
+            if isinstance(writer, TsvBulkLoader) and writer.failed_tables
+        }
+        for shard_id, writer in self.writers.items():
+            if isinstance(writer, TsvBulkLoader) and writer.conn is not None:
+                self.shards[shard_id].release(writer.conn)
+        self.writers = {}
+        self.rows_written += rows
+        return rows
 
 
     def close(self):
-        self.lookup_cursor.close()
-        self.lookup_conn.close()
-        for conn in self.shards.values():
-            try:
-                conn.cursor().close()
-            except:
-                pass
-            conn.close()
+        self.finish_writes()
+        self.lookup_pool.close()
+        for pool in self.shards.values():
+            pool.close()
+
 
+    def report_pools(self):
+        self.lookup_pool.report()
+        for pool in self.shards.values():
+            pool.report()
 
-def insert_data_teams(sm: ShardManager, directory):
+
+def insert_data_teams(sm: ShardManager, directory, manifest):
     """
         Insert teams from json files in given directory to all shards.
     """    
     filepath = os.path.join(directory, "team_mapping.json")
     if not os.path.exists(filepath):
         return
+    start = manifest.start_file(filepath)
+    if start is None:
+        return
 
-    with open(filepath, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-        for entry in data.get("teams", []):
-            for shard_id, conn in sm.shards.items():
-                try:
-                    cursor = conn.cursor()
-                    data = handle_missing_fields("credocommon_team", entry)
-                    keys = data.keys()
-                    columns = ", ".join(keys)
-                    insert_values = ", ".join(["%s"] * len(keys))
-                    query = f"INSERT INTO credocommon_team ({columns}) VALUES ({insert_values})"
-                    cursor.execute(query, list(data.values()))
-                    conn.commit()
-                    cursor.close()
-                except Exception as e:
-                    print(f"Error inserting team {entry['id']} into shard {shard_id}: {e}")
+    index = 0
+    for index, (_, entry) in enumerate(iter_json_entries(filepath, {"teams"}), 1):
+        if index <= start:
+            continue
+        for shard_id in sm.shards:
+            try:
+                sm.insert_generic("credocommon_team", dict(entry), shard_id=shard_id)
+            except Exception as e:
+                print(f"Error inserting team {entry['id']} into shard {shard_id}: {e}")
+    manifest.mark(filepath, max(index, start), done=True)
 
 
-def insert_data_users(sm: ShardManager, directory):
+def insert_data_users(sm: ShardManager, directory, manifest):
     """
         Insert users from json files in given directory.
-        Users are split to shards based on round-robin assignment,
+        Users are split to shards by the shard manager's placement strategy, users an interrupted run
+        already placed keep their shard.
     """    
     user_mapping_path = os.path.join(directory, "user_mapping.json")
     if os.path.exists(user_mapping_path):
-        with open(user_mapping_path, "r", encoding="utf-8") as f:
-            user_json = json.load(f)
-            if "users" in user_json:
-                shard_ids = list(sm.shards.keys())
-                for i, entry in enumerate(user_json["users"]):
-                    try:
-                        user_id = entry["id"]
-                        shard_id = shard_ids[i % len(shard_ids)]
+        start = manifest.start_file(user_mapping_path)
+        if start is None:
+            return
+        index = 0
+        for index, (_, entry) in enumerate(iter_json_entries(user_mapping_path, {"users"}), 1):
+            if index <= start:
+                continue
+            try:
+                user_id = entry["id"]
+                shard_id = sm.stored_shard(user_id)
+                if shard_id is None:
+                    shard_id = sm.placement.shard_for(user_id)
+                    sm.insert_user_shard_mapping(user_id, shard_id)
 
-                        sm.insert_user_shard_mapping(user_id, shard_id)
+                user_info = {"id": user_id}
+                sm.insert_generic("credocommon_user_info", user_info, user_id=user_id)
+                sm.insert_generic("credocommon_user", entry, user_id=user_id)
+            except Exception as e:
+                print(f"Error inserting user {entry.get('id')}: {e}")
+        manifest.mark(user_mapping_path, max(index, start), done=True)
 
-                        user_info = {"id": user_id}
-                        sm.insert_generic("credocommon_user_info", user_info, user_id=user_id)
-                        sm.insert_generic("credocommon_user", entry, user_id=user_id)
-                    except Exception as e:
-                        print(f"Error inserting user {entry.get('id')}: {e}")
 
+def iter_user_ids(directory):
+    user_mapping_path = os.path.join(directory, "user_mapping.json")
+    if os.path.exists(user_mapping_path):
+        for _, entry in iter_json_entries(user_mapping_path, {"users"}):
+            yield entry["id"]
+
+
+def detection_info_for(entry):
+    return {
+        "id": entry["id"],
+        "accuracy": entry["accuracy"],
+        "altitude": entry["altitude"],
+        "height": entry["height"],
+        "width": entry["width"],
+        "latitude": entry["latitude"],
+        "longitude": entry["longitude"],
+        "provider": entry["provider"],
+        "source": entry["source"],
+        "x": entry["x"],
+        "y": entry["y"],
+        "metadata": entry["metadata"]
+    }
+
+
+def entry_to_rows(table_name, entry):
+    """
+        Build the rows for one json entry as (table, data, user_id) triples, user_id picks the shard
+    """
+    rows = []
+    if table_name == "credocommon_device":
+        device_info = {
+            "id": entry["id"],
+            "device_identifier": entry["id"],
+            "device_type": entry["device_type"],
+            "device_model": entry["device_model"],
+            "user_id":  entry["user_id"]
+        }
+        device_version = {
+            "id": entry["id"],
+            "device_id": entry["id"],
+            "system_version": entry["system_version"],
+            "recorded_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        rows.append((table_name, device_info, entry["user_id"]))
+        rows.append((f"{table_name}_version", device_version, entry["user_id"]))
+    elif table_name == "credocommon_detection":
+        detection_info = detection_info_for(entry)
+        detection_main = {
+            "id": entry["id"],
+            "frame_content": decode_frame(entry["frame_content"]) if frame_binary else entry["frame_content"],
+            "timestamp": datetime.fromtimestamp(entry["timestamp"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
+            "time_received": datetime.fromtimestamp(entry["time_received"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
+            "visible": entry["visible"],
+            "device_id": entry["device_id"],
+        }
+        user_id_for_shard = entry["user_id"]
+        rows.append((f"{table_name}_info", detection_info, user_id_for_shard))
+        rows.append((table_name, detection_main, user_id_for_shard))
+    elif table_name == "credocommon_ping":
+        ping_info = {
+            "id": entry["id"],
+            "timestamp": datetime.fromtimestamp(entry["timestamp"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
+            "delta_time": entry["delta_time"],
+            "device_id": entry["device_id"],
+            "on_time": entry["on_time"],
+            "time_received": datetime.fromtimestamp(entry["time_received"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
+            "metadata": entry["metadata"],
+        }
+        rows.append((table_name, ping_info, entry["user_id"]))
+    return rows
 
 
-def insert_data(sm: ShardManager, directory):
+def save_checkpoint(sm: ShardManager, manifest, images=None):
+    """
+    Flush and commit every shard and wait for the image store to write and sync the frames of those rows,
+    then save the progress recorded in the manifest.
+    Nothing is saved while a shard writer is down, and LOAD DATA only commits
+    once the staged files are loaded, main saves the manifest after that.
+    """
+    sm.flush()
+    if load_mode == "load_data" or sm.writer_errors():
+        return
+    if images is not None:
+        images.flush()
+    manifest.save()
+
+
+def insert_data(sm: ShardManager, directory, manifest):
     """
         Insert data from json files in given directory to rest of the tables.
+        Files the manifest marks as loaded are skipped, partly loaded ones resume after the last checkpoint
     """    
-    for filename in os.listdir(directory):
+    for filename in sorted(os.listdir(directory)):
         if not filename.endswith(".json") or filename == "user_mapping.json" or filename == "team_mapping.json":
             continue
         filepath = os.path.join(directory, filename)
-        with open(filepath, "r", encoding="utf-8") as file:
-            json_data = json.load(file)
+        start = manifest.start_file(filepath)
+        if start is None:
+            print(f"{filename}: already loaded, skipped")
+            continue
+        rows = 0
+        index = 0
+        start_time = time.perf_counter()
+        for index, (key, entry) in enumerate(iter_json_entries(filepath, table_mapping), 1):
+            if index <= start:
+                continue
+            table_name = table_mapping[key]
+            rows += 1
+            try:
+                for table, data, user_id in entry_to_rows(table_name, entry):
+                    sm.insert_generic(table, data, user_id=user_id)
+            except Exception as e:
+                print(f"Error inserting data into {table_name}: {e}")
+            if index % checkpoint_every == 0:
+                manifest.mark(filepath, index)
+                save_checkpoint(sm, manifest)
+        manifest.mark(filepath, max(index, start), done=True)
+        save_checkpoint(sm, manifest)
+        report_file(filename, rows, time.perf_counter() - start_time)
 
-            for key, table_name in table_mapping.items():
-                if key not in json_data:
-                    continue
-                for entry in json_data[key]:
-                    try:
-                        if table_name == "credocommon_device":
-                            device_info = {
-                                "id": entry["id"],
-                                "device_identifier": entry["id"],
-                                "device_type": entry["device_type"],
-                                "device_model": entry["device_model"],
-                                "user_id":  entry["user_id"]
-                            }
-                            device_version = {
-                                "id": entry["id"],
-                                "device_id": entry["id"],
-                                "system_version": entry["system_version"],
-                                "recorded_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                            }
-                            sm.insert_generic(table_name, device_info, user_id=entry["user_id"])
-                            sm.insert_generic(f"{table_name}_version", device_version, user_id=entry["user_id"])
-                        elif table_name == "credocommon_detection":
-                            detection_info = {
-                                "id": entry["id"],
-                                "accuracy": entry["accuracy"],
-                                "altitude": entry["altitude"],
-                                "height": entry["height"],
-                                "width": entry["width"],
-                                "latitude": entry["latitude"],
-                                "longitude": entry["longitude"],
-                                "provider": entry["provider"],
-                                "source": entry["source"],
-                                "x": entry["x"],
-                                "y": entry["y"],
-                                "metadata": entry["metadata"]
-                            }
-                            detection_main = {
-                                "id": entry["id"],
-                                "frame_content": entry["frame_content"],
-                                "timestamp": datetime.fromtimestamp(entry["timestamp"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
-                                "time_received": datetime.fromtimestamp(entry["time_received"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
-                                "visible": entry["visible"],
-                                "device_id": entry["device_id"],
-                            }
-                            user_id_for_shard = entry["user_id"]
-                            sm.insert_generic(f"{table_name}_info", 
-                            detection_info, user_id=user_id_for_shard)
-                            sm.insert_generic(table_name, detection_main, user_id=user_id_for_shard)
-                        elif table_name == "credocommon_ping":
-                            ping_info = {
-                                "id": entry["id"],
-                                "timestamp": datetime.fromtimestamp(entry["timestamp"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
-                                "delta_time": entry["delta_time"],
-                                "device_id": entry["device_id"],
-                                "on_time": entry["on_time"],
-                                "time_received": datetime.fromtimestamp(entry["time_received"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
-                                "metadata": entry["metadata"],
-                            }
-                            sm.insert_generic(table_name, ping_info, user_id=entry["user_id"])
-                    except Exception as e:
-                        print(f"Error inserting data into {table_name}: {e}")
+
+def load_directory(sm: ShardManager, directory, manifest):
+    """
+        Insert a directory, parsing files on PARSE_WORKERS processes when it is set.
+        The parsed rows go to the shard writers from this process.
+        With parse workers files are checkpointed once complete, the commit happens at the end of the directory
+    """
+    if parse_workers > 0:
+        parallel_insert(directory, table_mapping, entry_to_rows, sm.insert_generic,
+                        workers=parse_workers, queue_size=parse_queue_size, batch_rows=batch_size,
+                        skip_files=("user_mapping.json", "team_mapping.json"),
+                        resume=manifest.start_file, on_file=manifest.mark)
+        save_checkpoint(sm, manifest)
+    else:
+        insert_data(sm, directory, manifest)
 
 
-def save_image_from_blob(blob_data, detection_id, output_dir="images"):
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    image_path = os.path.join(output_dir, f"detection_{detection_id}.jpg")
-    with open(image_path, "wb") as f:
-        f.write(base64.b64decode(blob_data))
-    return image_path
+def create_image_store(output_dir=None):
+    """
+        Pick where detection frames go for the configured FRAME_STORE
+    """
+    if frame_store == "pack":
+        return FramePack(output_dir, dedup=frame_dedup) if output_dir else FramePack(dedup=frame_dedup)
+    return ImageWriter(output_dir or image_directory, workers=image_workers, queue_size=image_queue_size,
+                       fsync_batch=image_fsync_batch, dedup=frame_dedup)
 
 
-def process_sharded_detection_entry(entry, sm: ShardManager, output_dir="images"):
+def process_sharded_detection_entry(entry, sm: ShardManager, images, pending):
     """
     Process a single detection entry:
-    - Saves image from BLOB
+    - Queues the BLOB to be written as an image file
     - Prepares detection record
-    - Inserts into sharded DB
+    - Inserts into sharded DB once the image path is known
     """
-    image_path = save_image_from_blob(entry["frame_content"], entry["id"], output_dir)
-
     detection_main = {
         "id": entry["id"],
-        "frame_path": image_path,
+        "frame_path": None,
         "timestamp": datetime.fromtimestamp(entry["timestamp"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
         "time_received": datetime.fromtimestamp(entry["time_received"] / 1000).strftime('%Y-%m-%d %H:%M:%S'),
         "visible": entry["visible"],
@@ -306,33 +1008,59 @@ def process_sharded_detection_entry(entry, sm: ShardManager, output_dir="images"
         "detection_info_id": entry["id"]
     }
 
-    sm.insert_generic("credocommon_detection_v2", detection_main, user_id=entry["user_id"])
+    # A deduplicated frame is named by its hash, the row goes in once an image worker computed it
+    sm.insert_generic("credocommon_detection_info", detection_info_for(entry), user_id=entry["user_id"])
+    pending.add(images.submit(entry["id"], entry["frame_content"]),
+                lambda image_path: sm.insert_generic(detection_v2_table, dict(detection_main, frame_path=image_path),
+                                                     user_id=entry["user_id"]))
 
 
-def insert_detections_with_paths_sharded(sm: ShardManager, directory, image_dir="images"):
+def insert_detections_with_paths_sharded(sm: ShardManager, directory, manifest, image_dir=None):
     """
     Reads all JSON files and processes detection entries for sharded DB.
-    Converts BLOBs to images and saves them locally.
+    Converts BLOBs to images and saves them locally, as files or into a frame pack.
+    Files the manifest marks as loaded are skipped, partly loaded ones resume after the last checkpoint
     """
-    for filename in os.listdir(directory):
+    images = create_image_store(image_dir)
+    pending = PendingRows(image_queue_size)
+    for filename in sorted(os.listdir(directory)):
         if not filename.endswith(".json"):
             continue
 
         filepath = os.path.join(directory, filename)
-        with open(filepath, "r", encoding="utf-8") as file:
-            json_data = json.load(file)
-
-        if "detections" not in json_data:
+        start = manifest.start_file(filepath)
+        if start is None:
+            print(f"{filename}: already loaded, skipped")
             continue
-
-        for entry in json_data["detections"]:
+        rows = 0
+        index = 0
+        start_time = time.perf_counter()
+        for index, (_, entry) in enumerate(iter_json_entries(filepath, {"detections"}), 1):
+            if index <= start:
+                continue
+            rows += 1
             try:
-                process_sharded_detection_entry(entry, sm, image_dir)
+                process_sharded_detection_entry(entry, sm, images, pending)
             except Exception as e:
                 print(f"Error processing detection {entry.get('id')}: {e}")
+            if index % checkpoint_every == 0:
+                pending.flush()
+                manifest.mark(filepath, index)
+                save_checkpoint(sm, manifest, images)
+        pending.flush()
+        manifest.mark(filepath, max(index, start), done=True)
+        save_checkpoint(sm, manifest, images)
+        report_file(filename, rows, time.perf_counter() - start_time)
+    images.close()
 
 
 def main():
+    if detection_feed and frame_store != "inline":
+        # The feed pages credocommon_detection, files and pack load detections into credocommon_detection_v2 instead
+        sys.exit(f"❌ DETECTION_FEED=1 needs FRAME_STORE=inline, with FRAME_STORE={frame_store} the feed would stay empty")
+    if frame_dedup and frame_store == "inline":
+        # credocommon_frame and the frame_hash column only exist on SQLite, every detection would keep its own blob
+        sys.exit("❌ FRAME_DEDUP=1 needs FRAME_STORE=files or pack here, inline frames are only deduplicated on SQLite")
     lookup_db_config = {
         'host': os.getenv("MYSQL_HOST"),
         'port': os.getenv("MYSQL_LOOKUP_PORT"),
@@ -347,20 +1075,63 @@ def main():
         3: {'host': os.getenv("MYSQL_HOST"), 'port': os.getenv("MYSQL_SHARD3_PORT"), 'user': os.getenv("MYSQL_USER"), 'password': os.getenv("MYSQL_PASSWORD"), 'database': os.getenv("MYSQL_SHARD3_DB")},
         4: {'host': os.getenv("MYSQL_HOST"), 'port': os.getenv("MYSQL_SHARD4_PORT"), 'user': os.getenv("MYSQL_USER"), 'password': os.getenv("MYSQL_PASSWORD"), 'database': os.getenv("MYSQL_SHARD4_DB")},
     }
-    sm = ShardManager(lookup_db_config, shard_db_configs)
+    if load_mode == "load_data":
+        for config in shard_db_configs.values():
+            config['allow_local_infile'] = True
+    instrumentation = start_instrumentation("shards")
+    placement = create_placement(shard_db_configs)
+    sm = ShardManager(lookup_db_config, shard_db_configs, route_cache_size=route_cache_size, placement=placement,
+                      pool_size=pool_size)
+    manifest = manifest_for(checkpoint_directory, f"shards_{lookup_db_config['host']}_{lookup_db_config['port']}_{lookup_db_config['database']}")
+    start_time = time.perf_counter()
+    if load_mode == "load_data":
+        sm.start_bulk_load(bulk_load_directory)
+    elif group_commit_rows > 0:
+        sm.start_batched_writes(batch_size, group_commit_rows, group_commit_ms)
+    if detection_feed:
+        sm.start_feed()
+    if frame_store != "inline":
+        for pool in sm.shards.values():
+            with pool.connection() as conn:
+                ensure_detection_v2_table(conn)
 
-    insert_data_teams(sm, json_directory)
+    insert_data_teams(sm, json_directory, manifest)
+    save_checkpoint(sm, manifest)
     print("finished teams")
-    insert_data_users(sm, json_directory)
+    insert_data_users(sm, json_directory, manifest)
+    save_checkpoint(sm, manifest)
     print("finished users")
-    insert_data(sm, json_directory)
+    load_directory(sm, json_directory, manifest)
     print("finished rest")
-    insert_data(sm, detections_directory)
+    if frame_store == "inline":
+        load_directory(sm, detections_directory, manifest)
+    else:
+        # Frames go to the image store from this process, PARSE_WORKERS does not apply here
+        insert_detections_with_paths_sharded(sm, detections_directory, manifest)
     print("finished detections")
-    insert_data(sm, pings_directory)
+    load_directory(sm, pings_directory, manifest)
     print("finished pings")
 
+    writer_errors = sm.writer_errors()
+    sm.finish_writes()
+    # Files of a failed shard or table are not marked as loaded, the next run loads them again
+    if not writer_errors and not sm.failed_loads:
+        manifest.save()
+    elapsed = time.perf_counter() - start_time
+    rate = sm.rows_written / elapsed if elapsed > 0 else 0.0
+    print(f"{load_mode}: {sm.rows_written} rows in {elapsed:.2f}s ({rate:.0f} rows/s)")
+    stats = sm.route_cache_stats()
+    print(f"shard routing: {stats['hits']} cache hits, {stats['misses']} cache misses, {stats['size']} routes cached")
+    sm.report_pools()
+    if sm.feed:
+        sm.feed.report("shards")
+
+    if isinstance(placement, ConsistentHashRing):
+        report_shard_moves(placement, iter_user_ids(json_directory), added=[max(shard_db_configs) + 1])
+        report_shard_moves(placement, iter_user_ids(json_directory), removed=[max(shard_db_configs)])
+
     sm.close()
+    instrumentation.stop()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,19 @@
 import os
-import json
 import sqlite3
 import random
+import time
 from dotenv import load_dotenv
 from datetime import datetime
+from functools import partial
+from json_stream import iter_json_entries, report_file
+from batch_writer import BatchWriter
+from parallel_ingest import parallel_insert
+from checkpoint import manifest_for
+from sqlite_bulk import SQLiteBulkLoad
+from frame_dedup import FrameDeduplicator, FrameDedupWriter, ensure_frame_table
+from frame_binary import decode_frame
+from detection_feed import FeedWriter, ensure_feed_table
+from loader_metrics import metrics, start_instrumentation
 
 
 load_dotenv()
@@ -11,6 +21,23 @@ load_dotenv()
 # SQLite database file
 db_file_opt = os.getenv("DB_FILE_OPT")
 json_directory = os.getenv("JSON_DIRECTORY")
+batch_size = int(os.getenv("BATCH_SIZE", "1000"))
+# Parse files on this many worker processes, 0 parses in the main process
+parse_workers = int(os.getenv("PARSE_WORKERS", "0"))
+parse_queue_size = int(os.getenv("PARSE_QUEUE_SIZE", "16"))
+# Manifests of loaded files are kept here so a re-run resumes, empty loads everything again
+checkpoint_directory = os.getenv("CHECKPOINT_DIRECTORY", "")
+# Commit and checkpoint every N entries inside a file
+checkpoint_every = int(os.getenv("CHECKPOINT_EVERY", "50000"))
+# Bulk-load mode: load-time pragmas, secondary indexes dropped and rebuilt after the load, then ANALYZE
+sqlite_bulk_load = os.getenv("SQLITE_BULK_LOAD", "0") == "1"
+sqlite_cache_mb = int(os.getenv("SQLITE_CACHE_MB", "256"))
+# Store identical detection frames once in credocommon_frame, detections reference them by frame_hash
+frame_dedup = os.getenv("FRAME_DEDUP", "0") == "1"
+# Decode base64 frames and store raw bytes in the frame_content blob
+frame_binary = os.getenv("FRAME_BINARY", "0") == "1"
+# Maintain credocommon_detection_feed (detections with their user and team names, keyed by timestamp) while loading
+detection_feed = os.getenv("DETECTION_FEED", "0") == "1"
 
 # Mapping JSON keys to table names
 table_mapping = {
@@ -87,101 +114,173 @@ def handle_missing_fields(table, data):
     return data
 
 
-def json_to_insert(table, data, cursor):
+def report_insert_error(table, data, e):
+    if isinstance(e, sqlite3.IntegrityError):
+        print(f"IntegrityError for table {table}: {e}  ;  {data.get('id')}")
+    else:
+        print(f"Error inserting data into {table}: {e}")
+
+
+def json_to_insert(table, data, writer):
     """
-        Insert data into table
+        Queue data for insertion into table
     """
     data = handle_missing_fields(table, data)
-    
-    keys = data.keys()
-    columns = ", ".join(keys)
-    insert_values = ", ".join(["?" for _ in keys])
-    query = f"INSERT INTO {table} ({columns}) VALUES ({insert_values})"
-    cursor.execute(query, list(data.values()))
+    writer.add(table, data)
+
+
+def entry_to_rows(table_name, entry):
+    """
+        Build the rows for one json entry as (table, data) pairs
+    """
+    rows = []
+    if table_name == "credocommon_user":
+        user_info = {
+            "id": entry["id"],
+        }
+        rows.append((f"{table_name}_info", user_info))
+        rows.append((table_name, entry))
+    elif table_name == "credocommon_device":
+        device_info = {
+            "id": entry["id"],
+            "device_identifier": entry["id"],
+            "device_type": entry["device_type"],
+            "device_model": entry["device_model"],
+            "user_id":  entry["user_id"]
+        }
+        device_version = {
+            "id": entry["id"],
+            "device_id": entry["id"],
+            "system_version": entry["system_version"],
+            "recorded_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        rows.append((table_name, device_info))
+        rows.append((f"{table_name}_version", device_version))
+    elif table_name == "credocommon_detection":
+        detection_info = {
+            "id": entry["id"],
+            "accuracy": entry["accuracy"],
+            "altitude": entry["altitude"],
+            "height": entry["height"],
+            "width": entry["width"],
+            "latitude": entry["latitude"],
+            "longitude": entry["longitude"],
+            "provider": entry["provider"],
+            "source": entry["source"],
+            "x": entry["x"],
+            "y": entry["y"],
+            "metadata": entry["metadata"]
+        }
+        detection_main = {
+            "id": entry["id"],
+            "frame_content": decode_frame(entry["frame_content"]) if frame_binary else entry["frame_content"],
+            "timestamp": entry["timestamp"],
+            "time_received": entry["time_received"],
+            "visible": entry["visible"],
+            "device_id": entry["device_id"],
+        }
+        rows.append((f"{table_name}_info", detection_info))
+        rows.append((table_name, detection_main))
+    else:
+        rows.append((table_name, entry))
+    return rows
 
 
-def insert_data(directory, cursor):
+def save_checkpoint(writer, manifest):
+    """
+        Commit everything written so far, then save the progress recorded in the manifest
+    """
+    writer.flush()
+    with metrics.timer("all", "commit"):
+        writer.conn.commit()
+    manifest.save()
+
+
+def insert_data(directory, writer, manifest):
     """
         Insert data from json files in given directory
         change the line in insert for the sqlite - mysql
+        Files the manifest marks as loaded are skipped, partly loaded ones resume after the last checkpoint
     """
-    for filename in os.listdir(directory):
+    for filename in sorted(os.listdir(directory)):
         if not filename.endswith(".json"):
             continue
         filepath = os.path.join(directory, filename)
-        with open(filepath, "r", encoding="utf-8") as file:
-            json_data = json.load(file)
-
-            for key, table_name in table_mapping.items():
-                if key not in json_data:
-                    continue
-                for entry in json_data[key]:
-                    try:
-                        if table_name == "credocommon_user":
-                            user_info = {
-                                "id": entry["id"],
-                            }
-                            json_to_insert(f"{table_name}_info" , user_info, cursor)
-                            json_to_insert(table_name, entry, cursor)
-                        elif table_name == "credocommon_device":
-                            device_info = {
-                                "id": entry["id"],
-                                "device_identifier": entry["id"],
-                                "device_type": entry["device_type"],
-                                "device_model": entry["device_model"],
-                                "user_id":  entry["user_id"]
-                            }
-                            device_version = {
-                                "id": entry["id"],
-                                "device_id": entry["id"],
-                                "system_version": entry["system_version"],
-                                "recorded_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                            }
-                            json_to_insert(table_name, device_info, cursor)
-                            json_to_insert(f"{table_name}_version", device_version, cursor)
-                        elif table_name == "credocommon_detection":
-                            detection_info = {
-                                "id": entry["id"],
-                                "accuracy": entry["accuracy"],
-                                "altitude": entry["altitude"],
-                                "height": entry["height"],
-                                "width": entry["width"],
-                                "latitude": entry["latitude"],
-                                "longitude": entry["longitude"],
-                                "provider": entry["provider"],
-                                "source": entry["source"],
-                                "x": entry["x"],
-                                "y": entry["y"],
-                                "metadata": entry["metadata"]
-                            }
-                            detection_main = {
-                                "id": entry["id"],
-                                "frame_content": entry["frame_content"],
-                                "timestamp": entry["timestamp"],
-                                "time_received": entry["time_received"],
-                                "visible": entry["visible"],
-                                "device_id": entry["device_id"],
-                            }
-                            json_to_insert(f"{table_name}_info", detection_info, cursor)
-                            json_to_insert(table_name, detection_main, cursor)
-                        else:
-                            json_to_insert(table_name, entry, cursor)
-                    except sqlite3.IntegrityError as e:
-                        print(f"IntegrityError for table {table_name}: {e}  ;  {entry["id"]}")
-                    except Exception as e:
-                        print(f"Error inserting data into {table_name}: {e}")
+        start = manifest.start_file(filepath)
+        if start is None:
+            print(f"{filename}: already loaded, skipped")
+            continue
+        rows = 0
+        index = 0
+        start_time = time.perf_counter()
+        for index, (key, entry) in enumerate(iter_json_entries(filepath, table_mapping), 1):
+            if index <= start:
+                continue
+            table_name = table_mapping[key]
+            rows += 1
+            try:
+                for table, data in entry_to_rows(table_name, entry):
+                    json_to_insert(table, data, writer)
+            except Exception as e:
+                print(f"Error inserting data into {table_name}: {e}")
+            if index % checkpoint_every == 0:
+                manifest.mark(filepath, index)
+                save_checkpoint(writer, manifest)
+        manifest.mark(filepath, max(index, start), done=True)
+        save_checkpoint(writer, manifest)
+        report_file(filename, rows, time.perf_counter() - start_time)
+
+
+def load_directory(directory, writer, manifest):
+    """
+        Insert a directory, parsing files on PARSE_WORKERS processes when it is set
+        With parse workers files are checkpointed once complete, the commit happens at the end of the directory
+    """
+    if parse_workers > 0:
+        parallel_insert(directory, table_mapping, entry_to_rows, partial(json_to_insert, writer=writer),
+                        workers=parse_workers, queue_size=parse_queue_size, batch_rows=batch_size,
+                        resume=manifest.start_file, on_file=manifest.mark)
+        save_checkpoint(writer, manifest)
+    else:
+        insert_data(directory, writer, manifest)
 
 
 def main():
+    instrumentation = start_instrumentation("sqlite_opt")
     conn = sqlite3.connect(db_file_opt)
-    cursor = conn.cursor()
+    bulk_load = SQLiteBulkLoad(conn, cache_mb=sqlite_cache_mb, name=db_file_opt) if sqlite_bulk_load else None
+    if bulk_load:
+        bulk_load.begin()
+    start_time = time.perf_counter()
+    writer = BatchWriter(conn, batch_size=batch_size, on_error=report_insert_error)
+    frames = None
+    if frame_dedup:
+        # Adds credocommon_frame and the frame_hash column, a load without FRAME_DEDUP leaves the schema as it is
+        known_hashes = ensure_frame_table(conn)
+        writer = frames = FrameDedupWriter(writer, FrameDeduplicator(known_hashes))
+    feed = None
+    if detection_feed:
+        ensure_feed_table(conn)
+        writer = feed = FeedWriter(writer)
+    manifest = manifest_for(checkpoint_directory, db_file_opt)
 
-    insert_data(json_directory, cursor)
-    insert_data(detections_directory, cursor)
-    insert_data(pings_directory, cursor)
+    load_directory(json_directory, writer, manifest)
+    load_directory(detections_directory, writer, manifest)
+    load_directory(pings_directory, writer, manifest)
 
+    writer.close()
     conn.commit()
+    if bulk_load:
+        bulk_load.finish()
+    if frames:
+        frames.report(db_file_opt)
+    if feed:
+        feed.directory.report(db_file_opt)
+    elapsed = time.perf_counter() - start_time
+    rate = writer.rows_written / elapsed if elapsed > 0 else 0.0
+    print(f"{writer.rows_written} rows in {elapsed:.2f}s ({rate:.0f} rows/s)")
     conn.close()
+    instrumentation.stop()
 
 
 if __name__ == "__main__":
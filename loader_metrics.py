@@ -0,0 +1,303 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# Counters and latency histograms per table, 0 turns them off
+loader_metrics = os.getenv("LOADER_METRICS", "1") == "1"
+metrics_directory = os.getenv("METRICS_DIRECTORY", "metrics")
+# Append a snapshot to METRICS_DIRECTORY/<loader>.jsonl every N seconds, 0 only writes the final one
+metrics_interval = float(os.getenv("METRICS_INTERVAL", "30"))
+# "cprofile" (deterministic, writes <loader>.prof) or "sample" (stack sampling, writes <loader>.folded), empty is off
+loader_profile = os.getenv("LOADER_PROFILE", "")
+profile_interval_ms = float(os.getenv("PROFILE_INTERVAL_MS", "10"))
+
+
+def value_bytes(rows):
+    """
+    Bytes of the text and blob values of a batch, numbers count 8 bytes.
+    """
+    size = 0
+    for row in rows:
+        for value in row:
+            if isinstance(value, (str, bytes, bytearray)):
+                size += len(value)
+            elif value is not None:
+                size += 8
+    return size
+
+
+class Histogram:
+    """
+    Latency histogram with power-of-two microsecond buckets, cheap enough for every batch.
+    """
+    def __init__(self):
+        self.buckets = [0] * 32
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def observe(self, seconds):
+        self.buckets[min(int(seconds * 1e6).bit_length(), 31)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket holding the p-th percentile, in seconds.
+        """
+        target = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return min((1 << i) / 1e6, self.max)
+        return self.max
+
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+            "buckets_us": {f"<{1 << i}": n for i, n in enumerate(self.buckets) if n},
+        }
+
+
+class LoaderMetrics:
+    """
+    Thread-safe counters and latency histograms keyed by table.
+    Counters: inserts, bytes, errors, integrity_errors, shard lookup hits/misses...
+    Histograms: batch insert, commit and shard lookup latencies.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = defaultdict(Counter)
+        self.histograms = defaultdict(dict)
+
+
+    def count(self, table, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[table][name] += n
+
+
+    def observe(self, table, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms[table].get(name)
+            if histogram is None:
+                histogram = self.histograms[table][name] = Histogram()
+            histogram.observe(seconds)
+
+
+    @contextmanager
+    def timer(self, table, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(table, name, time.perf_counter() - start_time)
+
+
+    def record_batch(self, table, rows, seconds, size=None):
+        """
+        One successful batch insert of `rows` (a list of row tuples, or a row count when `size` is given).
+        """
+        if not self.enabled:
+            return
+        if size is None:
+            size = value_bytes(rows)
+            rows = len(rows)
+        with self.lock:
+            counters = self.counters[table]
+            counters["inserts"] += rows
+            counters["bytes"] += size
+            counters["batches"] += 1
+            histogram = self.histograms[table].get("batch")
+            if histogram is None:
+                histogram = self.histograms[table]["batch"] = Histogram()
+            histogram.observe(seconds)
+
+
+    def record_error(self, table, error):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[table]["errors"] += 1
+            if type(error).__name__ == "IntegrityError":
+                self.counters[table]["integrity_errors"] += 1
+
+
+    def snapshot(self):
+        with self.lock:
+            tables = sorted(set(self.counters) | set(self.histograms))
+            return {
+                table: {
+                    **self.counters.get(table, {}),
+                    "latency": {name: h.snapshot() for name, h in self.histograms.get(table, {}).items()},
+                }
+                for table in tables
+            }
+
+
+metrics = LoaderMetrics(enabled=loader_metrics)
+
+
+instrumentation_threads = {"sampling-profiler", "metrics-snapshots"}
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every other thread each `interval` seconds and counts them in folded form
+    ("file:function;file:function ..."), which flamegraph.pl and speedscope read directly.
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+
+
+    def start(self):
+        self.thread.start()
+
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            # The profiler and the snapshot writer only wait, leave them out
+            skip = {thread.ident for thread in threading.enumerate() if thread.name in instrumentation_threads}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in skip:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+
+    def stop(self, path):
+        self.stop_event.set()
+        self.thread.join()
+        with open(path, "w", encoding="utf-8") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        total = sum(leaves.values()) or 1
+        print(f"sampling profile: {self.samples} samples written to {path}, top functions:")
+        for function, count in leaves.most_common(15):
+            print(f"   {count / total * 100:5.1f}%  {function}")
+
+
+class Instrumentation:
+    """
+    Per-run instrumentation of a loader: periodic metrics snapshots and the optional profiler.
+    Start it at the beginning of main() and stop() it at the end.
+    """
+    def __init__(self, name, directory=metrics_directory, interval=metrics_interval, profile=loader_profile):
+        self.name = name
+        self.directory = directory
+        self.interval = interval
+        self.profile = profile
+        self.start_time = time.time()
+        self.stop_event = threading.Event()
+        self.snapshot_thread = None
+        self.profiler = None
+        os.makedirs(directory, exist_ok=True)
+
+        if metrics.enabled and interval > 0:
+            self.snapshot_thread = threading.Thread(target=self.run, name="metrics-snapshots", daemon=True)
+            self.snapshot_thread.start()
+        if profile == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif profile == "sample":
+            self.profiler = SamplingProfiler(profile_interval_ms / 1000)
+            self.profiler.start()
+        elif profile:
+            print(f"Unknown LOADER_PROFILE {profile!r}, profiling is off")
+
+
+    def path(self, extension):
+        return os.path.join(self.directory, f"{self.name}.{extension}")
+
+
+    def write_snapshot(self, final=False):
+        snapshot = {
+            "loader": self.name,
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "elapsed": time.time() - self.start_time,
+            "final": final,
+            "tables": metrics.snapshot(),
+        }
+        with open(self.path("jsonl"), "a", encoding="utf-8") as file:
+            file.write(json.dumps(snapshot) + "\n")
+        return snapshot
+
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.write_snapshot()
+            except OSError as e:
+                print(f"Error writing metrics snapshot: {e}")
+
+
+    def stop(self):
+        self.stop_event.set()
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+        if isinstance(self.profiler, cProfile.Profile):
+            self.profiler.disable()
+            self.profiler.dump_stats(self.path("prof"))
+            output = io.StringIO()
+            pstats.Stats(self.profiler, stream=output).sort_stats("cumulative").print_stats(15)
+            print(f"cProfile written to {self.path('prof')}")
+            print(output.getvalue())
+        elif isinstance(self.profiler, SamplingProfiler):
+            self.profiler.stop(self.path("folded"))
+        if metrics.enabled:
+            report(self.write_snapshot(final=True))
+            print(f"metrics snapshots written to {self.path('jsonl')}")
+
+
+def start_instrumentation(name):
+    return Instrumentation(name)
+
+
+def report(snapshot):
+    """
+    Print the per-table counters and batch latency percentiles of a snapshot.
+    """
+    for table, stats in snapshot["tables"].items():
+        counters = ", ".join(f"{name} {value}" for name, value in stats.items() if name != "latency")
+        latencies = ", ".join(
+            f"{name} p50 {h['p50'] * 1000:.2f} ms p99 {h['p99'] * 1000:.2f} ms" for name, h in stats["latency"].items()
+        )
+        print(f"   {table}: {counters}{'; ' if counters and latencies else ''}{latencies}")
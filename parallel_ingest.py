@@ -0,0 +1,131 @@
+import os
+import queue
+import time
+import multiprocessing
+from json_stream import iter_json_entries, peak_rss_mb, report_file
+
+
+def parse_worker(tasks, results, table_mapping, entry_to_rows, batch_rows):
+    """
+    Worker process: parse and transform files from `tasks` into row batches.
+    Tasks are (filepath, start) pairs, the first `start` entries of the file are skipped.
+    Puts ("rows", batch), ("file", filepath, entries, total_entries, done, seconds, peak_rss) and finally ("exit", pid)
+    on `results`. total_entries counts the file's entries whose rows were sent, done is False when the file could not
+    be parsed to the end. `results` is bounded, so a worker blocks while the writer is behind.
+    """
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        filepath, start = task
+        filename = os.path.basename(filepath)
+        entries = 0
+        index = 0
+        failed = False
+        start_time = time.perf_counter()
+        batch = []
+        try:
+            for index, (key, entry) in enumerate(iter_json_entries(filepath, table_mapping), 1):
+                if index <= start:
+                    continue
+                table_name = table_mapping[key]
+                entries += 1
+                try:
+                    batch.extend(entry_to_rows(table_name, entry))
+                except Exception as e:
+                    print(f"Error inserting data into {table_name}: {e}")
+                if len(batch) >= batch_rows:
+                    results.put(("rows", batch))
+                    batch = []
+        except Exception as e:
+            print(f"Error parsing {filename}: {e}")
+            failed = True
+        if batch:
+            results.put(("rows", batch))
+        # A file that failed to parse is not reported as complete, but the entries before the error were sent
+        results.put(("file", filepath, entries, max(index, start), not failed, time.perf_counter() - start_time,
+                     peak_rss_mb()))
+    results.put(("exit", os.getpid()))
+
+
+def parallel_insert(directory, table_mapping, entry_to_rows, sink, workers=None, queue_size=16,
+                    batch_rows=1000, skip_files=(), resume=None, on_file=None, poll_interval=1.0):
+    """
+    Parse the .json files of a directory on a process pool and feed the rows to a single writer.
+    `entry_to_rows` must be a module-level function so it can be sent to the workers.
+    Every row tuple it returns is passed to `sink(*row)` in this process, in file order.
+    At most `queue_size` batches of `batch_rows` rows are in flight, which bounds memory.
+    `resume(filepath)` returns how many entries of a file to skip, or None to skip the file,
+    `on_file(filepath, total_entries, done=...)` is called once the rows of a file went to `sink`, with done=False and
+    the entries sent before the error when the file failed to parse, so a resume continues after them.
+    Workers are checked every `poll_interval` seconds, one that died without finishing (killed, crashed)
+    stops the others and raises RuntimeError, its unfinished files are not passed to `on_file`.
+    Returns the number of entries parsed.
+    """
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue(maxsize=queue_size)
+    filepaths = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".json") or filename in skip_files:
+            continue
+        filepath = os.path.join(directory, filename)
+        start = resume(filepath) if resume else 0
+        if start is None:
+            print(f"{filename}: already loaded, skipped")
+            continue
+        filepaths.append(filepath)
+        tasks.put((filepath, start))
+    if not filepaths:
+        return 0
+    workers = min(workers or os.cpu_count() or 1, len(filepaths))
+
+    for _ in range(workers):
+        tasks.put(None)
+
+    processes = [
+        multiprocessing.Process(target=parse_worker, args=(tasks, results, table_mapping, entry_to_rows, batch_rows))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    total_entries = 0
+    start_time = time.perf_counter()
+    exited = set()
+    # Workers found dead at the last wake-up, their exit message may still have been on its way
+    dead = set()
+    while len(exited) < workers:
+        try:
+            message = results.get(timeout=poll_interval)
+        except queue.Empty:
+            lost = [process for process in processes if process.pid in dead and process.pid not in exited]
+            if lost:
+                for process in processes:
+                    if process.is_alive():
+                        process.terminate()
+                for process in processes:
+                    process.join()
+                codes = ", ".join(f"{process.pid} (exit code {process.exitcode})" for process in lost)
+                raise RuntimeError(f"Parse worker {codes} exited before finishing its files")
+            dead = {process.pid for process in processes if not process.is_alive()}
+            continue
+        if message[0] == "rows":
+            for row in message[1]:
+                sink(*row)
+        elif message[0] == "file":
+            _, filepath, entries, file_entries, done, parse_time, peak = message
+            total_entries += entries
+            report_file(os.path.basename(filepath), entries, parse_time, peak)
+            if on_file:
+                on_file(filepath, file_entries, done=done)
+        else:
+            exited.add(message[1])
+
+    for process in processes:
+        process.join()
+
+    elapsed = time.perf_counter() - start_time
+    rate = total_entries / elapsed if elapsed > 0 else 0.0
+    print(f"{directory}: {total_entries} entries from {len(filepaths)} files with {workers} parse workers "
+          f"in {elapsed:.2f}s ({rate:.0f} entries/s)")
+    return total_entries
@@ -4,21 +4,98 @@ import mysql.connector
 import subprocess
 import time
 import csv
+import json
 import statistics
+import itertools
+import threading
+import tracemalloc
 from dotenv import load_dotenv
 from json_to_shards import ShardManager
+from query_plans import capture_plan, save_plan, format_summary, mysql_placeholders
+from frame_dedup import frame_column, frame_join, frame_table
+from detection_feed import feed_table, feed_query, sqlite_feed_query, page_query, feed_page_size, feed_source, DetectionFeed, ShardedDetectionFeed
 
 
 load_dotenv()
 
 
+# "cold" evicts the caches before every iteration, "warm" keeps them, "hot" also runs HOT_AFTER_RUNS unrecorded queries first
+cache_mode = os.getenv("CACHE_MODE", "cold")
+hot_after_runs = int(os.getenv("HOT_AFTER_RUNS", "3"))
+# How long to wait for a restarted MySQL container to accept queries
+mysql_ready_timeout = float(os.getenv("MYSQL_READY_TIMEOUT", "120"))
+# Store EXPLAIN QUERY PLAN / EXPLAIN FORMAT=JSON next to the timings, PLAN_ANALYZE also runs EXPLAIN ANALYZE on MySQL
+capture_plans = os.getenv("CAPTURE_PLANS", "1") == "1"
+plan_analyze = os.getenv("PLAN_ANALYZE", "0") == "1"
+# feed_stream reads this many feed rows page by page, fetching each page's frames when FEED_FRAMES is set
+feed_max_rows = int(os.getenv("FEED_MAX_ROWS", "800000"))
+feed_frames = os.getenv("FEED_FRAMES", "1") == "1"
+# How results are read: "fetchall" (first row, then the rest into one list), "fetchmany" (FETCH_SIZE rows at a time)
+# or "unbuffered" (row by row off the cursor), the streaming modes do not keep the rows
+fetch_mode = os.getenv("FETCH_MODE", "fetchall")
+fetch_size = int(os.getenv("FETCH_SIZE", "1000"))
+# Peak client memory of one extra untimed run: "tracemalloc", "rss" (sampled every MEMORY_SAMPLE_MS) or empty for off
+memory_mode = os.getenv("MEMORY_MODE", "tracemalloc")
+memory_sample_ms = float(os.getenv("MEMORY_SAMPLE_MS", "5"))
+
+
 def flush_os_cache_windows(dummy_file_path="huge_dummy_file"):
     with open(dummy_file_path, "rb") as f:
         while f.read(1024 * 1024):
             pass
 
 
-def restart_mysql_container(container_name="credo_mysql", wait_time=5):
+def evict_file_cache(paths):
+    """
+    Drop the page cache of the given files with posix_fadvise(DONTNEED), dirty pages are written out first.
+    Where posix_fadvise is missing (Windows, macOS) fall back to reading the dummy file.
+    Returns the time it took in seconds.
+    """
+    start_time = time.perf_counter()
+    if not hasattr(os, "posix_fadvise"):
+        flush_os_cache_windows()
+        return time.perf_counter() - start_time
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    return time.perf_counter() - start_time
+
+
+def evict_sqlite_cache(db_path):
+    return evict_file_cache([db_path + suffix for suffix in ("", "-wal", "-shm", "-journal")])
+
+
+def wait_for_mysql(db_config, timeout=None):
+    """
+    Poll until MySQL answers a query, with a growing delay between attempts.
+    Returns the seconds waited, or None when it is not ready within `timeout`.
+    """
+    timeout = mysql_ready_timeout if timeout is None else timeout
+    start_time = time.perf_counter()
+    delay = 0.05
+    while True:
+        try:
+            conn = mysql.connector.connect(connection_timeout=5, **db_config)
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            cursor.close()
+            conn.close()
+            return time.perf_counter() - start_time
+        except mysql.connector.Error:
+            if time.perf_counter() - start_time + delay > timeout:
+                return None
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+
+def restart_mysql_container(container_name="credo_mysql", db_config=None):
     """
     Restarts the Docker container running MySQL and waits for it to be ready.
     """
@@ -29,14 +106,17 @@ def restart_mysql_container(container_name="credo_mysql", wait_time=5):
         print(f"❌ Error restarting container: {e}")
         return False
 
-    print(f"⏳ Waiting {wait_time} seconds for MySQL to become available...")
-    time.sleep(wait_time)
+    waited = wait_for_mysql(db_config)
+    if waited is None:
+        print(f"❌ MySQL not ready after {mysql_ready_timeout:.0f} seconds")
+        return False
+    print(f"⏳ MySQL ready after {waited:.2f} seconds")
     return True
 
 
-def restart_mysql_shards(wait_time=5):
+def restart_mysql_shards(db_configs):
     """
-    Restarts the Docker container running MySQL and waits for it to be ready.
+    Restarts the Docker containers of the lookup database and the shards and waits for all of them to be ready.
     """
     containers = [
         os.getenv("MYSQL_LOOKUP_CONTAINER"),
@@ -51,141 +131,690 @@ def restart_mysql_shards(wait_time=5):
         except subprocess.CalledProcessError as e:
             print(f"❌ Error restarting container: {e}")
             return False
-    
-    print(f"⏳ Waiting {wait_time} seconds for MySQL to become available...")
-    time.sleep(wait_time)
+
+    start_time = time.perf_counter()
+    for db_config in db_configs:
+        if wait_for_mysql(db_config) is None:
+            print(f"❌ MySQL on port {db_config.get('port')} not ready after {mysql_ready_timeout:.0f} seconds")
+            return False
+    print(f"⏳ MySQL ready after {time.perf_counter() - start_time:.2f} seconds")
     return True
 
 
-def log_results(times, stats, filename):
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with open(filename, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(["Iteration", "Time (seconds)"])
-        for i, t in enumerate(times, start=1):
-            writer.writerow([i, f"{t:.6f}"])
-        writer.writerow([])
-        writer.writerow(["Average Time", f"{stats['mean']:.6f}"])
-        writer.writerow(["Median Time", f"{stats['median']:.6f}"])
-        writer.writerow(["Minimum Time", f"{stats['min']:.6f}"])
-        writer.writerow(["Maximum Time", f"{stats['max']:.6f}"])
-        writer.writerow(["Standard Deviation", f"{stats['stddev']:.6f}"])
-    print(f"\n✅ Results saved to: {filename}")
+def warmup_runs(mode):
+    return hot_after_runs if mode == "hot" else 0
 
 
-def measure_performance_sqlite(query, db_path, iterations=10, output_file="results/query_times.csv"):
-    """
-    Measures query execution time for SQLite database over multiple iterations and logs stats.
-    """
-    times = []
-    for i in range(iterations):
-        flush_os_cache_windows()
-        print(f"⏱️ Iteration {i + 1}...")
+def iteration_label(i, warmup):
+    return f"Warm-up {i + 1}" if i < warmup else f"Iteration {i - warmup + 1}"
 
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
 
-        start_time = time.time()
-        cursor.execute(query)
-        cursor.fetchall()
-        end_time = time.time()
+def row_bytes(row):
+    """
+    Size of the text and blob values of a row, base64 frames count about a third more than raw ones.
+    """
+    return sum(len(value) for value in row if isinstance(value, (str, bytes, bytearray)))
 
-        elapsed = end_time - start_time
-        times.append(elapsed)
-        print(f"   Time: {elapsed:.6f} seconds")
 
+def mysql_database_size_mb(db_config):
+    """
+    Data and index size of a MySQL database, read once per benchmark outside the timed runs.
+    """
+    conn = mysql.connector.connect(**db_config)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT COALESCE(SUM(data_length + index_length), 0) FROM information_schema.tables WHERE table_schema = DATABASE()"
+        )
+        return float(cursor.fetchone()[0]) / (1024 * 1024)
+    finally:
         cursor.close()
         conn.close()
 
-    stats = {
-        "mean": statistics.mean(times),
-        "stddev": statistics.stdev(times) if len(times) > 1 else 0.0,
-        "median": statistics.median(times),
-        "min": min(times),
-        "max": max(times)
-    }
 
-    log_results(times, stats, output_file)
+def mysql_query(query):
+    """
+    Benchmarks are written with SQLite "?" placeholders, mysql.connector expects "%s".
+    A "?" inside a string literal or LIKE pattern is not a placeholder and is kept.
+    """
+    return mysql_placeholders(query)
+
+
+def executed(cursor, query, params):
+    cursor.execute(query, params)
+    return cursor
 
 
-def measure_performance_mysql(query, db_config, iterations=10, output_file="results/query_times.csv"):
+def fetch_batches(rows, fetch=None, size=None):
     """
-    Measures query execution time for MySQL database over multiple iterations and logs stats.
+    Read a cursor (or a row iterator) the way `fetch` says: "fetchall" reads the first row on its own and then
+    fetchall() into one list, "fetchmany" reads `size` rows at a time and "unbuffered" iterates row by row.
     """
-    times = []
-    for i in range(iterations):
-        flush_os_cache_windows()
-        if not restart_mysql_container():
-            print(f"⚠️ Skipping iteration {i+1} due to restart error.")
-            continue
-        
-        print(f"⏱️ Iteration {i + 1}...")
+    fetch = fetch or fetch_mode
+    size = size or fetch_size
+    is_cursor = hasattr(rows, "fetchmany")
+    if fetch == "fetchall":
+        first = rows.fetchone() if is_cursor else next(rows, None)
+        if first is None:
+            return
+        yield [first]
+        yield rows.fetchall() if is_cursor else list(rows)
+    elif fetch == "fetchmany":
+        while True:
+            batch = rows.fetchmany(size) if is_cursor else list(itertools.islice(rows, size))
+            if not batch:
+                return
+            yield batch
+    elif fetch == "unbuffered":
+        for row in iter(rows.fetchone, None) if is_cursor else rows:
+            yield (row,)
+    else:
+        raise ValueError(f"Unknown FETCH_MODE: {fetch}")
+
+
+def timed_fetch(execute, fetch=None, size=None):
+    """
+    Time one query in parts: `execute` runs it and returns the cursor or a row iterator, then the rows are read
+    with fetch_batches. Only "fetchall" keeps the whole result in memory, the streaming modes count and drop each batch.
+    Returns a sample with the execute, first-row and total (fully drained) times in nanoseconds, the rows and bytes.
+    """
+    start_ns = time.perf_counter_ns()
+    rows = execute()
+    execute_ns = time.perf_counter_ns() - start_ns
+    first_row_ns = None
+    count = 0
+    size_bytes = 0
+    for batch in fetch_batches(rows, fetch, size):
+        if first_row_ns is None and batch:
+            first_row_ns = time.perf_counter_ns() - start_ns
+        count += len(batch)
+        size_bytes += sum(row_bytes(row) for row in batch)
+    total_ns = time.perf_counter_ns() - start_ns
+    return {
+        "time_ns": total_ns,
+        "execute_ns": execute_ns,
+        "first_row_ns": total_ns if first_row_ns is None else first_row_ns,
+        "rows": count,
+        "bytes": size_bytes,
+    }
 
-        conn = mysql.connector.connect(**db_config)
-        cursor = conn.cursor()
 
-        start_time = time.time()
-        cursor.execute(query)
-        cursor.fetchall()
-        end_time = time.time()
+def current_rss():
+    """
+    Resident set size of this process in bytes, None where /proc is missing.
+    """
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
 
-        elapsed = end_time - start_time
-        times.append(elapsed)
-        print(f"   Time: {elapsed:.6f} seconds")
 
-        cursor.close()
-        conn.close()
+def peak_memory(run_once, mode=None):
+    """
+    Peak client memory of one extra run in MB, above what was in use before it: "tracemalloc" traces Python
+    allocations (exact, slows the run down), "rss" samples the resident set every MEMORY_SAMPLE_MS (also counts
+    driver buffers outside Python). None when it is off or not available here.
+    """
+    mode = memory_mode if mode is None else mode
+    if mode == "tracemalloc":
+        tracemalloc.start()
+        try:
+            run_once()
+            return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        finally:
+            tracemalloc.stop()
+    if mode == "rss":
+        baseline = current_rss()
+        if baseline is None:
+            print("   RSS sampling needs /proc, memory not measured")
+            return None
+        peak = baseline
+        stop = threading.Event()
+
+        def sample():
+            nonlocal peak
+            while not stop.wait(memory_sample_ms / 1000):
+                peak = max(peak, current_rss() or 0)
+
+        sampler = threading.Thread(target=sample, name="rss-sampler", daemon=True)
+        sampler.start()
+        try:
+            run_once()
+        finally:
+            stop.set()
+            sampler.join()
+        peak = max(peak, current_rss() or 0)
+        return (peak - baseline) / (1024 * 1024)
+    if mode:
+        print(f"   Unknown MEMORY_MODE {mode!r}, memory not measured")
+    return None
+
+
+def percentile(sorted_values, p):
+    """
+    Linear-interpolated percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
 
+
+def summarize(samples, fetch=None):
+    """
+    Stats of the recorded samples, times in seconds. `fetch` is the fetch mode the samples were read with.
+    """
+    times = sorted(sample["time_ns"] / 1e9 for sample in samples)
+    first_rows = sorted(sample["first_row_ns"] / 1e9 for sample in samples)
+    if not times:
+        return {}
     stats = {
+        "iterations": len(times),
         "mean": statistics.mean(times),
         "stddev": statistics.stdev(times) if len(times) > 1 else 0.0,
         "median": statistics.median(times),
-        "min": min(times),
-        "max": max(times)
+        "min": times[0],
+        "max": times[-1],
+        "p50": percentile(times, 50),
+        "p90": percentile(times, 90),
+        "p99": percentile(times, 99),
+        "first_row_p50": percentile(first_rows, 50),
+        "first_row_p90": percentile(first_rows, 90),
+        "rows": samples[-1]["rows"],
+        "bytes": samples[-1]["bytes"],
     }
-
-    log_results(times, stats, output_file)
+    # Execution is what the database spends, the drain after the first row is mostly the client building rows
+    if all("execute_ns" in sample for sample in samples):
+        executes = sorted(sample["execute_ns"] / 1e9 for sample in samples)
+        drains = sorted((sample["time_ns"] - sample["first_row_ns"]) / 1e9 for sample in samples)
+        stats.update(execute_p50=percentile(executes, 50), execute_p90=percentile(executes, 90),
+                     drain_p50=percentile(drains, 50), drain_p90=percentile(drains, 90))
+    if all("execute_total_ns" in sample for sample in samples):
+        totals = sorted(sample["execute_total_ns"] / 1e9 for sample in samples)
+        stats.update(execute_total_p50=percentile(totals, 50), execute_total_p90=percentile(totals, 90))
+    if fetch:
+        stats["fetch"] = fetch
+    return stats
+
+
+def log_results(samples, stats, filename, extra=None, info=None):
+    """
+    Write the samples and stats of one benchmark run to `filename` (CSV) and next to it as JSON.
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(["Iteration", "Time (seconds)", "Time to first row (seconds)", "Rows", "Bytes",
+                         "Execute (seconds)", "Execute all shards (seconds)"])
+        for i, sample in enumerate(samples, start=1):
+            execute = f"{sample['execute_ns'] / 1e9:.6f}" if "execute_ns" in sample else ""
+            execute_total = f"{sample['execute_total_ns'] / 1e9:.6f}" if "execute_total_ns" in sample else ""
+            writer.writerow([i, f"{sample['time_ns'] / 1e9:.6f}", f"{sample['first_row_ns'] / 1e9:.6f}",
+                             sample["rows"], sample["bytes"], execute, execute_total])
+        writer.writerow([])
+        if stats:
+            writer.writerow(["Average Time", f"{stats['mean']:.6f}"])
+            writer.writerow(["Median Time", f"{stats['median']:.6f}"])
+            writer.writerow(["Minimum Time", f"{stats['min']:.6f}"])
+            writer.writerow(["Maximum Time", f"{stats['max']:.6f}"])
+            writer.writerow(["Standard Deviation", f"{stats['stddev']:.6f}"])
+            writer.writerow(["P50 Time", f"{stats['p50']:.6f}"])
+            writer.writerow(["P90 Time", f"{stats['p90']:.6f}"])
+            writer.writerow(["P99 Time", f"{stats['p99']:.6f}"])
+            writer.writerow(["Median Time to First Row", f"{stats['first_row_p50']:.6f}"])
+            if "execute_p50" in stats:
+                writer.writerow(["Median Execute Time", f"{stats['execute_p50']:.6f}"])
+                writer.writerow(["Median Drain Time", f"{stats['drain_p50']:.6f}"])
+            if "execute_total_p50" in stats:
+                writer.writerow(["Median Execute Time All Shards", f"{stats['execute_total_p50']:.6f}"])
+            writer.writerow(["Rows", stats["rows"]])
+            writer.writerow(["Bytes Fetched", stats["bytes"]])
+        for name, value in (extra or {}).items():
+            writer.writerow([name, f"{value:.1f}"])
+
+    json_file = os.path.splitext(filename)[0] + ".json"
+    with open(json_file, "w", encoding="utf-8") as file:
+        json.dump({**(info or {}), "stats": stats, "extra": extra or {}, "samples": samples}, file, indent=1)
+    print(f"\n✅ Results saved to: {filename} and {json_file}")
+
+
+def record_memory(stats, run_once, extra):
+    """
+    Add the peak memory of one extra, untimed run to the stats and to the extra values logged with them.
+    """
+    if not stats:
+        return
+    peak_mb = peak_memory(run_once)
+    if peak_mb is None:
+        return
+    stats["peak_mb"] = peak_mb
+    extra["Peak Memory (MB)"] = peak_mb
+    print(f"   Peak memory ({memory_mode}): {peak_mb:.1f} MB")
 
 
-def measure_performance_shards(query, lookup_db_config, shard_db_configs, iterations=10, output_file="results/query_times.csv"):
+def measure_iterations(run_once, iterations, warmup, reset_cache=None):
     """
-    Measures query execution time for sharded MySQL database over multiple iterations and logs stats.
+    Shared timing loop: `warmup` unrecorded runs, then `iterations` recorded ones.
+    `reset_cache` runs before every iteration, an iteration is skipped when it returns False.
     """
-    times = []
-    for i in range(iterations):
-        flush_os_cache_windows()
-        if not restart_mysql_shards():
-            print(f"⚠️ Skipping iteration {i+1} due to restart error.")
+    samples = []
+    for i in range(warmup + iterations):
+        if reset_cache is not None and reset_cache() is False:
+            print(f"⚠️ Skipping iteration {i + 1} due to cache reset error.")
             continue
 
-        print(f"⏱️ Iteration {i+1}...")
+        print(f"⏱️ {iteration_label(i, warmup)}...")
+        sample = run_once()
+        if i >= warmup:
+            samples.append(sample)
+        execute = f"execute {sample['execute_ns'] / 1e9:.6f}, " if "execute_ns" in sample else ""
+        if "execute_total_ns" in sample:
+            execute += f"all shards {sample['execute_total_ns'] / 1e9:.6f}, "
+        print(f"   Time: {sample['time_ns'] / 1e9:.6f} seconds ({execute}first row {sample['first_row_ns'] / 1e9:.6f}, "
+              f"{sample['rows']} rows, {sample['bytes'] / (1024 * 1024):.1f} MB)")
+    return samples
 
-        sm = ShardManager(lookup_db_config, shard_db_configs)
 
-        start_time = time.time()
-        for conn in sm.shards.values():
-            cursor = conn.cursor()
-            cursor.execute(query)
-            cursor.fetchall()
+def measure_performance_sqlite(query, db_path, iterations=10, output_file="results/query_times.csv", mode=None,
+                               params=(), warmup=0, name=None):
+    """
+    Measures query execution time for SQLite database over multiple iterations and logs stats.
+    Also logs the database file size.
+    `mode` is "cold", "warm" or "hot" (CACHE_MODE by default), cold runs evict the database files from the page cache.
+    """
+    mode = mode or cache_mode
+
+    def reset_cache():
+        print(f"   Cache evicted in {evict_sqlite_cache(db_path) * 1000:.1f} ms")
+
+    def run_once():
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        try:
+            return timed_fetch(lambda: executed(cursor, query, params))
+        finally:
             cursor.close()
-        end_time = time.time()
+            conn.close()
+
+    samples = measure_iterations(run_once, iterations, warmup + warmup_runs(mode), reset_cache if mode == "cold" else None)
+    stats = summarize(samples, fetch_mode)
+    db_size_mb = sum(os.path.getsize(path) for path in (db_path, db_path + "-wal") if os.path.exists(path)) / (1024 * 1024)
+    print(f"   Database size: {db_size_mb:.1f} MB")
+    extra = {"Database Size (MB)": db_size_mb}
+    record_memory(stats, run_once, extra)
+    log_results(samples, stats, output_file, extra=extra,
+                info={"benchmark": name, "backend": "sqlite", "database": db_path, "mode": mode, "fetch": fetch_mode,
+                      "fetch_size": fetch_size})
+    return stats
+
+
+def measure_performance_mysql(query, db_config, iterations=10, output_file="results/query_times.csv", mode=None,
+                              params=(), warmup=0, name=None):
+    """
+    Measures query execution time for MySQL database over multiple iterations and logs stats.
+    Also logs the database size.
+    `mode` is "cold", "warm" or "hot" (CACHE_MODE by default), cold runs restart the container to empty the buffer pool.
+    """
+    mode = mode or cache_mode
 
-        elapsed = end_time - start_time
-        times.append(elapsed)
-        print(f"   Time: {elapsed:.6f} seconds")
-        
-        sm.close()
-        del sm
+    def run_once():
+        conn = mysql.connector.connect(**db_config)
+        cursor = conn.cursor()
+        try:
+            return timed_fetch(lambda: executed(cursor, mysql_query(query), params))
+        finally:
+            cursor.close()
+            conn.close()
+
+    reset_cache = (lambda: restart_mysql_container(db_config=db_config)) if mode == "cold" else None
+    samples = measure_iterations(run_once, iterations, warmup + warmup_runs(mode), reset_cache)
+    stats = summarize(samples, fetch_mode)
+    db_size_mb = mysql_database_size_mb(db_config)
+    print(f"   Database size: {db_size_mb:.1f} MB")
+    extra = {"Database Size (MB)": db_size_mb}
+    record_memory(stats, run_once, extra)
+    log_results(samples, stats, output_file, extra=extra,
+                info={"benchmark": name, "backend": "mysql", "database": db_config.get("database"), "mode": mode,
+                      "fetch": fetch_mode, "fetch_size": fetch_size})
+    return stats
+
+
+def measure_performance_shards(query, lookup_db_config, shard_db_configs, iterations=10, output_file="results/query_times.csv",
+                               order_by=None, descending=False, limit=None, mode=None, params=(), warmup=0, name=None):
+    """
+    Measures query execution time for sharded MySQL database over multiple iterations and logs stats.
+    The query runs on all shards at once and the results are merged on `order_by` up to `limit` rows.
+    `mode` is "cold", "warm" or "hot" (CACHE_MODE by default), cold runs restart every container.
+    """
+    mode = mode or cache_mode
 
-    stats = {
-        "mean": statistics.mean(times),
-        "stddev": statistics.stdev(times) if len(times) > 1 else 0.0,
-        "median": statistics.median(times),
-        "min": min(times),
-        "max": max(times)
+    def run_once():
+        sm = ShardManager(lookup_db_config, shard_db_configs, preload_routes=False)
+        try:
+            sample = timed_fetch(lambda: sm.scatter_gather(mysql_query(query), params or None, order_by=order_by,
+                                                           descending=descending, limit=limit, fetch_size=fetch_size))
+            # The shards run the query on their own threads, execution is the slowest shard's execute(),
+            # the total is the work all shards together spent on it
+            sample["execute_ns"] = int(max(sm.shard_execute_times.values(), default=0) * 1e9)
+            sample["execute_total_ns"] = int(sum(sm.shard_execute_times.values()) * 1e9)
+            print(f"   Slowest shard: {max(sm.shard_query_times.values()):.6f} seconds")
+            return sample
+        finally:
+            sm.close()
+
+    reset_cache = (lambda: restart_mysql_shards([lookup_db_config, *shard_db_configs.values()])) if mode == "cold" else None
+    samples = measure_iterations(run_once, iterations, warmup + warmup_runs(mode), reset_cache)
+    stats = summarize(samples, fetch_mode)
+    extra = {}
+    record_memory(stats, run_once, extra)
+    log_results(samples, stats, output_file, extra=extra,
+                info={"benchmark": name, "backend": "shards", "mode": mode, "fetch": fetch_mode, "fetch_size": fetch_size})
+    return stats
+
+
+def measure_feed(backend, target, iterations=10, output_file="results/feed_times.csv", mode=None, params=(), warmup=0,
+                 name=None, max_rows=None, frames=None):
+    """
+    Read the detection feed the way the feed page does: keyset pages streamed with fetchmany, each page's frames
+    fetched on demand, up to `max_rows` rows. Records time to the first page (with its frames) and the total time.
+    """
+    mode = mode or cache_mode
+    max_rows = feed_max_rows if max_rows is None else max_rows
+    frames = feed_frames if frames is None else frames
+
+    def open_feed():
+        if backend in ("sqlite", "sqlite_opt"):
+            conns = [sqlite3.connect(target)]
+            return DetectionFeed(conns[0]), conns
+        if backend == "mysql":
+            conns = [mysql.connector.connect(**target)]
+            return DetectionFeed(conns[0]), conns
+        _, shard_db_configs = target
+        shard_conns = {shard_id: mysql.connector.connect(**config) for shard_id, config in shard_db_configs.items()}
+        return ShardedDetectionFeed(shard_conns), list(shard_conns.values())
+
+    def run_once():
+        feed, conns = open_feed()
+        try:
+            start_ns = time.perf_counter_ns()
+            first_page_ns = None
+            rows = 0
+            size = 0
+            pages = 0
+            for page in feed.pages(max_rows=max_rows):
+                size += sum(row_bytes(row) for row in page)
+                if frames:
+                    size += sum(len(frame) for frame in feed.frames([row[1] for row in page]).values() if frame)
+                if first_page_ns is None:
+                    first_page_ns = time.perf_counter_ns() - start_ns
+                rows += len(page)
+                pages += 1
+            total_ns = time.perf_counter_ns() - start_ns
+            return {"time_ns": total_ns, "first_row_ns": total_ns if first_page_ns is None else first_page_ns,
+                    "rows": rows, "bytes": size, "pages": pages}
+        finally:
+            for conn in conns:
+                conn.close()
+
+    if mode != "cold":
+        reset_cache = None
+    elif backend in ("sqlite", "sqlite_opt"):
+        reset_cache = lambda: print(f"   Cache evicted in {evict_sqlite_cache(target) * 1000:.1f} ms")
+    elif backend == "mysql":
+        reset_cache = lambda: restart_mysql_container(db_config=target)
+    else:
+        reset_cache = lambda: restart_mysql_shards([target[0], *target[1].values()])
+    samples = measure_iterations(run_once, iterations, warmup + warmup_runs(mode), reset_cache)
+    stats = summarize(samples)
+    if not stats:
+        return stats
+
+    stats.update(first_page_p50=stats["first_row_p50"], first_page_p90=stats["first_row_p90"], pages=samples[-1]["pages"])
+    print(f"   Time to first page: {stats['first_page_p50']:.6f}s, {stats['pages']} pages")
+    extra = {}
+    record_memory(stats, run_once, extra)
+    log_results(samples, stats, output_file, extra=extra,
+                info={"benchmark": name, "backend": backend, "mode": mode, "page_size": feed_page_size,
+                      "source": feed_source, "frames": frames, "first_row": "time to the first page"})
+    return stats
+
+
+all_backends = ("sqlite", "sqlite_opt", "mysql", "shards")
+
+
+class Benchmark:
+    """
+    A named query with its parameters, the backends it runs on and how many warm-up and recorded runs it gets.
+    Queries use "?" placeholders. order_by/descending/limit tell the shards backend how to merge the
+    per-shard results, queries that cannot be merged that way (aggregates) leave "shards" out of `backends`.
+    `queries` maps a backend to its own text of the query where it differs from `query`.
+    A `runner` replaces the plain query measurement: runner(backend, target, **options), `query` is then only
+    used for its plan.
+    `requires_table` is an SQLite table the query needs, or a tuple of them, databases without one skip the benchmark.
+    """
+    def __init__(self, name, query, params=(), backends=all_backends, warmup=0, iterations=10,
+                 order_by=None, descending=False, limit=None, runner=None, queries=None, requires_table=None):
+        self.name = name
+        self.query = query
+        self.queries = dict(queries or {})
+        self.params = tuple(params)
+        self.backends = tuple(backends)
+        self.warmup = warmup
+        self.iterations = iterations
+        self.order_by = order_by
+        self.descending = descending
+        self.limit = limit
+        self.runner = runner
+        self.requires_table = (requires_table,) if isinstance(requires_table, str) else tuple(requires_table or ())
+
+
+    def query_for(self, backend):
+        return self.queries.get(backend, self.query)
+
+
+    def missing_table(self, db_file):
+        """
+        The first required table the SQLite database `db_file` does not have, None when it has them all.
+        """
+        return next((table for table in self.requires_table if not sqlite_has_table(db_file, table)), None)
+
+
+benchmarks = {}
+
+
+def register_benchmark(name, query, **options):
+    benchmarks[name] = Benchmark(name, query, **options)
+    return benchmarks[name]
+
+
+def sqlite_has_table(db_file, table):
+    conn = sqlite3.connect(db_file)
+    try:
+        return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+    finally:
+        conn.close()
+
+
+def run_benchmark(benchmark, backend, targets, output_dir="performance_tests", mode=None):
+    missing = benchmark.missing_table(targets[backend]) if backend in ("sqlite", "sqlite_opt") else None
+    if missing:
+        print(f"⏭️ {benchmark.name} skipped on {backend}: no {missing} table")
+        return None
+    output_file = os.path.join(output_dir, f"{benchmark.name}_{backend}.csv")
+    options = dict(iterations=benchmark.iterations, output_file=output_file, mode=mode, params=benchmark.params,
+                   warmup=benchmark.warmup, name=benchmark.name)
+    if benchmark.runner is not None:
+        stats = benchmark.runner(backend, targets[backend], **options)
+    elif backend in ("sqlite", "sqlite_opt"):
+        stats = measure_performance_sqlite(benchmark.query_for(backend), targets[backend], **options)
+    elif backend == "mysql":
+        stats = measure_performance_mysql(benchmark.query_for(backend), targets[backend], **options)
+    elif backend == "shards":
+        lookup_db_config, shard_db_configs = targets[backend]
+        stats = measure_performance_shards(benchmark.query_for(backend), lookup_db_config, shard_db_configs, order_by=benchmark.order_by,
+                                           descending=benchmark.descending, limit=benchmark.limit, **options)
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+    if capture_plans and stats:
+        stats.update(plan_stats(benchmark, backend, targets[backend], output_file))
+    return stats
+
+
+def plan_stats(benchmark, backend, target, output_file):
+    """
+    Capture the plan after the timed runs (EXPLAIN ANALYZE executes the query) and store it next to the CSV.
+    """
+    try:
+        captured = capture_plan(backend, target, benchmark.query_for(backend), benchmark.params, analyze=plan_analyze)
+    except Exception as e:
+        print(f"⚠️ Could not capture the plan of {benchmark.name} on {backend}: {e}")
+        return {}
+    changed = save_plan(captured, os.path.splitext(output_file)[0] + ".plan.json")
+    summary = captured["summary"]
+    print(f"   Plan: {format_summary(summary)}")
+    return {
+        "full_scans": "; ".join(summary["full_scans"]),
+        "sorts": "; ".join(summary["sorts"]),
+        "indexes": "; ".join(summary["indexes"]),
+        "plan_changed": changed,
     }
 
-    log_results(times, stats, output_file)
+
+def write_summary(results, output_dir="performance_tests"):
+    """
+    One line per (benchmark, backend) in summary.csv and summary.json.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    columns = ["benchmark", "backend", "iterations", "mean", "p50", "p90", "p99", "min", "max", "stddev",
+               "first_row_p50", "first_row_p90", "execute_p50", "execute_p90", "execute_total_p50", "execute_total_p90", "drain_p50", "drain_p90", "rows", "bytes",
+               "fetch", "peak_mb", "first_page_p50", "pages", "full_scans", "sorts", "indexes", "plan_changed"]
+    with open(os.path.join(output_dir, "summary.csv"), mode='w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(results)
+    with open(os.path.join(output_dir, "summary.json"), "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=1)
+
+
+def run_benchmarks(targets, names=None, backends=None, output_dir="performance_tests", mode=None):
+    """
+    Run the registered benchmarks (all, or the ones in `names`) on every backend of `targets` they apply to.
+    `targets` maps a backend to its database: a file for "sqlite"/"sqlite_opt", a config for "mysql",
+    (lookup config, shard configs) for "shards".
+    """
+    results = []
+    for name, benchmark in benchmarks.items():
+        if names and name not in names:
+            continue
+        for backend in benchmark.backends:
+            if backend not in targets or (backends and backend not in backends):
+                continue
+            print(f"\n📊 {name} on {backend}")
+            try:
+                stats = run_benchmark(benchmark, backend, targets, output_dir, mode)
+            except Exception as e:
+                print(f"❌ {name} failed on {backend}: {e}")
+                continue
+            if not stats:
+                continue
+            results.append({"benchmark": name, "backend": backend, **stats})
+    write_summary(results, output_dir)
+    return results
+
+
+latest_detections_query = """
+    SELECT
+        {frame} AS detection_frame_content,
+        det.timestamp AS detection_timestamp,
+        u.username AS user_username,
+        u.display_name AS user_display_name,
+        t.name AS user_team_name
+    FROM 
+        credocommon_detection det
+    LEFT JOIN 
+        credocommon_device d ON det.device_id = d.id
+    LEFT JOIN
+        credocommon_user u ON d.user_id = u.id
+    LEFT JOIN 
+        credocommon_team t ON u.team_id = t.id
+    {frame_join}
+    ORDER BY 
+        det.timestamp DESC
+    LIMIT 800000;
+    """
+
+# The same query on every backend, so the timings compare
+register_benchmark("latest_detections", latest_detections_query.format(frame="det.frame_content", frame_join=""),
+    # Every shard returns its own latest 800000 rows, merged on det.timestamp (column 1) into the global top 800000
+    order_by=1, descending=True, limit=800000)
+
+# SQLite databases loaded with FRAME_DEDUP read the frames deduplicated into credocommon_frame
+register_benchmark("latest_detections_dedup", latest_detections_query.format(frame=frame_column, frame_join=frame_join),
+                   backends=("sqlite", "sqlite_opt"), requires_table=frame_table)
+
+# SQLite databases loaded without DETECTION_FEED have no feed table
+register_benchmark("latest_detections_feed", feed_query, order_by=1, descending=True, limit=800000,
+                   requires_table=feed_table)
+
+register_benchmark("latest_detections_feed_dedup", sqlite_feed_query, backends=("sqlite", "sqlite_opt"),
+                   requires_table=(feed_table, frame_table))
+
+# The feed API paging the whole feed, its plan is the one of the first page
+register_benchmark("feed_stream", page_query("?", feed_source), params=(feed_page_size,), runner=measure_feed,
+                   requires_table=feed_table if feed_source == "feed" else None)
+
+register_benchmark("user_by_username", """
+    SELECT u.id, u.username, u.display_name, t.name
+    FROM credocommon_user u
+    LEFT JOIN credocommon_team t ON u.team_id = t.id
+    WHERE u.username = ?
+    """, params=[os.getenv("BENCHMARK_USERNAME", "user1")], warmup=1, iterations=50)
+
+register_benchmark("user_latest_detections", """
+    SELECT det.id, det.timestamp, det.visible
+    FROM credocommon_detection det
+    JOIN credocommon_device d ON det.device_id = d.id
+    JOIN credocommon_user u ON d.user_id = u.id
+    WHERE u.username = ?
+    ORDER BY det.timestamp DESC
+    LIMIT 100
+    """, params=[os.getenv("BENCHMARK_USERNAME", "user1")], warmup=1, iterations=50,
+    order_by=1, descending=True, limit=100)
+
+register_benchmark("user_devices", """
+    SELECT d.id, d.device_type, d.device_model
+    FROM credocommon_device d
+    JOIN credocommon_user u ON d.user_id = u.id
+    WHERE u.username = ?
+    ORDER BY d.id
+    """, params=[os.getenv("BENCHMARK_USERNAME", "user1")], warmup=1, iterations=50, order_by=0)
+
+register_benchmark("device_latest_pings", """
+    SELECT p.id, p.timestamp, p.delta_time, p.on_time
+    FROM credocommon_ping p
+    WHERE p.device_id = ?
+    ORDER BY p.timestamp DESC
+    LIMIT 1000
+    """, params=[int(os.getenv("BENCHMARK_DEVICE_ID", "1"))], warmup=1, iterations=50,
+    order_by=1, descending=True, limit=1000)
+
+register_benchmark("team_detection_counts", """
+    SELECT t.name, COUNT(*) AS detections
+    FROM credocommon_detection det
+    JOIN credocommon_device d ON det.device_id = d.id
+    JOIN credocommon_user u ON d.user_id = u.id
+    JOIN credocommon_team t ON u.team_id = t.id
+    GROUP BY t.name
+    ORDER BY detections DESC
+    LIMIT 50
+    """, backends=("sqlite", "sqlite_opt", "mysql"))
+
+register_benchmark("visible_detection_count", """
+    SELECT COUNT(*) FROM credocommon_detection WHERE visible = 1
+    """, backends=("sqlite", "sqlite_opt", "mysql"))
 
 
 def main():
@@ -214,47 +843,37 @@ def main():
         4: {'host': os.getenv("MYSQL_HOST"), 'port': os.getenv("MYSQL_SHARD4_PORT"), 'user': os.getenv("MYSQL_USER"), 'password': os.getenv("MYSQL_PASSWORD"), 'database': os.getenv("MYSQL_SHARD4_DB")},
     }
 
-    iterations = 10
-    output_file_sqlite_base = "performance_tests/time_sqlite.csv"
-    output_file_sqlite_opt = "performance_tests/time_sqlite_opt.csv"
-    output_file_mysql = "performance_tests/time_mysql.csv"
-    output_file_mysql_shards = "performance_tests/time_shards.csv"
-
-    query1 = """
-    SELECT
-        det.frame_content AS detection_frame_content,
-        det.timestamp AS detection_timestamp,
-        u.username AS user_username,
-        u.display_name AS user_display_name,
-        t.name AS user_team_name
-    FROM 
-        credocommon_detection det
-    LEFT JOIN 
-        credocommon_device d ON det.device_id = d.id
-    LEFT JOIN
-        credocommon_user u ON d.user_id = u.id
-    LEFT JOIN 
-        credocommon_team t ON u.team_id = t.id
-    ORDER BY 
-        det.timestamp DESC
-    LIMIT 800000;
-    """
+    targets = {
+        "sqlite": os.getenv("DB_FILE_OG"),
+        "sqlite_opt": os.getenv("DB_FILE_OPT"),
+        "mysql": config_mysql,
+        "shards": (lookup_db_config, shard_db_configs),
+    }
+    # Comma separated names of the benchmarks and backends to run, empty runs all of them
+    names = [name for name in os.getenv("BENCHMARKS", "").split(",") if name]
+    backends = [backend for backend in os.getenv("BENCHMARK_BACKENDS", "").split(",") if backend]
 
-    
     print("\nMeasuring query performance...\n")
-
-    # SQLITE BASE
-    measure_performance_sqlite(query1, os.getenv("DB_FILE_OG"), iterations=iterations, output_file=output_file_sqlite_base)
-
-    # SQLITE OPTIMISED
-    measure_performance_sqlite(query1, os.getenv("DB_FILE_OPT"), iterations=iterations, output_file=output_file_sqlite_opt)
-
-    # MYSQL
-    measure_performance_mysql(query1, config_mysql, iterations=iterations, output_file=output_file_mysql)
-
-    # MYSQL SHARDS
-    measure_performance_shards(query1, lookup_db_config, shard_db_configs, iterations=iterations, output_file=output_file_mysql_shards)
-
+    results = run_benchmarks(targets, names, backends, output_dir=os.getenv("BENCHMARK_DIRECTORY", "performance_tests"))
+
+    for result in results:
+        print(f"{result['benchmark']:<26} {result['backend']:<11} p50 {result['p50']:.6f}s  p90 {result['p90']:.6f}s  "
+              f"p99 {result['p99']:.6f}s  first row {result['first_row_p50']:.6f}s  {result['rows']} rows")
+        details = []
+        if "execute_p50" in result:
+            details.append(f"execute {result['execute_p50']:.6f}s  drain {result['drain_p50']:.6f}s  ({result.get('fetch', fetch_mode)})")
+        if "execute_total_p50" in result:
+            details.append(f"execute all shards {result['execute_total_p50']:.6f}s")
+        if "pages" in result:
+            details.append(f"first page {result['first_page_p50']:.6f}s  {result['pages']} pages")
+        if "peak_mb" in result:
+            details.append(f"peak memory {result['peak_mb']:.1f} MB")
+        if details:
+            print(f"{'':<38} {'  '.join(details)}")
+        if result.get("full_scans") or result.get("sorts"):
+            print(f"{'':<38} full scans: {result['full_scans'] or '-'}  sorts: {result['sorts'] or '-'}")
+        if result.get("plan_changed"):
+            print(f"{'':<38} ⚠️ plan changed since the last run")
     print(f"Results saved to output files.")
 
 
@@ -0,0 +1,174 @@
+import json
+import os
+import re
+import sqlite3
+import mysql.connector
+
+
+_sqlite_access = re.compile(r"^(SCAN|SEARCH)\s+(?:TABLE\s+)?(\S+)(?:\s+AS\s+\S+)?(.*)$")
+_sqlite_index = re.compile(r"USING (?:COVERING )?INDEX (\S+)")
+_sqlite_temp = re.compile(r"USE TEMP B-TREE FOR (.+)$")
+# A quoted string or identifier (kept as is) or a "?" placeholder
+_placeholder = re.compile(r"""('(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*"|`[^`]*`)|\?""")
+
+
+def mysql_placeholders(query):
+    """
+    Rewrite SQLite "?" placeholders to the "%s" mysql.connector expects, leaving "?" inside quotes alone.
+    """
+    return _placeholder.sub(lambda match: match.group(1) or "%s", query)
+
+
+def sqlite_plan(db_path, query, params=()):
+    """
+    EXPLAIN QUERY PLAN of a query as a list of (id, parent, detail).
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        return [(row[0], row[1], row[3]) for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+    finally:
+        conn.close()
+
+
+def summarize_sqlite_plan(plan):
+    """
+    Full scans, temporary B-trees and indexes of an SQLite plan.
+    "SCAN t" reads the whole table, "SCAN t USING INDEX i" the whole index, "SEARCH" is a lookup.
+    """
+    summary = {"full_scans": [], "sorts": [], "indexes": []}
+    for _, _, detail in plan:
+        access = _sqlite_access.match(detail)
+        if access:
+            kind, table, rest = access.groups()
+            index = _sqlite_index.search(rest)
+            if index:
+                summary["indexes"].append(index.group(1))
+            elif "INTEGER PRIMARY KEY" in rest:
+                summary["indexes"].append(f"{table}.PRIMARY")
+            if kind == "SCAN":
+                summary["full_scans"].append(f"{table} via {index.group(1)}" if index else table)
+        temp = _sqlite_temp.search(detail)
+        if temp:
+            summary["sorts"].append(f"temp b-tree for {temp.group(1).lower()}")
+    summary["signature"] = "\n".join(detail for _, _, detail in plan)
+    return summary
+
+
+def mysql_plan(db_config, query, params=(), analyze=False):
+    """
+    EXPLAIN FORMAT=JSON of a query, and the EXPLAIN ANALYZE text when `analyze` is set.
+    EXPLAIN ANALYZE runs the query, so it costs one more execution.
+    """
+    conn = mysql.connector.connect(**db_config)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"EXPLAIN FORMAT=JSON {query}", params or None)
+        plan = {"json": json.loads(cursor.fetchone()[0])}
+        if analyze:
+            cursor.execute(f"EXPLAIN ANALYZE {query}", params or None)
+            plan["analyze"] = "\n".join(row[0] for row in cursor.fetchall())
+        return plan
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def summarize_mysql_plan(plan):
+    """
+    Full scans (access_type ALL, or index for a full index scan), filesorts, temporary tables and keys used.
+    """
+    summary = {"full_scans": [], "sorts": [], "indexes": []}
+    tables = []
+
+    def walk(node):
+        if isinstance(node, list):
+            for item in node:
+                walk(item)
+            return
+        if not isinstance(node, dict):
+            return
+        if node.get("using_filesort"):
+            summary["sorts"].append("filesort")
+        if node.get("using_temporary_table"):
+            summary["sorts"].append("temporary table")
+        if "table_name" in node and "access_type" in node:
+            table, access, key = node["table_name"], node["access_type"], node.get("key")
+            tables.append((table, access, key))
+            if key:
+                summary["indexes"].append(key)
+            if access == "ALL":
+                summary["full_scans"].append(table)
+            elif access == "index":
+                summary["full_scans"].append(f"{table} via {key}")
+        for value in node.values():
+            walk(value)
+
+    walk(plan["json"])
+    summary["signature"] = json.dumps([tables, summary["sorts"]])
+    return summary
+
+
+def merge_shard_summaries(summaries):
+    """
+    One summary for the shards, every item prefixed with its shard.
+    """
+    merged = {"full_scans": [], "sorts": [], "indexes": []}
+    for shard_id, summary in summaries.items():
+        for key in merged:
+            merged[key].extend(f"shard{shard_id}: {item}" for item in summary[key])
+    merged["signature"] = json.dumps({str(shard_id): summary["signature"] for shard_id, summary in summaries.items()})
+    return merged
+
+
+def capture_plan(backend, target, query, params=(), analyze=False):
+    """
+    Plan and summary of a query on one backend: "sqlite"/"sqlite_opt" (a file), "mysql" (a config)
+    or "shards" ((lookup config, shard configs), one plan per shard).
+    """
+    if backend in ("sqlite", "sqlite_opt"):
+        plan = sqlite_plan(target, query, params)
+        return {"plan": plan, "summary": summarize_sqlite_plan(plan)}
+    mysql_query = mysql_placeholders(query)
+    if backend == "mysql":
+        plan = mysql_plan(target, mysql_query, params, analyze)
+        return {"plan": plan, "summary": summarize_mysql_plan(plan)}
+    if backend == "shards":
+        _, shard_configs = target
+        plans = {shard_id: mysql_plan(config, mysql_query, params, analyze) for shard_id, config in shard_configs.items()}
+        summary = merge_shard_summaries({shard_id: summarize_mysql_plan(plan) for shard_id, plan in plans.items()})
+        return {"plan": {str(shard_id): plan for shard_id, plan in plans.items()}, "summary": summary}
+    raise ValueError(f"Unknown backend: {backend}")
+
+
+def save_plan(captured, path):
+    """
+    Write a captured plan to `path` and compare it with the plan of the previous run stored there.
+    Returns True when the plan changed, prints a warning with both summaries.
+    """
+    previous = None
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                previous = json.load(file)
+        except (OSError, ValueError):
+            previous = None
+    changed = previous is not None and previous["summary"]["signature"] != captured["summary"]["signature"]
+    captured["changed"] = changed
+    if changed:
+        print(f"⚠️ Query plan changed since the last run ({path})")
+        print(f"   before: {format_summary(previous['summary'])}")
+        print(f"   now:    {format_summary(captured['summary'])}")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(captured, file, indent=1)
+    return changed
+
+
+def format_summary(summary):
+    parts = []
+    if summary["full_scans"]:
+        parts.append(f"full scans: {', '.join(summary['full_scans'])}")
+    if summary["sorts"]:
+        parts.append(f"sorts: {', '.join(summary['sorts'])}")
+    parts.append(f"indexes: {', '.join(summary['indexes']) or 'none'}")
+    return "; ".join(parts)
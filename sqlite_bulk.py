@@ -0,0 +1,97 @@
+import re
+import time
+
+
+# Index definitions dropped for a bulk load, kept in the database itself so an interrupted
+# load still knows what to rebuild
+dropped_indexes_table = "bulk_load_dropped_indexes"
+
+
+class SQLiteBulkLoad:
+    """
+    Bulk-load mode for an sqlite3 connection.
+    begin() switches to load-time pragmas and drops the non-unique secondary indexes,
+    finish() rebuilds them after the load, runs ANALYZE and restores the previous settings.
+    UNIQUE and primary key indexes stay, so constraint errors are still reported during the load.
+    """
+    def __init__(self, conn, cache_mb=256, journal_mode="WAL", name="sqlite"):
+        self.conn = conn
+        self.cache_mb = cache_mb
+        self.journal_mode = journal_mode
+        self.name = name
+        self.saved_settings = {}
+
+
+    def pragma(self, name, value=None):
+        if value is None:
+            return self.conn.execute(f"PRAGMA {name}").fetchone()[0]
+        return self.conn.execute(f"PRAGMA {name} = {value}").fetchone()
+
+
+    def begin(self):
+        self.conn.commit()
+        self.saved_settings = {
+            name: self.pragma(name) for name in ("journal_mode", "synchronous", "cache_size", "temp_store")
+        }
+        # synchronous OFF survives a crash of the loader, but SQLite no longer waits for the disk,
+        # so a power loss or OS crash during the load can corrupt the database file
+        print(f"[{self.name}] ⚠️ bulk load runs with synchronous=OFF: a power loss or OS crash before finish() "
+              f"can corrupt the database, keep a copy or be ready to reload it from the export")
+        self.pragma("journal_mode", self.journal_mode)
+        self.pragma("synchronous", "OFF")
+        self.pragma("cache_size", -self.cache_mb * 1024)
+        self.pragma("temp_store", "MEMORY")
+
+        start_time = time.perf_counter()
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {dropped_indexes_table} (name TEXT PRIMARY KEY, tbl_name TEXT, sql TEXT)")
+        indexes = self.conn.execute(
+            "SELECT name, tbl_name, sql FROM sqlite_master "
+            f"WHERE type = 'index' AND sql IS NOT NULL AND tbl_name != '{dropped_indexes_table}'"
+        ).fetchall()
+        dropped = 0
+        for name, table, sql in indexes:
+            if re.match(r"\s*CREATE\s+UNIQUE", sql, re.IGNORECASE):
+                continue
+            self.conn.execute(f"INSERT OR REPLACE INTO {dropped_indexes_table} VALUES (?, ?, ?)", (name, table, sql))
+            self.conn.execute(f'DROP INDEX "{name}"')
+            dropped += 1
+        self.conn.commit()
+        print(f"[{self.name}] bulk load: dropped {dropped} secondary indexes in {time.perf_counter() - start_time:.2f}s")
+
+
+    def rebuild_indexes(self):
+        """
+        Recreate every index dropped by begin(), including the ones of an earlier interrupted load.
+        """
+        self.conn.commit()
+        exists = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (dropped_indexes_table,)
+        ).fetchone()
+        if not exists:
+            return
+        indexes = self.conn.execute(f"SELECT name, tbl_name, sql FROM {dropped_indexes_table} ORDER BY tbl_name").fetchall()
+        total_start = time.perf_counter()
+        for name, table, sql in indexes:
+            start_time = time.perf_counter()
+            self.conn.execute(re.sub(r"^\s*CREATE\s+INDEX\s+(IF\s+NOT\s+EXISTS\s+)?", "CREATE INDEX IF NOT EXISTS ",
+                                     sql, count=1, flags=re.IGNORECASE))
+            print(f"[{self.name}] rebuilt {name} on {table} in {time.perf_counter() - start_time:.2f}s")
+        self.conn.execute(f"DROP TABLE {dropped_indexes_table}")
+        self.conn.commit()
+        print(f"[{self.name}] rebuilt {len(indexes)} indexes in {time.perf_counter() - total_start:.2f}s")
+
+
+    def finish(self):
+        self.rebuild_indexes()
+
+        start_time = time.perf_counter()
+        self.conn.execute("ANALYZE")
+        self.conn.commit()
+        print(f"[{self.name}] ANALYZE took {time.perf_counter() - start_time:.2f}s")
+
+        # Back to the settings the database had before the load, synchronous at least FULL
+        settings = self.saved_settings or {"journal_mode": "delete", "synchronous": 2, "cache_size": -2000, "temp_store": 0}
+        self.pragma("journal_mode", settings["journal_mode"])
+        self.pragma("synchronous", max(int(settings["synchronous"]), 2))
+        self.pragma("cache_size", settings["cache_size"])
+        self.pragma("temp_store", settings["temp_store"])
@@ -0,0 +1,184 @@
+import sqlite3
+import pytest
+from mysql.connector.errors import OperationalError
+import db_pool
+from batch_writer import BatchWriter, MySQLBatchWriter, estimate_row_bytes
+
+
+class ServerError(Exception):
+    def __init__(self, errno):
+        super().__init__(f"error {errno}")
+        self.errno = errno
+
+
+class FakeMySQL:
+    """
+    Keeps the rows of multi-row INSERTs per transaction, `failures` are raised by the next statements.
+    A deadlock (1213) undoes the transaction, a lock wait timeout (1205) only the statement, as in InnoDB.
+    """
+    def __init__(self, failures=()):
+        self.failures = list(failures)
+        self.committed = []
+        self.open = []
+
+
+    def cursor(self):
+        return self
+
+
+    def execute(self, query, params=None):
+        if self.failures:
+            errno = self.failures.pop(0)
+            if errno == 1213:
+                self.open = []
+            raise ServerError(errno)
+        columns = query.split(" VALUES ")[0].count("`") // 2
+        self.open.extend(tuple(params[i:i + columns]) for i in range(0, len(params), columns))
+
+
+    def commit(self):
+        self.committed.extend(self.open)
+        self.open = []
+
+
+    def rollback(self):
+        self.open = []
+
+
+    def close(self):
+        pass
+
+
+def test_failed_batch_falls_back_to_single_rows():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, name TEXT NOT NULL)")
+    errors = []
+    writer = BatchWriter(conn, batch_size=100, commit=True, on_error=lambda table, data, error: errors.append(data))
+    for row in [{"id": 1, "name": "a"}, {"id": 2, "name": "b"}, {"id": 1, "name": "dup"}, {"id": 3, "name": "c"}]:
+        writer.add("t", row)
+    writer.close()
+
+    assert conn.execute("SELECT id, name FROM t ORDER BY id").fetchall() == [(1, "a"), (2, "b"), (3, "c")]
+    assert errors == [{"id": 1, "name": "dup"}]
+    assert writer.rows_written == 3
+
+
+def test_batches_flush_in_first_seen_order():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("CREATE TABLE parent (id INTEGER PRIMARY KEY)")
+    conn.execute("CREATE TABLE child (id INTEGER PRIMARY KEY, parent_id INTEGER NOT NULL REFERENCES parent (id))")
+    writer = BatchWriter(conn, batch_size=4, commit=True)
+    for i in range(10):
+        writer.add("parent", {"id": i})
+        writer.add("child", {"id": i, "parent_id": i})
+    writer.close()
+    assert conn.execute("SELECT COUNT(*) FROM child").fetchone()[0] == 10
+
+
+def test_row_size_counts_utf8_and_escapes():
+    assert estimate_row_bytes(["abc"]) == 5
+    assert estimate_row_bytes(["é\U0001F600"]) == 8
+    assert estimate_row_bytes(["it's\n"]) == 9
+    assert estimate_row_bytes([None, 12]) == 8
+
+
+@pytest.mark.parametrize("errno", [1213, 1205])
+def test_rolled_back_transaction_is_replayed(errno):
+    conn = FakeMySQL()
+    writer = MySQLBatchWriter(conn, batch_size=2, commit_rows=100, commit_interval_ms=10**6, max_packet=10**6)
+    for i in range(4):
+        writer.add("t", {"id": i})
+    conn.failures = [errno]
+    for i in range(4, 6):
+        writer.add("t", {"id": i})
+    writer.close()
+
+    assert conn.committed == [(i,) for i in range(6)]
+    assert writer.replays == 1
+    assert writer.rows_committed == writer.rows_written == 6
+
+
+def test_transaction_that_keeps_failing_raises():
+    conn = FakeMySQL()
+    writer = MySQLBatchWriter(conn, batch_size=2, commit_rows=100, commit_interval_ms=10**6, max_packet=10**6,
+                              max_replays=2)
+    writer.add("t", {"id": 1})
+    writer.add("t", {"id": 2})
+    conn.failures = [1213] * 10
+    with pytest.raises(ServerError):
+        writer.add("t", {"id": 3})
+        writer.add("t", {"id": 4})
+    assert conn.committed == []
+    assert writer.rows_committed == 0
+
+
+class PooledConnection(FakeMySQL):
+    """
+    Connection of a FakeMySQL server, killing it drops its open transaction like a server restart.
+    """
+    def __init__(self, server):
+        super().__init__()
+        self.server = server
+        self.alive = True
+
+
+    @property
+    def in_transaction(self):
+        return bool(self.open)
+
+
+    def execute(self, query, params=None):
+        if not self.alive:
+            raise OperationalError(msg="Lost connection to MySQL server during query", errno=2013)
+        super().execute(query, params)
+
+
+    def commit(self):
+        if not self.alive:
+            raise OperationalError(msg="Lost connection to MySQL server during query", errno=2013)
+        self.server.committed.extend(self.open)
+        self.open = []
+
+
+    def kill(self):
+        self.alive = False
+        self.open = []
+
+
+def test_lost_connection_is_replaced_and_replayed(monkeypatch):
+    server = FakeMySQL()
+    opened = []
+
+    def connect(**config):
+        opened.append(PooledConnection(server))
+        return opened[-1]
+    monkeypatch.setattr(db_pool.mysql.connector, "connect", connect)
+
+    pool = db_pool.ConnectionPool({}, size=1)
+    writer = MySQLBatchWriter(pool.acquire(), batch_size=2, commit_rows=100, commit_interval_ms=10**6,
+                              max_packet=10**6, pool=pool)
+    for i in range(4):
+        writer.add("t", {"id": i})
+    opened[0].kill()
+    for i in range(4, 6):
+        writer.add("t", {"id": i})
+    writer.close()
+
+    assert server.committed == [(i,) for i in range(6)]
+    assert len(opened) == 2 and writer.conn is opened[1]
+    assert writer.rows_committed == 6
+    pool.release(writer.conn)
+    assert pool.stats()["open"] == 1
+
+
+def test_lost_connection_without_pool_fails_the_rows():
+    conn = PooledConnection(FakeMySQL())
+    errors = []
+    writer = MySQLBatchWriter(conn, batch_size=2, commit_rows=100, commit_interval_ms=10**6, max_packet=10**6,
+                              on_error=lambda table, data, error: errors.append(data))
+    conn.kill()
+    writer.add("t", {"id": 1})
+    writer.add("t", {"id": 2})
+    assert errors == [{"id": 1}, {"id": 2}]
+    assert writer.replays == 0
@@ -0,0 +1,60 @@
+import os
+from checkpoint import CheckpointManifest, manifest_for
+
+
+def write_export(path, text='{"users": [1, 2, 3]}'):
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(text)
+
+
+def test_resume_from_saved_entries(tmp_path):
+    export = tmp_path / "users.json"
+    write_export(export)
+    manifest = manifest_for(str(tmp_path / "checkpoints"), "dbs/credo.sqlite3")
+    assert manifest.start_file(str(export)) == 0
+    manifest.mark(str(export), 2)
+    manifest.save()
+
+    resumed = manifest_for(str(tmp_path / "checkpoints"), "dbs/credo.sqlite3")
+    assert resumed.start_file(str(export)) == 2
+    resumed.mark(str(export), 3, done=True)
+    resumed.save()
+    assert manifest_for(str(tmp_path / "checkpoints"), "dbs/credo.sqlite3").start_file(str(export)) is None
+
+
+def test_changed_file_loads_from_start(tmp_path):
+    export = tmp_path / "users.json"
+    write_export(export)
+    path = str(tmp_path / "manifest.json")
+    manifest = CheckpointManifest(path)
+    manifest.start_file(str(export))
+    manifest.mark(str(export), 2)
+    manifest.save()
+
+    write_export(export, '{"users": [4, 5, 6, 7]}')
+    assert CheckpointManifest(path).start_file(str(export)) == 0
+
+
+def test_touched_file_keeps_progress(tmp_path):
+    export = tmp_path / "users.json"
+    write_export(export)
+    path = str(tmp_path / "manifest.json")
+    manifest = CheckpointManifest(path)
+    manifest.start_file(str(export))
+    manifest.mark(str(export), 2)
+    manifest.save()
+
+    stat = os.stat(export)
+    os.utime(export, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert CheckpointManifest(path).start_file(str(export)) == 2
+
+
+def test_without_path_nothing_is_kept(tmp_path):
+    export = tmp_path / "users.json"
+    write_export(export)
+    manifest = manifest_for("", "dbs/credo.sqlite3")
+    manifest.start_file(str(export))
+    manifest.mark(str(export), 2)
+    manifest.save()
+    assert manifest.start_file(str(export)) == 0
+    assert os.listdir(tmp_path) == ["users.json"]
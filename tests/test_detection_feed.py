@@ -0,0 +1,102 @@
+import sqlite3
+import pytest
+from detection_feed import DetectionFeed, FeedDirectory, FeedWriter, ShardedDetectionFeed, ensure_feed_table, feed_table
+from tsv_loader import TsvBulkLoader
+
+
+def feed_connection(rows):
+    conn = sqlite3.connect(":memory:")
+    ensure_feed_table(conn)
+    conn.executemany(
+        f"INSERT INTO {feed_table} (timestamp, detection_id, device_id, username, display_name, team_name) "
+        "VALUES (?, ?, 1, 'user', 'User', 'team')",
+        rows,
+    )
+    conn.commit()
+    return conn
+
+
+# Three detections per timestamp, so page boundaries fall inside a timestamp
+feed_rows = [(detection_id // 3, detection_id) for detection_id in range(1, 26)]
+newest_first = sorted(feed_rows, reverse=True)
+
+
+def keys(rows):
+    return [(row[0], row[1]) for row in rows]
+
+
+@pytest.mark.parametrize("page_size", [1, 2, 4, 7, 25, 100])
+def test_pages_cover_the_feed_once(page_size):
+    feed = DetectionFeed(feed_connection(feed_rows), page_size=page_size, fetch_size=2, source="feed")
+    pages = list(feed.pages())
+    assert keys(row for page in pages for row in page) == newest_first
+    assert all(len(page) <= page_size for page in pages)
+
+
+def test_page_continues_after_key():
+    feed = DetectionFeed(feed_connection(feed_rows), page_size=4, fetch_size=3, source="feed")
+    read = []
+    rows, after = feed.page()
+    while True:
+        read.extend(rows)
+        if after is None:
+            break
+        assert after == (read[-1][0], read[-1][1])
+        rows, after = feed.page(after)
+    assert keys(read) == newest_first
+
+
+def test_max_rows_stops_mid_page():
+    feed = DetectionFeed(feed_connection(feed_rows), page_size=4, source="feed")
+    pages = list(feed.pages(max_rows=10))
+    assert [len(page) for page in pages] == [4, 4, 2]
+    assert keys(row for page in pages for row in page) == newest_first[:10]
+
+
+def test_sharded_feed_merges_shards():
+    shard_conns = {
+        1: feed_connection([row for row in feed_rows if row[1] % 2]),
+        2: feed_connection([row for row in feed_rows if not row[1] % 2]),
+    }
+    feed = ShardedDetectionFeed(shard_conns, page_size=4, fetch_size=2, source="feed")
+    pages = list(feed.pages())
+    assert keys(row for page in pages for row in page) == newest_first
+    assert feed.shard_of == {row[1]: 2 - row[1] % 2 for row in pages[-1]}
+
+
+def test_frames_without_frame_table():
+    conn = feed_connection(feed_rows)
+    conn.execute("CREATE TABLE credocommon_detection (id INTEGER PRIMARY KEY, frame_content BLOB)")
+    conn.executemany("INSERT INTO credocommon_detection VALUES (?, ?)", [(1, b"a"), (2, b"b")])
+    assert DetectionFeed(conn, source="feed").frames([1, 2]) == {1: b"a", 2: b"b"}
+
+
+def test_unknown_device_is_looked_up_once_per_flush():
+    looked_up = []
+    directory = FeedDirectory(lambda device_id: looked_up.append(device_id))
+    for detection_id in range(3):
+        assert directory.feed_row({"id": detection_id, "timestamp": 1, "device_id": 7})["username"] is None
+    assert looked_up == [7]
+
+    directory.forget_missing()
+    directory.feed_row({"id": 3, "timestamp": 1, "device_id": 7})
+    assert looked_up == [7, 7]
+    assert directory.unresolved == 4
+
+
+def test_bulk_load_feed_does_not_look_up_owners(tmp_path):
+    loader = TsvBulkLoader(None, directory=str(tmp_path))
+    feed = FeedWriter(loader)
+    assert feed.directory.lookup is None
+    assert feed.directory.feed_row({"id": 1, "timestamp": 1, "device_id": 7})["username"] is None
+    assert feed.directory.lookups == 0
+    loader.close()
+
+
+@pytest.mark.parametrize("module_name", ["json_to_mysql", "json_to_shards"])
+def test_loaders_refuse_feed_without_inline_frames(module_name, monkeypatch):
+    loader = __import__(module_name)
+    monkeypatch.setattr(loader, "detection_feed", True)
+    monkeypatch.setattr(loader, "frame_store", "files")
+    with pytest.raises(SystemExit, match="FRAME_STORE=inline"):
+        loader.main()
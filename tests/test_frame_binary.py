@@ -0,0 +1,46 @@
+import base64
+import sqlite3
+from frame_binary import decode_frame, migrate_sqlite, migrate_sqlite_table
+
+
+def frame(n, size=32):
+    return bytes([n]) * size
+
+
+def detections_db(path, frames):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE credocommon_detection (id INTEGER PRIMARY KEY, frame_content BLOB)")
+    conn.executemany("INSERT INTO credocommon_detection (id, frame_content) VALUES (?, ?)", enumerate(frames, 1))
+    conn.commit()
+    return conn
+
+
+def stored(conn):
+    return [row[0] for row in conn.execute("SELECT frame_content FROM credocommon_detection ORDER BY id")]
+
+
+def test_decode_frame():
+    assert decode_frame(base64.b64encode(frame(1)).decode()) == frame(1)
+    assert decode_frame(frame(2)) == frame(2)
+    assert decode_frame(None) is None
+
+
+def test_migration_decodes_text_frames_and_can_run_again(tmp_path):
+    frames = [base64.b64encode(frame(n)).decode() for n in range(5)] + [None, frame(9), "not base64!"]
+    conn = detections_db(str(tmp_path / "db.sqlite3"), frames)
+
+    assert migrate_sqlite_table(conn, "credocommon_detection", batch_size=2) == (5, 1)
+    expected = [frame(n) for n in range(5)] + [None, frame(9), "not base64!"]
+    assert stored(conn) == expected
+
+    # Already binary rows and NULL frames are left alone, only the invalid text is looked at again
+    assert migrate_sqlite_table(conn, "credocommon_detection", batch_size=2) == (0, 1)
+    assert stored(conn) == expected
+
+
+def test_migrate_sqlite_skips_missing_frame_table(tmp_path):
+    path = str(tmp_path / "db.sqlite3")
+    detections_db(path, [base64.b64encode(frame(3)).decode()]).close()
+    migrate_sqlite(path, vacuum=False)
+    conn = sqlite3.connect(path)
+    assert stored(conn) == [frame(3)]
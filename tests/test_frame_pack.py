@@ -0,0 +1,73 @@
+import base64
+import pytest
+from frame_pack import FramePack
+
+
+def frame(n, size=64):
+    return bytes([n]) * size
+
+
+def test_append_read_delete(tmp_path):
+    pack = FramePack(str(tmp_path), fsync=False)
+    refs = {detection_id: pack.append(detection_id, frame(detection_id)) for detection_id in range(1, 4)}
+    assert refs[2] == "pack:2"
+    assert bytes(pack.read(refs[2])) == frame(2)
+    assert bytes(pack.read(3)) == frame(3)
+
+    pack.delete(2)
+    assert pack.read(refs[2]) is None
+    assert bytes(pack.read(refs[1])) == frame(1)
+    pack.close()
+
+    reopened = FramePack(str(tmp_path), fsync=False)
+    assert bytes(reopened.read("pack:3")) == frame(3)
+    reopened.close()
+
+
+def test_compact_moves_live_frames(tmp_path):
+    pack = FramePack(str(tmp_path), segment_size=256, fsync=False)
+    for detection_id in range(1, 13):
+        pack.append(detection_id, frame(detection_id))
+    segments = pack.segments()
+    assert len(segments) == 3
+    for detection_id in (1, 2, 3, 5, 6, 7):
+        pack.delete(detection_id)
+
+    reclaimed = pack.compact()
+    assert reclaimed == 6 * 64
+    assert segments[0] not in pack.segments() and segments[1] not in pack.segments()
+    for detection_id in (4, 8, 9, 10, 11, 12):
+        assert bytes(pack.read(detection_id)) == frame(detection_id)
+    for detection_id in (1, 5):
+        assert pack.read(detection_id) is None
+    pack.close()
+
+
+def test_shared_frame_lives_until_last_reference(tmp_path):
+    pack = FramePack(str(tmp_path), fsync=False, dedup=True)
+    content = base64.b64encode(frame(7)).decode()
+    first = pack.submit(1, content)
+    second = pack.submit(2, content)
+    other = pack.submit(3, base64.b64encode(frame(8)).decode())
+    assert first == second != other
+    assert pack.bytes_written == 2 * 64
+
+    pack.delete(1)
+    assert bytes(pack.read(second)) == frame(7)
+    pack.delete(2)
+    assert pack.read(second) is None
+    assert bytes(pack.read(other)) == frame(8)
+
+    # Gone from the deduplicator too, the next copy is stored again
+    assert pack.submit(4, content) == first
+    assert bytes(pack.read(first)) == frame(7)
+    pack.close()
+
+
+@pytest.mark.parametrize("module_name", ["json_to_mysql", "json_to_shards"])
+def test_mysql_loaders_refuse_inline_frame_dedup(module_name, monkeypatch):
+    loader = __import__(module_name)
+    monkeypatch.setattr(loader, "frame_dedup", True)
+    monkeypatch.setattr(loader, "frame_store", "inline")
+    with pytest.raises(SystemExit, match="FRAME_DEDUP=1"):
+        loader.main()
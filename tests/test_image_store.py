@@ -0,0 +1,17 @@
+import base64
+import os
+from image_store import ImageWriter
+
+
+def test_flush_waits_for_queued_frames(tmp_path):
+    images = ImageWriter(str(tmp_path), workers=3, queue_size=4, fsync_batch=2)
+    paths = [images.submit(detection_id, base64.b64encode(bytes([detection_id]) * 32).decode())
+             for detection_id in range(1, 20)]
+    images.flush()
+    assert images.images_written == 19
+    assert all(os.path.getsize(path) == 32 for path in paths)
+
+    # The workers keep running after a flush
+    path = images.submit(20, base64.b64encode(b"x" * 8).decode())
+    images.close()
+    assert os.path.getsize(path) == 8
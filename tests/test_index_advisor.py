@@ -0,0 +1,33 @@
+import json
+import sqlite3
+import index_advisor
+from performance_test import Benchmark
+
+
+def detections_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE detection (id INTEGER PRIMARY KEY, device_id INTEGER, timestamp BIGINT)")
+    conn.executemany("INSERT INTO detection (device_id, timestamp) VALUES (?, ?)",
+                     [(i % 50, i) for i in range(2000)])
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_advise_reports_the_queries_that_can_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_advisor, "advisor_iterations", 1)
+    monkeypatch.setattr(index_advisor, "advisor_ingest_rows", 100)
+    monkeypatch.setattr(index_advisor, "benchmarks", {
+        "by_device": Benchmark("by_device", "SELECT timestamp FROM detection WHERE device_id = ?", params=(7,)),
+        "missing_table": Benchmark("missing_table", "SELECT * FROM frame", requires_table="frame"),
+        "with_runner": Benchmark("with_runner", "SELECT * FROM detection WHERE id > ?", runner=lambda *a, **k: {}),
+        "broken": Benchmark("broken", "SELECT no_such_column FROM detection"),
+    })
+    output_dir = tmp_path / "out"
+    index_advisor.advise(str(detections_db(tmp_path / "db.sqlite3")), output_dir=str(output_dir))
+
+    with open(output_dir / "index_advisor.json", encoding="utf-8") as file:
+        report = json.load(file)
+    assert list(report["baseline"]) == ["by_device"]
+    assert any(row["action"] == "add" and "device_id" in row["columns"] for row in report["results"])
+    assert (output_dir / "index_advisor.csv").exists()
@@ -0,0 +1,52 @@
+import json
+import pytest
+from json_stream import iter_json_entries, _StreamReader
+
+
+export = {
+    "team": [{"id": 1, "name": "aé\U0001F600"}],
+    "detections": [{"id": i, "x": -2.5, "y": 5e10, "z": -12345.678e-3, "t": True, "n": None} for i in range(50)],
+    "meta": {"skipped": [1, 2]},
+    "users": [1, 2.0, -3e5, 12345678901234567890],
+}
+
+
+@pytest.fixture
+def export_file(tmp_path):
+    path = tmp_path / "export.json"
+    path.write_text(json.dumps(export), encoding="utf-8")
+    return str(path)
+
+
+def expected(keys=None):
+    return [(key, entry) for key, value in export.items() if isinstance(value, list) and (keys is None or key in keys)
+            for entry in value]
+
+
+@pytest.mark.parametrize("chunk_size", list(range(1, 24)) + [1024 * 1024])
+def test_every_chunk_boundary(export_file, chunk_size):
+    assert list(iter_json_entries(export_file, chunk_size=chunk_size)) == expected()
+
+
+def test_number_split_after_dot_and_exponent(tmp_path):
+    path = tmp_path / "numbers.json"
+    path.write_text('{"users": [-2.5, 5e10, 7]}', encoding="utf-8")
+    for chunk_size in range(1, 20):
+        assert [entry for _, entry in iter_json_entries(str(path), chunk_size=chunk_size)] == [-2.5, 5e10, 7]
+
+
+def test_only_wanted_keys(export_file):
+    assert list(iter_json_entries(export_file, {"users"}, chunk_size=7)) == expected({"users"})
+
+
+def test_malformed_value_is_not_buffered_whole(tmp_path):
+    path = tmp_path / "broken.json"
+    path.write_text('{"detections": [{"id": 1, "frame": "' + "a" * 100000 + "]}", encoding="utf-8")
+    with open(path, "r", encoding="utf-8") as file:
+        reader = _StreamReader(file, 1024, max_buffer=0.01)
+        reader.expect("{")
+        reader.decode()
+        reader.expect(":")
+        with pytest.raises(ValueError, match="No complete JSON value"):
+            list(reader.iter_array())
+        assert len(reader.buf) < 64 * 1024
@@ -0,0 +1,58 @@
+import json
+import os
+import pytest
+from parallel_ingest import parallel_insert
+
+
+table_mapping = {"users": "credocommon_user"}
+
+
+def entry_rows(table_name, entry):
+    return [(table_name, entry)]
+
+
+def crashing_entry_rows(table_name, entry):
+    if entry["id"] == 13:
+        # Like an OOM kill, the worker is gone without posting anything
+        os._exit(1)
+    return [(table_name, entry)]
+
+
+@pytest.fixture
+def export_directory(tmp_path):
+    for n in range(3):
+        path = tmp_path / f"users_{n}.json"
+        path.write_text(json.dumps({"users": [{"id": n * 10 + i} for i in range(5)]}), encoding="utf-8")
+    return str(tmp_path)
+
+
+def test_rows_of_every_file_reach_the_sink(export_directory):
+    rows = []
+    finished = []
+    parallel_insert(export_directory, table_mapping, entry_rows, lambda table, data: rows.append(data["id"]),
+                    workers=2, batch_rows=2, on_file=lambda filepath, entries, done: finished.append((entries, done)))
+    assert sorted(rows) == [n * 10 + i for n in range(3) for i in range(5)]
+    assert finished == [(5, True)] * 3
+
+
+def test_dead_worker_raises(export_directory):
+    finished = []
+    with pytest.raises(RuntimeError, match="exited before finishing"):
+        parallel_insert(export_directory, table_mapping, crashing_entry_rows, lambda table, data: None,
+                        workers=1, on_file=lambda filepath, entries, done: finished.append(os.path.basename(filepath)),
+                        poll_interval=0.1)
+    # Messages a killed worker had not flushed are lost, the file it died in is never reported as loaded
+    assert "users_1.json" not in finished
+
+
+def test_file_failing_to_parse_reports_the_entries_sent(export_directory):
+    # Cut off inside the fourth entry
+    with open(os.path.join(export_directory, "users_1.json"), "w", encoding="utf-8") as file:
+        file.write('{"users": [{"id": 10}, {"id": 11}, {"id": 12}, {"id": 1')
+    rows = []
+    finished = {}
+    parallel_insert(export_directory, table_mapping, entry_rows, lambda table, data: rows.append(data["id"]),
+                    workers=2, batch_rows=2,
+                    on_file=lambda filepath, entries, done: finished.update({os.path.basename(filepath): (entries, done)}))
+    assert finished == {"users_0.json": (5, True), "users_1.json": (3, False), "users_2.json": (5, True)}
+    assert [row for row in rows if 10 <= row < 20] == [10, 11, 12]
@@ -0,0 +1,291 @@
+from contextlib import contextmanager
+import time
+import pytest
+from json_to_shards import ConsistentHashRing, RoundRobinPlacement, ShardManager, ShardWriter, report_shard_moves
+
+
+class ShardCursor:
+    def __init__(self, rows, error=None):
+        self.rows = list(rows)
+        self.error = error
+
+
+    def execute(self, query, params=None):
+        if self.error:
+            raise self.error
+
+
+    def fetchmany(self, size=1):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+    def close(self):
+        pass
+
+
+class ShardPool:
+    """
+    Stands in for db_pool.ConnectionPool, every cursor returns the shard's rows.
+    """
+    def __init__(self, rows, error=None):
+        self.rows = rows
+        self.error = error
+
+
+    @contextmanager
+    def connection(self):
+        yield self
+
+
+    def cursor(self):
+        return ShardCursor(self.rows, self.error)
+
+
+def shard_manager(shard_rows):
+    sm = ShardManager.__new__(ShardManager)
+    sm.shards = {shard_id: ShardPool(rows) for shard_id, rows in shard_rows.items()}
+    return sm
+
+
+def test_adding_a_shard_only_moves_users_to_it():
+    ring = ConsistentHashRing([1, 2, 3])
+    user_ids = range(1, 20001)
+    grown = ConsistentHashRing([1, 2, 3, 4])
+    moved = [user_id for user_id in user_ids if ring.shard_for(user_id) != grown.shard_for(user_id)]
+
+    assert report_shard_moves(ring, user_ids, added=[4]) == len(moved)
+    assert all(grown.shard_for(user_id) == 4 for user_id in moved)
+    assert 0.15 < len(moved) / len(user_ids) < 0.35
+
+
+def test_removing_a_shard_only_moves_its_users():
+    ring = ConsistentHashRing([1, 2, 3, 4])
+    user_ids = range(1, 20001)
+    on_removed = sum(1 for user_id in user_ids if ring.shard_for(user_id) == 4)
+    assert report_shard_moves(ring, user_ids, removed=[4]) == on_removed
+    assert ring.weights == {1: 1, 2: 1, 3: 1, 4: 1}
+
+
+def test_weighted_shard_moves_more_users():
+    ring = ConsistentHashRing([1, 2, 3])
+    user_ids = range(1, 20001)
+    assert report_shard_moves(ring, user_ids, added=[(4, 2)]) > report_shard_moves(ring, user_ids, added=[4])
+
+
+def test_round_robin_resume_continues_after_placed_users():
+    straight = RoundRobinPlacement([1, 2, 3])
+    placed = [straight.shard_for(user_id) for user_id in range(10)]
+    resumed = RoundRobinPlacement([1, 2, 3])
+    resumed.resume(4)
+    assert [resumed.shard_for(user_id) for user_id in range(4, 10)] == placed[4:]
+
+
+def test_scatter_gather_merges_in_order_with_limit():
+    sm = shard_manager({
+        1: [(9, "a"), (6, "a"), (1, "a")],
+        2: [(8, "b"), (7, "b"), (2, "b")],
+        3: [(5, "c"), (4, "c"), (3, "c")],
+    })
+    rows = list(sm.scatter_gather("SELECT", order_by=0, descending=True, limit=5, fetch_size=1, queue_size=1))
+    assert rows == [(9, "a"), (8, "b"), (7, "b"), (6, "a"), (5, "c")]
+    assert set(sm.shard_execute_times) == {1, 2, 3}
+
+
+def test_scatter_gather_ascending_reads_everything():
+    sm = shard_manager({1: [(1,), (4,)], 2: [(2,), (3,), (5,)], 3: []})
+    assert list(sm.scatter_gather("SELECT", order_by=lambda row: row[0], fetch_size=2)) == [(1,), (2,), (3,), (4,), (5,)]
+
+
+def test_scatter_gather_reports_the_failed_shard():
+    sm = shard_manager({1: [(1,)]})
+    sm.shards[2] = ShardPool([], error=ValueError("gone"))
+    with pytest.raises(RuntimeError, match="shard 2"):
+        list(sm.scatter_gather("SELECT", order_by=0))
+
+
+class ServerError(Exception):
+    def __init__(self, errno):
+        super().__init__(f"error {errno}")
+        self.errno = errno
+
+
+class ShardConnection:
+    """
+    Shard connection whose statements fail with a deadlock from the `fail_from`-th one on.
+    A killed connection fails everything with a lost connection error and drops its open transaction.
+    """
+    def __init__(self, fail_from=None, server=None):
+        self.fail_from = fail_from
+        self.server = server if server is not None else self
+        self.statements = 0
+        self.committed = 0
+        self.open = 0
+        self.alive = True
+
+
+    def cursor(self):
+        return self
+
+
+    def execute(self, query, params=None):
+        if not self.alive:
+            raise ServerError(2013)
+        self.statements += 1
+        if query.startswith("SELECT @@max_allowed_packet"):
+            return
+        if self.fail_from is not None and self.statements >= self.fail_from:
+            self.open = 0
+            raise ServerError(1213)
+        self.open += query.count("(%s")
+
+
+    def fetchone(self):
+        return (1024 * 1024,)
+
+
+    def commit(self):
+        if not self.alive:
+            raise ServerError(2013)
+        self.server.committed += self.open
+        self.open = 0
+
+
+    def rollback(self):
+        self.open = 0
+
+
+    def close(self):
+        pass
+
+
+class WriterPool:
+    def __init__(self, conn):
+        self.conn = conn
+        self.broken = []
+
+
+    def acquire(self):
+        if self.conn is None:
+            self.conn = ShardConnection(server=self.broken[0].server)
+        return self.conn
+
+
+    def release(self, conn, broken=False):
+        if broken:
+            self.broken.append(conn)
+            self.conn = None
+
+
+def test_shard_writer_counts_uncommitted_rows_as_failed():
+    conn = ShardConnection(fail_from=4)
+    writer = ShardWriter(1, WriterPool(conn), batch_size=4, commit_rows=100, commit_interval_ms=10**6)
+    for i in range(4):
+        writer.add("t", {"id": i})
+    writer.flush()
+    for i in range(4, 12):
+        writer.add("t", {"id": i})
+    writer.flush()
+    writer.add("t", {"id": 12})
+    writer.close()
+
+    assert conn.committed == 4
+    assert writer.rows_written == 4
+    assert writer.failed_rows == 9
+    assert writer.error is not None
+
+
+def test_shard_writer_replays_on_a_new_connection():
+    conn = ShardConnection()
+    pool = WriterPool(conn)
+    writer = ShardWriter(1, pool, batch_size=2, commit_rows=100, commit_interval_ms=10**6)
+    for i in range(4):
+        writer.add("t", {"id": i})
+    # Wait until both batches are sent, then drop the connection with them uncommitted
+    deadline = time.monotonic() + 5
+    while conn.open < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    conn.alive = False
+    conn.open = 0
+    for i in range(4, 6):
+        writer.add("t", {"id": i})
+    writer.close()
+
+    assert pool.broken == [conn]
+    assert conn.committed == 6
+    assert writer.rows_written == 6
+    assert writer.failed_rows == 0 and writer.error is None
+
+
+class LookupCursor:
+    def __init__(self, pool):
+        self.pool = pool
+        self.rows = []
+
+
+    def execute(self, query, params=None):
+        if params:
+            self.pool.lookups.append(params[0])
+            shard_id = self.pool.routes.get(params[0])
+            self.rows = [{"shard_id": shard_id}] if shard_id is not None else []
+        else:
+            self.rows = list(self.pool.routes.items())
+
+
+    def fetchmany(self, size=1):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+
+    def close(self):
+        pass
+
+
+class LookupPool:
+    """
+    Stands in for db_pool.ConnectionPool on the lookup DB, user_shard is `routes`.
+    """
+    routes = {}
+
+    def __init__(self, config, size=1, name=None):
+        self.lookups = []
+
+
+    @contextmanager
+    def connection(self):
+        yield self
+
+
+    def cursor(self, dictionary=False):
+        return LookupCursor(self)
+
+
+def test_bounded_route_cache_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr("json_to_shards.ConnectionPool", LookupPool)
+    monkeypatch.setattr(LookupPool, "routes", {1: 1, 2: 2, 3: 1, 4: 2})
+    sm = ShardManager({}, {1: {}, 2: {}}, route_cache_size=2)
+    # Only the first routes fit into the bounded cache
+    assert list(sm.route_cache) == [1, 2]
+
+    assert sm.get_shard_for_user(1) == 1
+    assert sm.get_shard_for_user(3) == 1
+    # User 1 was used after user 2, so user 2 made room for user 3
+    assert list(sm.route_cache) == [1, 3]
+    assert sm.get_shard_for_user(2) == 2
+    assert sm.get_shard_for_user(3) == 1
+    assert sm.lookup_pool.lookups == [3, 2]
+    assert sm.route_cache_stats() == {"hits": 2, "misses": 2, "hit_rate": 0.5, "size": 2, "max_size": 2}
+
+
+def test_unbounded_route_cache_keeps_every_route(monkeypatch):
+    monkeypatch.setattr("json_to_shards.ConnectionPool", LookupPool)
+    monkeypatch.setattr(LookupPool, "routes", {user_id: user_id % 2 + 1 for user_id in range(10)})
+    sm = ShardManager({}, {1: {}, 2: {}})
+    for user_id in range(10):
+        assert sm.get_shard_for_user(user_id) == user_id % 2 + 1
+    assert sm.lookup_pool.lookups == []
+    assert sm.route_cache_stats()["hits"] == 10
@@ -0,0 +1,59 @@
+import sqlite3
+from sqlite_bulk import SQLiteBulkLoad, dropped_indexes_table
+
+
+def schema(conn):
+    return sorted(conn.execute("SELECT type, name, tbl_name, sql FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'"))
+
+
+def pragmas(conn):
+    return {name: conn.execute(f"PRAGMA {name}").fetchone()[0]
+            for name in ("journal_mode", "synchronous", "cache_size", "temp_store")}
+
+
+def detections_db(path):
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE detection (id INTEGER PRIMARY KEY, device_id INTEGER, timestamp BIGINT, hash TEXT);
+        CREATE INDEX idx_detection_device ON detection (device_id, timestamp DESC);
+        CREATE INDEX IF NOT EXISTS idx_detection_timestamp ON detection (timestamp);
+        CREATE UNIQUE INDEX idx_detection_hash ON detection (hash);
+    """)
+    conn.commit()
+    return conn
+
+
+def test_begin_drops_secondary_indexes_and_finish_restores_them(tmp_path):
+    conn = detections_db(str(tmp_path / "db.sqlite3"))
+    schema_before = schema(conn)
+    pragmas_before = pragmas(conn)
+    bulk = SQLiteBulkLoad(conn, cache_mb=64)
+
+    bulk.begin()
+    indexes = [row[1] for row in schema(conn) if row[0] == "index"]
+    assert indexes == ["idx_detection_hash"]
+    assert pragmas(conn)["synchronous"] == 0
+    conn.executemany("INSERT INTO detection (device_id, timestamp, hash) VALUES (?, ?, ?)",
+                     [(i % 7, i, str(i)) for i in range(100)])
+    conn.commit()
+
+    bulk.finish()
+    assert schema(conn) == schema_before
+    assert conn.execute("SELECT COUNT(*) FROM sqlite_stat1 WHERE tbl = 'detection'").fetchone()[0] > 0
+    assert pragmas(conn) == pragmas_before
+
+
+def test_finish_rebuilds_indexes_of_an_interrupted_load(tmp_path):
+    path = str(tmp_path / "db.sqlite3")
+    conn = detections_db(path)
+    schema_before = schema(conn)
+    SQLiteBulkLoad(conn).begin()
+    conn.close()
+
+    # A new run after the crash: its begin() finds nothing left to drop, finish() rebuilds from the saved definitions
+    conn = sqlite3.connect(path)
+    bulk = SQLiteBulkLoad(conn)
+    bulk.begin()
+    bulk.finish()
+    assert schema(conn) == schema_before
+    assert conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (dropped_indexes_table,)).fetchone() is None
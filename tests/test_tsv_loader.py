@@ -0,0 +1,69 @@
+from tsv_loader import TsvBulkLoader, encode_tsv_field, escape_tsv_value, table_load_order
+
+
+class RecordingCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+
+
+    def execute(self, query, params=None):
+        table = query.split(" INTO TABLE ")[1].split()[0]
+        with open(params[0], "rb") as file:
+            self.rowcount = len(file.read().splitlines())
+        self.conn.loaded.append(table)
+
+
+    def close(self):
+        pass
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.loaded = []
+
+
+    def cursor(self):
+        return RecordingCursor(self)
+
+
+    def commit(self):
+        pass
+
+
+def test_escape_values():
+    assert escape_tsv_value(None) == b"\\N"
+    assert escape_tsv_value(True) == b"1"
+    assert escape_tsv_value(False) == b"0"
+    assert escape_tsv_value(12) == b"12"
+    assert escape_tsv_value("a\tb\nc\rd\\e\0f") == b"a\\tb\\nc\\rd\\\\e\\0f"
+    assert escape_tsv_value("é") == "é".encode("utf-8")
+
+
+def test_blob_columns_are_hex():
+    assert encode_tsv_field("frame_content", b"\x00\t\n") == b"00090a"
+    assert encode_tsv_field("frame_content", None) == b"\\N"
+    assert encode_tsv_field("name", b"\t") == b"\\t"
+
+
+def test_load_in_foreign_key_order(tmp_path):
+    conn = RecordingConnection()
+    loader = TsvBulkLoader(conn, directory=str(tmp_path))
+    loader.add("credocommon_detection", {"id": 1, "device_id": 1, "frame_content": b"x"})
+    loader.add("credocommon_device", {"id": 1, "user_id": 1})
+    loader.add("credocommon_user", {"id": 1, "team_id": 1})
+    loader.add("credocommon_team", {"id": 1, "name": "a\tb"})
+    loader.add("credocommon_user_info", {"id": 1})
+    loader.close()
+
+    assert conn.loaded == sorted(conn.loaded, key=table_load_order.index)
+    assert loader.rows_written == 5
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_load_query_unhexes_blobs(tmp_path):
+    loader = TsvBulkLoader(RecordingConnection(), directory=str(tmp_path))
+    query = loader.load_query("credocommon_detection", ("id", "frame_content"))
+    assert "(`id`, @frame_content)" in query
+    assert query.endswith("SET `frame_content` = UNHEX(@frame_content)")
+    loader.close()
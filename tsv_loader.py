@@ -0,0 +1,180 @@
+import os
+import shutil
+import tempfile
+import time
+from loader_metrics import metrics
+from batch_writer import connection_lost
+
+
+# Parent tables first, LOAD DATA keeps foreign key checks on
+table_load_order = [
+    "credocommon_team",
+    "credocommon_user_info",
+    "credocommon_user",
+    "credocommon_device",
+    "credocommon_device_version",
+    "credocommon_detection_info",
+    "credocommon_detection",
+    "credocommon_detection_v2",
+    "credocommon_ping",
+]
+
+# Written as hex and converted back with UNHEX so arbitrary bytes survive the text format
+blob_columns = {"frame_content"}
+
+
+def escape_tsv_value(value):
+    """
+    Encode a value for LOAD DATA with the default FIELDS ESCAPED BY '\\' settings.
+    """
+    if value is None:
+        return b"\\N"
+    if isinstance(value, bool):
+        return b"1" if value else b"0"
+    if isinstance(value, (bytes, bytearray)):
+        data = bytes(value)
+    else:
+        data = str(value).encode("utf-8")
+    return (data.replace(b"\\", b"\\\\")
+                .replace(b"\t", b"\\t")
+                .replace(b"\n", b"\\n")
+                .replace(b"\r", b"\\r")
+                .replace(b"\0", b"\\0"))
+
+
+def encode_tsv_field(column, value):
+    if column in blob_columns and value is not None:
+        if not isinstance(value, (bytes, bytearray)):
+            value = str(value).encode("utf-8")
+        return value.hex().encode()
+    return escape_tsv_value(value)
+
+
+class TsvBulkLoader:
+    """
+    Writes rows to one temporary TSV file per (table, column set) and loads them with
+    LOAD DATA LOCAL INFILE when closed. Has the same add/flush/close interface as BatchWriter,
+    so the loaders can use either. The connection must be opened with allow_local_infile=True.
+    With the db_pool.ConnectionPool `conn` came from, the connection is checked before loading and a table
+    whose load broke the connection is loaded again on a new one.
+    """
+    def __init__(self, conn, name="mysql", directory=None, keep_files=False, pool=None):
+        self.conn = conn
+        self.pool = pool
+        self.name = name
+        self.directory = tempfile.mkdtemp(prefix=f"credo_{name}_", dir=directory)
+        self.keep_files = keep_files
+        self.files = {}
+        self.row_counts = {}
+        self.rows_written = 0
+        self.write_time = 0.0
+        self.failed_tables = []
+
+
+    def add(self, table, data):
+        key = (table, tuple(data))
+        file = self.files.get(key)
+        if file is None:
+            path = os.path.join(self.directory, f"{table}_{len(self.files)}.tsv")
+            file = self.files[key] = open(path, "wb")
+            self.row_counts[key] = 0
+        start_time = time.perf_counter()
+        line = b"\t".join(encode_tsv_field(column, value) for column, value in data.items())
+        file.write(line + b"\n")
+        self.write_time += time.perf_counter() - start_time
+        self.row_counts[key] += 1
+
+
+    def flush(self):
+        for file in self.files.values():
+            file.flush()
+
+
+    def load_query(self, table, columns):
+        targets = []
+        assignments = []
+        for column in columns:
+            if column in blob_columns:
+                targets.append(f"@{column}")
+                assignments.append(f"`{column}` = UNHEX(@{column})")
+            else:
+                targets.append(f"`{column}`")
+        query = (
+            f"LOAD DATA LOCAL INFILE %s INTO TABLE {table} CHARACTER SET utf8mb4 "
+            "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' "
+            f"({', '.join(targets)})"
+        )
+        if assignments:
+            query += " SET " + ", ".join(assignments)
+        return query
+
+
+    def load_file(self, table, columns, path):
+        """
+        LOAD DATA one staged file and commit it, returns the number of rows loaded.
+        A load that broke the connection was not committed, it runs once more on a new connection.
+        """
+        for attempt in range(2):
+            try:
+                cursor = self.conn.cursor()
+                try:
+                    cursor.execute(self.load_query(table, columns), (path,))
+                    loaded = cursor.rowcount
+                finally:
+                    cursor.close()
+                self.conn.commit()
+                return loaded
+            except Exception as e:
+                if attempt or self.pool is None or not connection_lost(e):
+                    raise
+                print(f"[{self.name}] connection lost while loading {table} ({e}), reconnecting")
+                self.pool.release(self.conn, broken=True)
+                self.conn = None
+                self.conn = self.pool.acquire()
+
+
+    def load(self):
+        """
+        Load every staged file in foreign key order and report rows/sec per table.
+        """
+        for file in self.files.values():
+            file.close()
+
+        order = {table: i for i, table in enumerate(table_load_order)}
+        keys = sorted(self.files, key=lambda key: order.get(key[0], len(order)))
+        if self.pool is not None:
+            # Staging can take long enough for the server to drop an idle connection
+            self.conn = self.pool.validate(self.conn)
+        total_rows = 0
+        total_start = time.perf_counter()
+        for table, columns in keys:
+            path = self.files[(table, columns)].name
+            start_time = time.perf_counter()
+            try:
+                loaded = self.load_file(table, columns, path)
+            except Exception as e:
+                print(f"LOAD DATA error on {self.name} table {table}: {e}")
+                self.failed_tables.append(table)
+                metrics.record_error(table, e)
+                continue
+            elapsed = time.perf_counter() - start_time
+            metrics.record_batch(table, loaded, elapsed, size=os.path.getsize(path))
+            staged = self.row_counts[(table, columns)]
+            if loaded < staged:
+                metrics.count(table, "skipped", staged - loaded)
+            total_rows += loaded
+            rate = loaded / elapsed if elapsed > 0 else 0.0
+            skipped = f", {staged - loaded} skipped" if loaded < staged else ""
+            print(f"[{self.name}] {table}: {loaded} rows loaded in {elapsed:.2f}s ({rate:.0f} rows/s{skipped})")
+        self.rows_written = total_rows
+
+        elapsed = time.perf_counter() - total_start
+        rate = total_rows / elapsed if elapsed > 0 else 0.0
+        print(f"[{self.name}] LOAD DATA: {total_rows} rows in {elapsed:.2f}s ({rate:.0f} rows/s), "
+              f"TSV staging took {self.write_time:.2f}s")
+
+
+    def close(self):
+        self.load()
+        if not self.keep_files:
+            shutil.rmtree(self.directory, ignore_errors=True)